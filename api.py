@@ -1,21 +1,30 @@
 """Chatterbox TTS API Server - FastAPI + WebSocket"""
 import os
 import io
+import struct
 import uuid
 import time
 import tempfile
 import logging
+import inspect
 from pathlib import Path
 from typing import Optional
+from functools import lru_cache
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, File, UploadFile, Form, WebSocket, WebSocketDisconnect, HTTPException
-from fastapi.responses import FileResponse, StreamingResponse, HTMLResponse
+from fastapi.responses import FileResponse, StreamingResponse, HTMLResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 import torch
 import torchaudio as ta
 
 from gpu_manager import gpu_manager
+from inference_worker import InferenceWorker, QueueFullError
+from micro_batcher import MicroBatcher
+from voice_registry import VoiceRegistry
+from chatterbox.conds_cache import ConditionalsCache
+from chatterbox.models.t3 import CFGSchedule, T3BatchScheduler
+from chatterbox.models.s3gen.const import S3GEN_SR
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -26,32 +35,214 @@ UPLOAD_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
 
 MODEL_TYPE = os.getenv("MODEL_TYPE", "turbo")
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", 8))
+VOICE_DIR = Path(os.getenv("VOICE_DIR", Path(tempfile.gettempdir()) / "chatterbox_voices"))
+# 参考音频 conditionals 缓存：显存 / 内存 / 磁盘三级预算（MB），COND_CACHE_DIR 为空则不落盘
+COND_CACHE_GPU_MB = int(os.getenv("COND_CACHE_GPU_MB", 64))
+COND_CACHE_CPU_MB = int(os.getenv("COND_CACHE_CPU_MB", 512))
+COND_CACHE_DISK_MB = int(os.getenv("COND_CACHE_DISK_MB", 4096))
+COND_CACHE_DIR = os.getenv("COND_CACHE_DIR") or None
+# 用 torch.compile 编译 T3 单 token 解码步（首次请求会多花编译时间）
+T3_COMPILE = os.getenv("T3_COMPILE", "0").lower() in ("1", "true")
+# T3 前缀 KV 缓存（音色条件 + 共同文本开头）的显存预算（MB），0 关闭
+T3_PREFIX_CACHE_MB = int(os.getenv("T3_PREFIX_CACHE_MB", 512))
+# T3 哪些解码步使用 CFG，如 "first=200"、"every=2"（见 CFGSchedule.parse），默认每步；turbo 不使用 CFG
+T3_CFG_SCHEDULE = CFGSchedule.parse(os.getenv("T3_CFG_SCHEDULE", "full"))
+# 动态微批：非流式请求在窗口（毫秒）内攒批，最多 BATCH_MAX_SIZE 条一起走 T3 批解码 + S3Gen 批合成；1 关闭
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", 10))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", 4))
 
-def load_model():
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+inference_worker = InferenceWorker(max_queue_size=MAX_QUEUE_SIZE)
+voice_registry = VoiceRegistry(VOICE_DIR, model_type=MODEL_TYPE)
+micro_batcher = MicroBatcher(
+    lambda items: inference_worker.run(synthesize_batch, items), window_ms=BATCH_WINDOW_MS, max_batch_size=BATCH_MAX_SIZE,
+)
+
+def model_class():
     if MODEL_TYPE == "turbo":
         from chatterbox.tts_turbo import ChatterboxTurboTTS
-        return ChatterboxTurboTTS.from_pretrained(device=device)
+        return ChatterboxTurboTTS
     elif MODEL_TYPE == "multilingual":
         from chatterbox.mtl_tts import ChatterboxMultilingualTTS
-        return ChatterboxMultilingualTTS.from_pretrained(device=device)
-    else:
-        from chatterbox.tts import ChatterboxTTS
-        return ChatterboxTTS.from_pretrained(device=device)
+        return ChatterboxMultilingualTTS
+    from chatterbox.tts import ChatterboxTTS
+    return ChatterboxTTS
+
+def load_model():
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = model_class().from_pretrained(device=device)
+    model.conds_cache = ConditionalsCache(
+        device_budget=COND_CACHE_GPU_MB * 2**20,
+        cpu_budget=COND_CACHE_CPU_MB * 2**20,
+        disk_dir=Path(COND_CACHE_DIR) / MODEL_TYPE if COND_CACHE_DIR else None,
+        disk_budget=COND_CACHE_DISK_MB * 2**20,
+    )
+    if T3_COMPILE:
+        model.t3.compile_decode_step()
+    model.t3.enable_prefix_cache(T3_PREFIX_CACHE_MB * 2**20)
+    return model
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # 启动时预加载模型到 GPU
     gpu_manager.preload(load_model, "ChatterboxTTS")
-    logger.info(f"Chatterbox TTS started, model={MODEL_TYPE}, resident mode")
+    inference_worker.start()
+    logger.info(f"Chatterbox TTS started, model={MODEL_TYPE}, resident mode, "
+                f"micro-batching window={BATCH_WINDOW_MS}ms max_batch={BATCH_MAX_SIZE}")
     yield
 
 app = FastAPI(title="Chatterbox TTS API", version="1.0.0", lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
 
+def resolve_conds(model, params: dict):
+    """参考音频只构建本次请求的 conditionals，不修改模型共享的默认音色"""
+    if voice_id := params.pop('voice_id', None):
+        params['conds'] = voice_registry.get(voice_id, device=model.device)
+    elif audio_prompt_path := params.pop('audio_prompt_path', None):
+        params['conds'] = model.get_conditionals(audio_prompt_path)
+
+def synthesize(text: str, params: dict):
+    """在推理线程中执行：取模型并生成音频"""
+    model = gpu_manager.get_model(load_func=load_model, model_name="ChatterboxTTS")
+    gen_start = time.time()
+    resolve_conds(model, params)
+    wav = model.generate(text, **params)
+    return wav, model.sr, time.time() - gen_start
+
+def get_batch_scheduler(model):
+    """T3 批解码器随模型常驻（KV 缓存首批时按设备分配），模型重新加载或换设备后重建"""
+    scheduler = getattr(model, "batch_scheduler", None)
+    if scheduler is None or (scheduler.cache is not None and scheduler.cache.device != model.t3.device):
+        rows_per_request = 1 if MODEL_TYPE == "turbo" else 2  # CFG 每条请求占 cond / uncond 两行
+        scheduler = model.batch_scheduler = T3BatchScheduler(model.t3, max_rows=BATCH_MAX_SIZE * rows_per_request)
+    return scheduler
+
+def synthesize_batch(items: list):
+    """在推理线程中执行：一批 (text, params) 一起生成；单条请求出错只让它自己失败"""
+    model = gpu_manager.get_model(load_func=load_model, model_name="ChatterboxTTS")
+    gen_start = time.time()
+    results = [None] * len(items)
+    requests, indices = [], []
+    for i, (text, params) in enumerate(items):
+        try:
+            resolve_conds(model, params)
+        except Exception as e:
+            results[i] = e
+            continue
+        requests.append(dict(params, text=text))
+        indices.append(i)
+    if not requests:
+        return results
+    try:
+        wavs = model.generate_batch(requests, scheduler=get_batch_scheduler(model))
+    except Exception:
+        # 整批失败时逐条重试，把错误限定在出错的请求上
+        logger.exception("Batch synthesis failed, retrying requests one by one")
+        model.batch_scheduler = None
+        wavs = []
+        for request in requests:
+            try:
+                wavs.append(model.generate(**request))
+            except Exception as e:
+                wavs.append(e)
+    gen_time = time.time() - gen_start
+    for i, wav in zip(indices, wavs):
+        results[i] = wav if isinstance(wav, Exception) else (wav, model.sr, gen_time)
+    return results
+
+@lru_cache(maxsize=None)
+def default_cfg_weight() -> float:
+    """请求未带 cfg_weight 时模型 generate 的默认值（Turbo 没有 CFG，记为 0）"""
+    parameter = inspect.signature(model_class().generate).parameters.get('cfg_weight')
+    return parameter.default if parameter is not None else 0.0
+
+def batch_key(params: dict):
+    """同批请求的采样参数、音色、语言可以各不相同（T3 逐序列采样）；CFG 请求占两行 KV，与非 CFG 请求分开攒批"""
+    return params.get('cfg_weight', default_cfg_weight()) > 0.0
+
+async def generate_audio(text: str, params: dict):
+    """非流式合成：开启微批时与同一窗口内的请求合批，否则单独排队"""
+    if micro_batcher.enabled:
+        return await micro_batcher.submit((text, params), key=batch_key(params))
+    return await inference_worker.run(synthesize, text, params)
+
+def synthesize_stream(text: str, params: dict):
+    """在推理线程中执行：逐段生成，每段就绪即产出 16-bit PCM"""
+    model = gpu_manager.get_model(load_func=load_model, model_name="ChatterboxTTS")
+    resolve_conds(model, params)
+    for wav in model.generate_stream(text, **params):
+        yield (wav.clamp(-1, 1) * 32767).to(torch.int16).numpy().tobytes()
+
+def wav_stream_header(sample_rate: int, channels: int = 1, bits: int = 16) -> bytes:
+    """总长度未知的 WAV 头（RIFF/data 大小填 0xFFFFFFFF），客户端可边收边播"""
+    block_align = channels * bits // 8
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI', b'RIFF', 0xFFFFFFFF, b'WAVE', b'fmt ', 16, 1, channels,
+        sample_rate, sample_rate * block_align, block_align, bits, b'data', 0xFFFFFFFF,
+    )
+
+def build_params(temperature, top_p, top_k, repetition_penalty, exaggeration, cfg_weight, language_id,
+                 audio_prompt_path=None, voice_id=None) -> dict:
+    params = {'temperature': temperature, 'top_p': top_p, 'repetition_penalty': repetition_penalty}
+    if MODEL_TYPE == "turbo":
+        params['top_k'] = top_k
+    else:
+        params['exaggeration'] = exaggeration
+        params['cfg_weight'] = cfg_weight
+        params['cfg_schedule'] = T3_CFG_SCHEDULE
+        params['min_p'] = 0.05
+    if MODEL_TYPE == "multilingual":
+        params['language_id'] = language_id
+    if audio_prompt_path:
+        params['audio_prompt_path'] = audio_prompt_path
+    if voice_id:
+        params['voice_id'] = voice_id
+    return params
+
+async def save_upload(audio_prompt: UploadFile) -> str:
+    audio_prompt_path = str(UPLOAD_DIR / f"{uuid.uuid4()}.wav")
+    with open(audio_prompt_path, "wb") as f:
+        f.write(await audio_prompt.read())
+    return audio_prompt_path
+
+def enroll_voice(audio_prompt_path: str, name: Optional[str]):
+    """在推理线程中执行：注册音色"""
+    model = gpu_manager.get_model(load_func=load_model, model_name="ChatterboxTTS")
+    return voice_registry.enroll(model, audio_prompt_path, name=name)
+
+def check_voice_id(voice_id: Optional[str]):
+    if voice_id and not voice_registry.exists(voice_id):
+        raise HTTPException(status_code=404, detail=f"Unknown voice_id '{voice_id}'")
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request, exc: QueueFullError):
+    return JSONResponse(
+        status_code=503, content={"detail": str(exc), "queue": inference_worker.get_status()},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
 @app.get("/health")
 async def health():
-    return {"status": "healthy", "model_type": MODEL_TYPE}
+    return {"status": "healthy", "model_type": MODEL_TYPE, "queue": inference_worker.get_status()}
+
+@app.get("/queue/status")
+async def queue_status():
+    return inference_worker.get_status()
+
+@app.get("/batch/status")
+async def batch_status():
+    return micro_batcher.get_status()
+
+@app.get("/cache/status")
+async def cache_status():
+    model = gpu_manager.model or gpu_manager.model_on_cpu
+    if model is None or getattr(model, "conds_cache", None) is None:
+        return {"enabled": False}
+    prefix_cache = model.t3.prefix_cache
+    return {
+        "enabled": True, **model.conds_cache.stats(),
+        "prefix_kv": prefix_cache.stats() if prefix_cache is not None else {"enabled": False},
+    }
 
 @app.get("/gpu/status")
 async def gpu_status():
@@ -67,10 +258,37 @@ async def gpu_release():
     gpu_manager.force_release()
     return {"status": "released"}
 
+@app.post("/api/voices")
+async def create_voice(audio: UploadFile = File(...), name: Optional[str] = Form(None)):
+    audio_prompt_path = str(UPLOAD_DIR / f"{uuid.uuid4()}.wav")
+    try:
+        with open(audio_prompt_path, "wb") as f:
+            f.write(await audio.read())
+        return await inference_worker.run(enroll_voice, audio_prompt_path, name)
+    except QueueFullError:
+        raise
+    except Exception as e:
+        logger.exception("Voice enrollment error")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if os.path.exists(audio_prompt_path):
+            os.remove(audio_prompt_path)
+
+@app.get("/api/voices")
+async def list_voices():
+    return {"voices": voice_registry.list()}
+
+@app.delete("/api/voices/{voice_id}")
+async def delete_voice(voice_id: str):
+    if not voice_registry.delete(voice_id):
+        raise HTTPException(status_code=404, detail=f"Unknown voice_id '{voice_id}'")
+    return {"status": "deleted", "voice_id": voice_id}
+
 @app.post("/api/tts")
 async def tts(
     text: str = Form(...),
     audio_prompt: Optional[UploadFile] = File(None),
+    voice_id: Optional[str] = Form(None),
     temperature: float = Form(0.8),
     top_p: float = Form(0.95),
     top_k: int = Form(1000),
@@ -79,67 +297,87 @@ async def tts(
     cfg_weight: float = Form(0.0),
     language_id: str = Form("en"),
 ):
+    has_audio_prompt = bool(audio_prompt and audio_prompt.filename)
+    if voice_id and has_audio_prompt:
+        raise HTTPException(status_code=400, detail="Provide either audio_prompt or voice_id, not both")
+    check_voice_id(voice_id)
+    audio_prompt_path = None
     try:
-        audio_prompt_path = None
-        if audio_prompt and audio_prompt.filename:
-            audio_prompt_path = str(UPLOAD_DIR / f"{uuid.uuid4()}.wav")
-            with open(audio_prompt_path, "wb") as f:
-                f.write(await audio_prompt.read())
+        if has_audio_prompt:
+            audio_prompt_path = await save_upload(audio_prompt)
         
-        params = {'temperature': temperature, 'top_p': top_p, 'repetition_penalty': repetition_penalty}
-        if MODEL_TYPE == "turbo":
-            params['top_k'] = top_k
-        else:
-            params['exaggeration'] = exaggeration
-            params['cfg_weight'] = cfg_weight
-            params['min_p'] = 0.05
-        if MODEL_TYPE == "multilingual":
-            params['language_id'] = language_id
-        if audio_prompt_path:
-            params['audio_prompt_path'] = audio_prompt_path
-        
-        model = gpu_manager.get_model(load_func=load_model, model_name="ChatterboxTTS")
-        
-        gen_start = time.time()
-        wav = model.generate(text, **params)
-        gen_time = time.time() - gen_start
+        params = build_params(temperature, top_p, top_k, repetition_penalty, exaggeration, cfg_weight, language_id,
+                              audio_prompt_path=audio_prompt_path, voice_id=voice_id)
+        wav, sr, gen_time = await generate_audio(text, params)
         
         output_path = OUTPUT_DIR / f"{uuid.uuid4()}.wav"
-        ta.save(str(output_path), wav, model.sr)
-        
-        if audio_prompt_path and os.path.exists(audio_prompt_path):
-            os.remove(audio_prompt_path)
+        ta.save(str(output_path), wav, sr)
         
         return FileResponse(
             str(output_path), media_type="audio/wav", filename="output.wav",
-            headers={"X-Generation-Time": f"{gen_time:.2f}"}
+            headers={"X-Generation-Time": f"{gen_time:.2f}", "X-Queue-Depth": str(inference_worker.queue_depth)}
         )
+    except QueueFullError:
+        raise
     except Exception as e:
         logger.exception("TTS error")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if audio_prompt_path and os.path.exists(audio_prompt_path):
+            os.remove(audio_prompt_path)
 
 @app.post("/api/tts/stream")
-async def tts_stream(text: str = Form(...), temperature: float = Form(0.8)):
+async def tts_stream(
+    text: str = Form(...),
+    audio_prompt: Optional[UploadFile] = File(None),
+    voice_id: Optional[str] = Form(None),
+    temperature: float = Form(0.8),
+    top_p: float = Form(0.95),
+    top_k: int = Form(1000),
+    repetition_penalty: float = Form(1.2),
+    exaggeration: float = Form(0.0),
+    cfg_weight: float = Form(0.0),
+    language_id: str = Form("en"),
+    format: str = Form("wav"),
+):
+    """边生成边返回：每段音频合成完即发送（chunked），format=wav 带长度未知的 WAV 头，format=pcm 为裸 s16le"""
+    if format not in ("wav", "pcm"):
+        raise HTTPException(status_code=400, detail="format must be 'wav' or 'pcm'")
+    has_audio_prompt = bool(audio_prompt and audio_prompt.filename)
+    if voice_id and has_audio_prompt:
+        raise HTTPException(status_code=400, detail="Provide either audio_prompt or voice_id, not both")
+    check_voice_id(voice_id)
+    audio_prompt_path = await save_upload(audio_prompt) if has_audio_prompt else None
+    params = build_params(temperature, top_p, top_k, repetition_penalty, exaggeration, cfg_weight, language_id,
+                          audio_prompt_path=audio_prompt_path, voice_id=voice_id)
     try:
-        model = gpu_manager.get_model(load_func=load_model, model_name="ChatterboxTTS")
-        gen_start = time.time()
-        wav = model.generate(text, temperature=temperature)
-        gen_time = time.time() - gen_start
-        
-        buffer = io.BytesIO()
-        ta.save(buffer, wav, model.sr, format="wav")
-        buffer.seek(0)
-        
-        async def audio_generator():
-            while chunk := buffer.read(8192):
+        chunks = inference_worker.stream(synthesize_stream, text, params)
+    except QueueFullError:
+        if audio_prompt_path and os.path.exists(audio_prompt_path):
+            os.remove(audio_prompt_path)
+        raise
+
+    async def audio_generator():
+        try:
+            if format == "wav":
+                yield wav_stream_header(S3GEN_SR)
+            async for chunk in chunks:
                 yield chunk
-        
-        return StreamingResponse(
-            audio_generator(), media_type="audio/wav",
-            headers={"Content-Disposition": "attachment; filename=output.wav", "X-Generation-Time": f"{gen_time:.2f}"}
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        except Exception:
+            # 响应头已发出，只能记录错误并提前结束
+            logger.exception("TTS stream error")
+        finally:
+            await chunks.aclose()
+            if audio_prompt_path and os.path.exists(audio_prompt_path):
+                os.remove(audio_prompt_path)
+
+    media_type = "audio/wav" if format == "wav" else f"audio/L16; rate={S3GEN_SR}; channels=1"
+    # 水印逐段添加，与 /api/tts 整段音频的水印不同，短段检测不可靠
+    return StreamingResponse(
+        audio_generator(), media_type=media_type,
+        headers={"X-Sample-Rate": str(S3GEN_SR), "X-Queue-Depth": str(inference_worker.queue_depth),
+                 "X-Watermark": "per-chunk"}
+    )
 
 @app.websocket("/ws/tts")
 async def websocket_tts(websocket: WebSocket):
@@ -151,21 +389,27 @@ async def websocket_tts(websocket: WebSocket):
             if not text:
                 await websocket.send_json({"error": "text is required"})
                 continue
+            voice_id = data.get("voice_id")
+            if voice_id and not voice_registry.exists(voice_id):
+                await websocket.send_json({"status": "error", "error": f"Unknown voice_id '{voice_id}'"})
+                continue
             try:
-                model = gpu_manager.get_model(load_func=load_model, model_name="ChatterboxTTS")
-                gen_start = time.time()
-                wav = model.generate(text, temperature=data.get("temperature", 0.8))
-                gen_time = time.time() - gen_start
+                params = {'temperature': data.get("temperature", 0.8)}
+                if voice_id:
+                    params['voice_id'] = voice_id
+                wav, sr, gen_time = await generate_audio(text, params)
                 
                 import base64
                 buffer = io.BytesIO()
-                ta.save(buffer, wav, model.sr, format="wav")
+                ta.save(buffer, wav, sr, format="wav")
                 await websocket.send_json({
                     "status": "completed",
                     "audio": base64.b64encode(buffer.getvalue()).decode(),
-                    "sample_rate": model.sr,
+                    "sample_rate": sr,
                     "generation_time": round(gen_time, 2)
                 })
+            except QueueFullError as e:
+                await websocket.send_json({"status": "busy", "error": str(e), "retry_after": e.retry_after})
             except Exception as e:
                 await websocket.send_json({"status": "error", "error": str(e)})
     except WebSocketDisconnect:
@@ -0,0 +1,151 @@
+"""
+CFG schedule benchmark: how much T3 guidance can be skipped before quality drops.
+
+For every schedule (see `CFGSchedule.parse`), synthesizes the same texts with the same seeds and reports, against
+full CFG:
+    * speed: T3 time, and how many steps ran guided
+    * speaker similarity: cosine between the voice encoder embedding of the output and of the reference voice
+    * intelligibility proxies: the share of utterances that ended on a natural EOS (not forced by the alignment
+        analyzer, nor cut at the token limit), the duration relative to full CFG, and, with `--asr`, the word error
+        rate of a speech recognition model (any `transformers` ASR checkpoint, e.g. openai/whisper-small)
+
+    python example_cfg_schedule_benchmark.py --schedules full first=100 first=200 every=2 every=3
+    python example_cfg_schedule_benchmark.py --multilingual --language fr --schedules full window=0:0.5
+"""
+import argparse
+import time
+
+import librosa
+import numpy as np
+import torch
+
+from chatterbox.models.s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, drop_invalid_tokens
+from chatterbox.models.t3 import CFGSchedule
+
+TEXTS = [
+    "Ezreal and Jinx teamed up with Ahri, Yasuo, and Teemo to take down the enemy's Nexus in an epic late-game pentakill.",
+    "The quick brown fox jumps over the lazy dog, then naps in the afternoon sun.",
+    "Please hold while I transfer your call to the next available representative.",
+    "On the seventeenth of October, the museum will reopen its east wing with three new exhibitions.",
+]
+
+
+def word_error_rate(reference, hypothesis):
+    ref = "".join(c for c in reference.lower() if c.isalnum() or c.isspace()).split()
+    hyp = "".join(c for c in hypothesis.lower() if c.isalnum() or c.isspace()).split()
+    dist = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        prev, dist[0] = dist[0], i
+        for j, h in enumerate(hyp, 1):
+            prev, dist[j] = dist[j], min(dist[j] + 1, dist[j - 1] + 1, prev + (r != h))
+    return dist[-1] / max(len(ref), 1)
+
+
+def synthesize(model, text, schedule, args):
+    "One utterance → (wav at model.sr, T3 seconds, stop reason, guided steps, sampled tokens)."
+    conds = model._with_exaggeration(model.conds, args.exaggeration)
+    if args.multilingual:
+        text_tokens = model._text_to_tokens(text, args.language, args.cfg_weight)
+    else:
+        text_tokens = model._text_to_tokens(text, args.cfg_weight)
+
+    start = time.perf_counter()
+    chunks = list(model.t3.inference_stream(
+        t3_cond=conds.t3,
+        text_tokens=text_tokens,
+        max_new_tokens=1000,
+        temperature=args.temperature,
+        cfg_weight=args.cfg_weight,
+        cfg_schedule=schedule,
+        repetition_penalty=args.repetition_penalty,
+        chunk_size=1000,
+    ))
+    if model.device == "cuda":
+        torch.cuda.synchronize()
+    t3_seconds = time.perf_counter() - start
+
+    speech_tokens = drop_invalid_tokens(torch.cat([chunk.tokens for chunk in chunks], dim=1)[0])
+    speech_tokens = speech_tokens[speech_tokens < SPEECH_VOCAB_SIZE].to(model.device)
+    wav, _ = model.s3gen.inference(speech_tokens=speech_tokens, ref_dict=conds.gen)
+    return wav.squeeze(0).cpu().numpy(), t3_seconds, chunks[-1].stop_reason, chunks[-1].guided_steps, speech_tokens.numel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--schedules", nargs="+", default=["full", "first=100", "first=200", "every=2", "every=3"])
+    parser.add_argument("--multilingual", action="store_true")
+    parser.add_argument("--language", default="en")
+    parser.add_argument("--voice", default=None, help="reference audio (default: the built-in voice)")
+    parser.add_argument("--texts", default=None, help="file with one text per line")
+    parser.add_argument("--seeds", type=int, default=3)
+    parser.add_argument("--cfg-weight", type=float, default=0.5)
+    parser.add_argument("--exaggeration", type=float, default=0.5)
+    parser.add_argument("--temperature", type=float, default=0.8)
+    parser.add_argument("--repetition-penalty", type=float, default=None)
+    parser.add_argument("--asr", default=None, help="transformers ASR model id, for word error rates")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    if args.multilingual:
+        from chatterbox.mtl_tts import ChatterboxMultilingualTTS
+        model = ChatterboxMultilingualTTS.from_pretrained(device=args.device)
+        args.repetition_penalty = args.repetition_penalty or 2.0
+    else:
+        from chatterbox.tts import ChatterboxTTS
+        model = ChatterboxTTS.from_pretrained(device=args.device)
+        args.repetition_penalty = args.repetition_penalty or 1.2
+    if args.voice:
+        model.prepare_conditionals(args.voice, exaggeration=args.exaggeration)
+    texts = TEXTS
+    if args.texts:
+        with open(args.texts, encoding="utf-8") as f:
+            texts = [line.strip() for line in f if line.strip()]
+
+    asr = None
+    if args.asr:
+        from transformers import pipeline
+        asr = pipeline("automatic-speech-recognition", model=args.asr, device=args.device)
+
+    # the reference voice, as seen by the voice encoder
+    voice_embed = model.conds.t3.speaker_emb.view(-1).cpu().numpy()
+    voice_embed = voice_embed / np.linalg.norm(voice_embed)
+
+    results = {}
+    for spec in args.schedules:
+        schedule = CFGSchedule.parse(spec)
+        rows = []
+        for text in texts:
+            for seed in range(args.seeds):
+                torch.manual_seed(seed)
+                wav, t3_seconds, stop_reason, guided, n_tokens = synthesize(model, text, schedule, args)
+                wav_16k = librosa.resample(wav, orig_sr=model.sr, target_sr=S3_SR)
+                embed = model.ve.embeds_from_wavs([wav_16k], sample_rate=S3_SR)[0]
+                row = dict(
+                    t3_seconds=t3_seconds,
+                    guided=guided / max(n_tokens, 1),
+                    similarity=float(embed @ voice_embed / np.linalg.norm(embed)),
+                    natural_eos=stop_reason == "eos",
+                    duration=len(wav) / model.sr,
+                )
+                if asr is not None:
+                    row["wer"] = word_error_rate(text, asr({"raw": wav_16k, "sampling_rate": S3_SR})["text"])
+                rows.append(row)
+        results[spec] = rows
+        print(f"{spec}: done")
+
+    baseline = results.get("full") or next(iter(results.values()))
+    print()
+    header = f"{'schedule':<22}{'T3 s':>8}{'guided':>8}{'spk sim':>9}{'EOS':>6}{'dur/full':>10}"
+    print(header + (f"{'WER':>7}" if asr is not None else ""))
+    for spec, rows in results.items():
+        mean = lambda key: float(np.mean([row[key] for row in rows]))
+        duration_ratio = np.mean([row["duration"] / ref["duration"] for row, ref in zip(rows, baseline)])
+        line = (
+            f"{spec:<22}{mean('t3_seconds'):>8.2f}{mean('guided'):>8.0%}{mean('similarity'):>9.3f}"
+            f"{mean('natural_eos'):>6.0%}{duration_ratio:>10.2f}"
+        )
+        print(line + (f"{mean('wer'):>7.1%}" if asr is not None else ""))
+
+
+if __name__ == "__main__":
+    main()
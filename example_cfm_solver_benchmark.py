@@ -0,0 +1,119 @@
+"""
+CFM solver benchmark: mel quality vs number of estimator calls (NFE) for the S3Gen ODE solvers and timestep schedules.
+
+Speech tokens are generated once per text with T3; then, for every configuration, the flow decodes them from the same
+noise. The error is measured against a high-accuracy reference solve (many midpoint steps), next to the current
+default (10 Euler steps, cosine schedule); configurations at or below the default's error with at most `--max-nfe`
+estimator calls are marked with *.
+
+    python example_cfm_solver_benchmark.py
+    python example_cfm_solver_benchmark.py --solvers euler multistep heun --steps 2 3 4 5 6 --schedules cosine linear
+"""
+import argparse
+import itertools
+import time
+
+import numpy as np
+import torch
+
+from chatterbox.models.s3gen.ode_solvers import ODE_SOLVERS, T_SCHEDULES
+from chatterbox.models.s3tokenizer import SPEECH_VOCAB_SIZE, drop_invalid_tokens
+from chatterbox.tts import ChatterboxTTS
+
+TEXTS = [
+    "Ezreal and Jinx teamed up with Ahri, Yasuo, and Teemo to take down the enemy's Nexus in an epic late-game pentakill.",
+    "The quick brown fox jumps over the lazy dog, then naps in the afternoon sun.",
+    "Please hold while I transfer your call to the next available representative.",
+]
+
+
+class NFECounter:
+    "Counts estimator calls, by wrapping `forward_prepared` (used by every solver step)."
+
+    def __init__(self, estimator):
+        self.count = 0
+        self._forward_prepared = estimator.forward_prepared
+
+        def forward_prepared(*args, **kwargs):
+            self.count += 1
+            return self._forward_prepared(*args, **kwargs)
+
+        estimator.forward_prepared = forward_prepared
+
+
+def decode(model, speech_tokens, seed, **kwargs):
+    "Mels of `speech_tokens`, from the same noise for the same seed, and the seconds it took."
+    torch.manual_seed(seed)
+    start = time.perf_counter()
+    mels = model.s3gen.flow_inference(speech_tokens, ref_dict=model.conds.gen, finalize=True, **kwargs)
+    if model.device == "cuda":
+        torch.cuda.synchronize()
+    return mels.float(), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--solvers", nargs="+", default=list(ODE_SOLVERS), choices=list(ODE_SOLVERS))
+    parser.add_argument("--schedules", nargs="+", default=["cosine"], choices=list(T_SCHEDULES))
+    parser.add_argument("--steps", nargs="+", type=int, default=[2, 3, 4, 5, 6, 10])
+    parser.add_argument("--reference-steps", type=int, default=64, help="midpoint steps of the reference solve")
+    parser.add_argument("--max-nfe", type=int, default=6)
+    parser.add_argument("--voice", default=None, help="reference audio (default: the built-in voice)")
+    parser.add_argument("--seeds", type=int, default=2)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    model = ChatterboxTTS.from_pretrained(device=args.device)
+    if args.voice:
+        model.prepare_conditionals(args.voice)
+    counter = NFECounter(model.s3gen.flow.decoder.estimator)
+
+    utterances = []
+    for i, text in enumerate(TEXTS):
+        torch.manual_seed(i)
+        with torch.inference_mode():
+            speech_tokens = model.t3.inference(
+                t3_cond=model.conds.t3,
+                text_tokens=model._text_to_tokens(text, cfg_weight=0.5),
+                max_new_tokens=1000,
+                cfg_weight=0.5,
+                temperature=0.8,
+            )[0]
+        speech_tokens = drop_invalid_tokens(speech_tokens)
+        utterances.append(speech_tokens[speech_tokens < SPEECH_VOCAB_SIZE].to(model.device))
+
+    def run(**kwargs):
+        "Mels of every utterance and seed, mean NFE per utterance and mean seconds."
+        counter.count, seconds, mels = 0, 0.0, []
+        for speech_tokens, seed in itertools.product(utterances, range(args.seeds)):
+            mel, elapsed = decode(model, speech_tokens, seed, **kwargs)
+            mels.append(mel)
+            seconds += elapsed
+        return mels, counter.count / len(mels), seconds / len(mels)
+
+    reference, _, _ = run(cfm_solver="midpoint", n_cfm_timesteps=args.reference_steps)
+
+    def errors(mels):
+        l1 = np.mean([(mel - ref).abs().mean().item() for mel, ref in zip(mels, reference)])
+        rmse = np.mean([(mel - ref).pow(2).mean().sqrt().item() for mel, ref in zip(mels, reference)])
+        return l1, rmse
+
+    baseline_mels, baseline_nfe, baseline_seconds = run(cfm_solver="euler", n_cfm_timesteps=10)
+    baseline_l1, baseline_rmse = errors(baseline_mels)
+
+    rows = []
+    for solver, schedule, steps in itertools.product(args.solvers, args.schedules, args.steps):
+        mels, nfe, seconds = run(cfm_solver=solver, cfm_schedule=schedule, n_cfm_timesteps=steps)
+        rows.append((f"{solver}/{schedule}/{steps}", nfe, seconds, *errors(mels)))
+        print(f"{rows[-1][0]}: done")
+
+    print(f"\nreference: midpoint, {args.reference_steps} steps; default: euler/cosine/10 "
+          f"({baseline_nfe:.0f} NFE, {baseline_seconds:.2f}s, mel L1 {baseline_l1:.4f}, RMSE {baseline_rmse:.4f})")
+    print(f"{'solver/schedule/steps':<28}{'NFE':>5}{'sec':>8}{'mel L1':>9}{'RMSE':>9}{'L1/default':>12}")
+    for name, nfe, seconds, l1, rmse in sorted(rows, key=lambda row: (row[1], row[3])):
+        mark = " *" if nfe <= args.max_nfe and l1 <= baseline_l1 else ""
+        print(f"{name:<28}{nfe:>5.0f}{seconds:>8.2f}{l1:>9.4f}{rmse:>9.4f}{l1 / baseline_l1:>12.2f}{mark}")
+
+
+if __name__ == "__main__":
+    main()
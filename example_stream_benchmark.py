@@ -0,0 +1,82 @@
+"""
+Streaming S3Gen benchmark: seconds per chunk along a long utterance, for `S3GenStreamer` with the flow re-running on
+everything received so far (the default, `context_tokens=None`) and with a bounded left context (`context_tokens`).
+
+Speech tokens are generated once with T3, repeated up to `--tokens`, then pushed to each streamer `--hop` tokens at a
+time. With a bounded context the time per chunk stays flat; re-running on the whole prefix grows with the position.
+
+    python example_stream_benchmark.py
+    python example_stream_benchmark.py --tokens 1500 --hop 25 --context 25 50 100
+"""
+import argparse
+import time
+
+import torch
+
+from chatterbox.models.s3gen import S3GenStreamer
+from chatterbox.models.s3tokenizer import SPEECH_VOCAB_SIZE, drop_invalid_tokens
+from chatterbox.tts import ChatterboxTTS
+
+TEXT = (
+    "Ezreal and Jinx teamed up with Ahri, Yasuo, and Teemo to take down the enemy's Nexus in an epic late-game "
+    "pentakill, and then they did it all over again in the next match."
+)
+
+
+def sync(device):
+    if device == "cuda":
+        torch.cuda.synchronize()
+
+
+def stream(model, speech_tokens, hop, context_tokens):
+    "Seconds taken by each chunk of audio (the `push` calls that returned audio, then `flush`)."
+    streamer = S3GenStreamer(model.s3gen, model.conds.gen, token_hop_len=hop, context_tokens=context_tokens)
+    seconds = []
+    for i in range(0, speech_tokens.size(1), hop):
+        start = time.perf_counter()
+        wav = streamer.push(speech_tokens[:, i:i + hop])
+        sync(model.device)
+        if wav.numel():
+            seconds.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    streamer.flush()
+    sync(model.device)
+    seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=1000, help="utterance length in speech tokens (25 per second)")
+    parser.add_argument("--hop", type=int, default=25)
+    parser.add_argument("--context", nargs="+", type=int, default=[50], help="`context_tokens` values to compare")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    model = ChatterboxTTS.from_pretrained(device=args.device)
+    with torch.inference_mode():
+        speech_tokens = model.t3.inference(
+            t3_cond=model.conds.t3,
+            text_tokens=model._text_to_tokens(TEXT, cfg_weight=0.5),
+            max_new_tokens=1000,
+            cfg_weight=0.5,
+        )[0]
+    speech_tokens = drop_invalid_tokens(speech_tokens)
+    speech_tokens = speech_tokens[speech_tokens < SPEECH_VOCAB_SIZE]
+    speech_tokens = speech_tokens.repeat(args.tokens // len(speech_tokens) + 1)[:args.tokens].view(1, -1)
+    speech_tokens = speech_tokens.to(model.device)
+
+    stream(model, speech_tokens[:, :4 * args.hop], args.hop, args.context[0])  # warm-up
+    results = {f"context={n}": stream(model, speech_tokens, args.hop, n) for n in args.context}
+    results["full prefix"] = stream(model, speech_tokens, args.hop, None)
+
+    n_chunks = min(len(seconds) for seconds in results.values())
+    marks = sorted({0, n_chunks // 4, n_chunks // 2, 3 * n_chunks // 4, n_chunks - 2})
+    print(f"\nseconds per chunk of {args.hop} tokens, at chunk:")
+    print(f"{'streamer':<16}" + "".join(f"{mark:>8}" for mark in marks) + f"{'total':>10}")
+    for name, seconds in results.items():
+        print(f"{name:<16}" + "".join(f"{seconds[mark]:>8.3f}" for mark in marks) + f"{sum(seconds):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
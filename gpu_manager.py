@@ -61,7 +61,7 @@ class GPUResourceManager:
         """移动模型到指定设备"""
         if hasattr(model, 'to'):
             return model.to(device)
-        for attr in ['t3', 's3gen', 've', 'conds']:
+        for attr in ['t3', 's3gen', 've', 'conds', 'conds_cache']:
             if hasattr(model, attr) and getattr(model, attr) is not None:
                 setattr(model, attr, getattr(model, attr).to(device))
         model.device = device
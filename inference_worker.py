@@ -0,0 +1,135 @@
+"""Inference Worker - 单线程推理队列 + 背压"""
+import asyncio
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """推理队列已满"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Inference queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class InferenceWorker:
+    """推理工作线程 - 所有模型调用在专用线程中串行执行，事件循环只负责 await 结果"""
+
+    def __init__(self, max_queue_size: int = 8, default_retry_after: int = 5):
+        self.max_queue_size = max_queue_size
+        self.default_retry_after = default_retry_after
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._busy = False
+        self._avg_job_time = None
+        self._completed = 0
+        self._rejected = 0
+
+    def start(self):
+        """启动工作线程（幂等）"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="inference-worker", daemon=True)
+            self._thread.start()
+            logger.info(f"Inference worker started, max_queue_size={self.max_queue_size}")
+
+    def _run(self):
+        while True:
+            future, fn, args, kwargs = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                self._queue.task_done()
+                continue
+            self._busy = True
+            start = time.time()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                elapsed = time.time() - start
+                with self._lock:
+                    self._busy = False
+                    self._completed += 1
+                    # EMA of job duration, used to estimate Retry-After
+                    if self._avg_job_time is None:
+                        self._avg_job_time = elapsed
+                    else:
+                        self._avg_job_time = 0.8 * self._avg_job_time + 0.2 * elapsed
+                self._queue.task_done()
+
+    def retry_after(self) -> int:
+        """按当前队列深度和平均耗时估算 Retry-After 秒数"""
+        with self._lock:
+            if self._avg_job_time is None:
+                return self.default_retry_after
+            pending = self._queue.qsize() + int(self._busy)
+            return max(1, int(round(pending * self._avg_job_time)))
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """提交任务，队列满时抛出 QueueFullError"""
+        self.start()
+        future = Future()
+        try:
+            self._queue.put_nowait((future, fn, args, kwargs))
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            raise QueueFullError(self.retry_after())
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        """在工作线程中执行 fn，并在当前事件循环中等待结果"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def stream(self, fn, *args, **kwargs):
+        """
+        在工作线程中迭代生成器 fn，返回异步迭代器，每产出一项就交给事件循环。
+        入队在调用时立即发生（队列满时直接抛出 QueueFullError）；消费方提前关闭时，生成器在下一项后停止。
+        """
+        loop = asyncio.get_running_loop()
+        items = asyncio.Queue()
+        stopped = threading.Event()
+        done = object()
+
+        def produce():
+            try:
+                for item in fn(*args, **kwargs):
+                    if stopped.is_set():
+                        break
+                    loop.call_soon_threadsafe(items.put_nowait, item)
+            finally:
+                loop.call_soon_threadsafe(items.put_nowait, done)
+
+        future = self.submit(produce)
+
+        async def consume():
+            try:
+                while (item := await items.get()) is not done:
+                    yield item
+                await asyncio.wrap_future(future)  # re-raise errors from the generator
+            finally:
+                stopped.set()
+
+        return consume()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_queue_size": self.max_queue_size,
+                "busy": self._busy,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "avg_job_time": round(self._avg_job_time, 3) if self._avg_job_time is not None else None,
+            }
@@ -13,6 +13,7 @@ import torch
 import torchaudio as ta
 
 from gpu_manager import gpu_manager
+from voice_registry import VoiceRegistry
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -22,6 +23,9 @@ mcp = FastMCP("chatterbox-tts")
 MODEL_TYPE = os.getenv("MODEL_TYPE", "turbo")
 OUTPUT_DIR = Path(tempfile.gettempdir()) / "chatterbox_mcp"
 OUTPUT_DIR.mkdir(exist_ok=True)
+# 与 API 服务共享同一音色目录
+VOICE_DIR = Path(os.getenv("VOICE_DIR", Path(tempfile.gettempdir()) / "chatterbox_voices"))
+voice_registry = VoiceRegistry(VOICE_DIR, model_type=MODEL_TYPE)
 
 def load_model():
     """加载 TTS 模型"""
@@ -46,6 +50,7 @@ def tts_generate(
     text: str,
     output_path: str = None,
     audio_prompt_path: str = None,
+    voice_id: str = None,
     temperature: float = 0.8,
     top_p: float = 0.95,
     top_k: int = 1000,
@@ -61,6 +66,7 @@ def tts_generate(
         text: 要合成的文本，支持 [laugh] [chuckle] [cough] 等标签
         output_path: 输出音频路径，不指定则自动生成
         audio_prompt_path: 参考音频路径（用于声音克隆）
+        voice_id: 已注册音色 ID（见 voice_enroll），优先于 audio_prompt_path
         temperature: 采样温度 (0.1-2.0)
         top_p: Top-P 采样 (0-1)
         top_k: Top-K 采样 (0-1000)
@@ -75,6 +81,8 @@ def tts_generate(
     try:
         if not text:
             return {"status": "error", "error": "text is required"}
+        if voice_id and not voice_registry.exists(voice_id):
+            return {"status": "error", "error": f"Unknown voice_id '{voice_id}'"}
         
         # 构建参数
         params = {
@@ -93,11 +101,13 @@ def tts_generate(
         if MODEL_TYPE == "multilingual":
             params['language_id'] = language_id
         
-        if audio_prompt_path:
-            params['audio_prompt_path'] = audio_prompt_path
-        
         # 生成
         model = gpu_manager.get_model(load_func=load_model, model_name="ChatterboxTTS")
+        if voice_id:
+            params['conds'] = voice_registry.get(voice_id, device=model.device)
+        elif audio_prompt_path:
+            # 仅用于本次请求，不覆盖模型默认音色
+            params['conds'] = model.get_conditionals(audio_prompt_path)
         wav = model.generate(text, **params)
         gpu_manager.force_offload()
         
@@ -120,6 +130,35 @@ def tts_generate(
         logger.exception("TTS generation error")
         return {"status": "error", "error": str(e)}
 
+@mcp.tool()
+def voice_enroll(audio_prompt_path: str, name: str = None) -> dict:
+    """
+    注册参考音频为音色，之后 tts_generate 可通过 voice_id 直接使用，无需重复提取音色特征
+    
+    Args:
+        audio_prompt_path: 参考音频路径
+        name: 音色名称（可选）
+    
+    Returns:
+        包含 voice_id 的音色信息
+    """
+    try:
+        model = gpu_manager.get_model(load_func=load_model, model_name="ChatterboxTTS")
+        return {"status": "success", **voice_registry.enroll(model, audio_prompt_path, name=name)}
+    except Exception as e:
+        logger.exception("Voice enrollment error")
+        return {"status": "error", "error": str(e)}
+
+@mcp.tool()
+def list_voices() -> dict:
+    """
+    获取已注册的音色列表
+    
+    Returns:
+        音色列表
+    """
+    return {"voices": voice_registry.list()}
+
 @mcp.tool()
 def get_gpu_status() -> dict:
     """
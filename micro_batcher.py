@@ -0,0 +1,81 @@
+"""Micro Batcher - 把短时间窗口内到达的请求合并成一批推理"""
+import asyncio
+import threading
+from collections import Counter
+from typing import Any, Awaitable, Callable, Hashable, List
+
+
+class MicroBatcher:
+    """
+    动态微批：同一 key（参数兼容）的请求在 window_ms 内攒批，凑满 max_batch_size 立即发出；
+    run_batch 收到一批 item，返回等长的结果列表（单项可以是 Exception，只让对应请求失败）。
+    window_ms 越大批越满、吞吐越高，但每个请求最多多等一个窗口（p50 延迟上升）。
+    """
+
+    def __init__(self, run_batch: Callable[[List[Any]], Awaitable[List[Any]]], window_ms: float = 10,
+                 max_batch_size: int = 4):
+        self.run_batch = run_batch
+        self.window = window_ms / 1000
+        self.window_ms = window_ms
+        self.max_batch_size = max_batch_size
+        self._pending = {}  # key -> [(item, future)]
+        self._timers = {}  # key -> asyncio.TimerHandle
+        self._lock = threading.Lock()
+        self._histogram = Counter()  # 批大小 -> 批数
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_batch_size > 1
+
+    async def submit(self, item, key: Hashable = None):
+        """加入 key 对应的待发批次，等待这一项的结果"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        group = self._pending.setdefault(key, [])
+        group.append((item, future))
+        if len(group) >= self.max_batch_size:
+            self._flush(key)
+        elif len(group) == 1:
+            self._timers[key] = loop.call_later(self.window, self._flush, key)
+        return await future
+
+    def _flush(self, key):
+        group = self._pending.pop(key, None)
+        if timer := self._timers.pop(key, None):
+            timer.cancel()
+        if not group:
+            return
+        with self._lock:
+            self._histogram[len(group)] += 1
+        asyncio.ensure_future(self._dispatch(group))
+
+    async def _dispatch(self, group):
+        try:
+            results = await self.run_batch([item for item, _ in group])
+        except BaseException as e:
+            # 整批失败（如队列已满）：每个请求收到同一个异常
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(group, results):
+            if future.done():  # 请求方已取消
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def get_status(self) -> dict:
+        with self._lock:
+            n_batches = sum(self._histogram.values())
+            n_requests = sum(size * count for size, count in self._histogram.items())
+            return {
+                "enabled": self.enabled,
+                "window_ms": self.window_ms,
+                "max_batch_size": self.max_batch_size,
+                "batches": n_batches,
+                "requests": n_requests,
+                "mean_batch_size": round(n_requests / n_batches, 2) if n_batches else None,
+                "batch_size_histogram": {str(size): self._histogram[size] for size in sorted(self._histogram)},
+            }
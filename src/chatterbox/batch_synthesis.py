@@ -0,0 +1,36 @@
+"""
+Shared steps of the `generate_batch` methods: T3 decoding of several utterances in one `T3BatchScheduler` batch, then
+S3Gen vocoding of all of them as one padded batch.
+"""
+from typing import List, Optional
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from .models.t3 import T3BatchScheduler
+
+
+def decode_batch(t3, sequences: List[dict], scheduler: Optional[T3BatchScheduler] = None) -> List[torch.Tensor]:
+    """
+    Speech tokens, (1, N), of each sequence (the keyword arguments of `T3BatchScheduler.add`), decoded together.
+    Without a `scheduler`, a new one with a KV row for every row of the sequences is used.
+    """
+    if scheduler is None:
+        scheduler = T3BatchScheduler(t3, max_rows=sum(seq["text_tokens"].size(0) for seq in sequences))
+    decoded = [scheduler.add(**seq) for seq in sequences]
+    tokens = {id(seq): [] for seq in decoded}
+    for seq, chunk in scheduler.run():
+        if id(seq) in tokens:
+            tokens[id(seq)].append(chunk.tokens)
+    for seq in decoded:
+        if seq.error is not None:
+            raise seq.error
+    return [torch.cat(tokens[id(seq)], dim=1) for seq in decoded]
+
+
+def vocode_batch(s3gen, speech_tokens: List[torch.Tensor], ref_dicts: List[dict], **kwargs) -> List[torch.Tensor]:
+    "Waveforms, (1, N_i), of 1D speech token sequences with their references, through one batched S3Gen call."
+    lens = torch.tensor([len(tokens) for tokens in speech_tokens], device=s3gen.device)
+    padded = pad_sequence(speech_tokens, batch_first=True).to(s3gen.device)
+    wavs, _ = s3gen.inference(speech_tokens=padded, speech_token_lens=lens, ref_dict=ref_dicts, **kwargs)
+    return wavs
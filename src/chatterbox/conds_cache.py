@@ -0,0 +1,218 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Optional
+
+import torch
+
+from .models.t3.modules.cond_enc import T3Cond
+
+if TYPE_CHECKING:
+    from .tts import Conditionals
+
+
+def conds_cache_key(wav_fpath, model_type: str, **params) -> Optional[str]:
+    """
+    Content-addressed key for a reference clip: hash of the audio bytes plus everything that changes the
+    resulting conditionals (model type, exaggeration, loudness normalisation, ...).
+    Returns None for inputs that can't be hashed cheaply (e.g. file-like objects).
+    """
+    if not isinstance(wav_fpath, (str, os.PathLike)):
+        return None
+    h = hashlib.sha256()
+    with open(wav_fpath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    h.update(model_type.encode())
+    for k in sorted(params):
+        h.update(f"|{k}={float(params[k]):.6g}".encode())
+    return h.hexdigest()
+
+
+def _conds_nbytes(conds) -> int:
+    tensors = [v for v in conds.t3.__dict__.values() if torch.is_tensor(v)]
+    tensors += [v for v in conds.gen.values() if torch.is_tensor(v)]
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def _conds_device(conds) -> torch.device:
+    return conds.t3.speaker_emb.device
+
+
+def _copy_to(conds, device):
+    "Copy of `conds` on `device`; the original is left untouched since it may be in use by other requests."
+    if _conds_device(conds).type == torch.device(device).type:
+        return conds
+    t3 = T3Cond(**conds.t3.__dict__).to(device=device)
+    gen = {k: v.to(device=device) if torch.is_tensor(v) else v for k, v in conds.gen.items()}
+    return type(conds)(t3, gen)
+
+
+class ConditionalsCache:
+    """
+    Tiered LRU cache for `Conditionals`, keyed by `conds_cache_key`:
+        * device tier: ready-to-use tensors on the model device (hot)
+        * cpu tier: host copies, promoted back to the device on hit (warm)
+        * disk tier: persisted with `Conditionals.save`, only if `disk_dir` is set (cold)
+    Each tier is bounded by a byte budget; the least recently used entries are demoted to the next tier and
+    dropped from the last one. Cached objects are shared, callers must not modify them in place.
+    """
+
+    def __init__(
+        self,
+        device_budget: int = 64 * 2**20,
+        cpu_budget: int = 512 * 2**20,
+        disk_dir: Optional[Path] = None,
+        disk_budget: int = 4 * 2**30,
+    ):
+        self.device_budget = device_budget
+        self.cpu_budget = cpu_budget
+        self.disk_budget = disk_budget
+        self.disk_dir = None if disk_dir is None else Path(disk_dir)
+
+        self.lock = threading.RLock()
+        self._device = OrderedDict()  # key -> Conditionals
+        self._cpu = OrderedDict()  # key -> Conditionals
+        self._disk = OrderedDict()  # key -> file size
+        self._nbytes = {}  # key -> size of the in-memory entry
+        self._builds = {}  # key -> [lock held while its conditionals are looked up / built, number of callers]
+        self.counters = dict(
+            device_hits=0, cpu_hits=0, disk_hits=0, misses=0,
+            device_evictions=0, cpu_evictions=0, disk_evictions=0,
+        )
+
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            for fpath in sorted(self.disk_dir.glob("*.pt"), key=lambda p: p.stat().st_mtime):
+                self._disk[fpath.stem] = fpath.stat().st_size
+
+    def _disk_path(self, key):
+        return self.disk_dir / f"{key}.pt"
+
+    def _tier_bytes(self, tier):
+        return sum(self._nbytes[k] for k in tier)
+
+    def get(self, key: str, device, conds_cls) -> Optional["Conditionals"]:
+        with self.lock:
+            if key in self._device:
+                self._device.move_to_end(key)
+                conds = self._device[key]
+                self.counters["device_hits"] += 1
+                if _conds_device(conds).type != torch.device(device).type:
+                    conds = self._device[key] = _copy_to(conds, device)
+                # the T3 prompt embedding is cached on the object after first use, so re-measure
+                self._nbytes[key] = _conds_nbytes(conds)
+                self._evict()
+                return conds
+
+            if key in self._cpu:
+                conds = self._cpu.pop(key)
+                self.counters["cpu_hits"] += 1
+            elif key in self._disk:
+                fpath = self._disk_path(key)
+                self._disk.pop(key)
+                if not fpath.exists():
+                    self.counters["misses"] += 1
+                    return None
+                conds = conds_cls.load(fpath, map_location="cpu")
+                fpath.unlink()
+                self.counters["disk_hits"] += 1
+            else:
+                self.counters["misses"] += 1
+                return None
+
+            return self._put_device(key, _copy_to(conds, device))
+
+    def put(self, key: str, conds):
+        with self.lock:
+            self._cpu.pop(key, None)
+            self._device.pop(key, None)
+            if key in self._disk:
+                self._disk.pop(key)
+                self._disk_path(key).unlink(missing_ok=True)
+            return self._put_device(key, conds)
+
+    def get_or_create(self, key: Optional[str], device, conds_cls, create_fn: Callable[[], "Conditionals"]):
+        """
+        Cached conditionals for `key`, built with `create_fn` on a miss. Concurrent callers for the same key wait for
+        a single build instead of each running `create_fn`.
+        """
+        if key is None:
+            return create_fn()
+        with self.lock:
+            build = self._builds.setdefault(key, [threading.Lock(), 0])
+            build[1] += 1
+        try:
+            with build[0]:
+                conds = self.get(key, device, conds_cls)
+                if conds is None:
+                    conds = self.put(key, create_fn())
+                return conds
+        finally:
+            with self.lock:
+                build[1] -= 1
+                if build[1] == 0:
+                    del self._builds[key]
+
+    def _put_device(self, key, conds):
+        self._device[key] = conds
+        self._nbytes[key] = _conds_nbytes(conds)
+        self._evict()
+        return conds
+
+    def _evict(self):
+        # device -> cpu
+        while len(self._device) > 1 and self._tier_bytes(self._device) > self.device_budget:
+            key, conds = self._device.popitem(last=False)
+            self._cpu[key] = _copy_to(conds, "cpu")
+            self.counters["device_evictions"] += 1
+
+        # cpu -> disk (or dropped)
+        while self._cpu and self._tier_bytes(self._cpu) > self.cpu_budget:
+            key, conds = self._cpu.popitem(last=False)
+            self._nbytes.pop(key)
+            self.counters["cpu_evictions"] += 1
+            if self.disk_dir is not None:
+                fpath = self._disk_path(key)
+                conds.save(fpath)
+                self._disk[key] = fpath.stat().st_size
+
+        # disk -> dropped
+        while self._disk and sum(self._disk.values()) > self.disk_budget:
+            key, _ = self._disk.popitem(last=False)
+            self._disk_path(key).unlink(missing_ok=True)
+            self.counters["disk_evictions"] += 1
+
+    def to(self, device):
+        "Follow the model: when it is moved off the accelerator, demote the device tier to host memory."
+        with self.lock:
+            if torch.device(device).type == "cpu":
+                for key, conds in self._device.items():
+                    self._device[key] = _copy_to(conds, "cpu")
+        return self
+
+    def clear(self):
+        with self.lock:
+            self._device.clear()
+            self._cpu.clear()
+            self._nbytes.clear()
+            for key in self._disk:
+                self._disk_path(key).unlink(missing_ok=True)
+            self._disk.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(
+                self.counters,
+                device_entries=len(self._device),
+                device_bytes=self._tier_bytes(self._device),
+                device_budget=self.device_budget,
+                cpu_entries=len(self._cpu),
+                cpu_bytes=self._tier_bytes(self._cpu),
+                cpu_budget=self.cpu_budget,
+                disk_entries=len(self._disk),
+                disk_bytes=sum(self._disk.values()),
+                disk_budget=self.disk_budget if self.disk_dir is not None else 0,
+            )
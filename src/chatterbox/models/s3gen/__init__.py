@@ -1,2 +1,2 @@
-from .s3gen import S3Token2Wav as S3Gen
+from .s3gen import S3Token2Wav as S3Gen, S3GenStreamer
 from .const import S3GEN_SR
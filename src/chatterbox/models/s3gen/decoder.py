@@ -11,6 +11,9 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from dataclasses import dataclass
+from typing import List, Optional
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -35,6 +38,60 @@ def mask_to_bias(mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
 
 
 
+class KeyPaddingAttnProcessor:
+    """
+    Self-attention of the `BasicTransformerBlock`s in `ConditionalDecoder`, replacing diffusers' `AttnProcessor2_0`.
+    The attention bias, a (B, 1, T) key padding bias (or (B, T, T) with chunk masks, or None), is broadcast over the
+    heads instead of being repeated per head, and goes straight to `F.scaled_dot_product_attention`. On devices
+    with fused kernels (`fused_devices`), memory then stays linear in T. Elsewhere (e.g. MPS), SDPA materializes
+    every T×T score map, so the queries are processed `chunk_size` at a time.
+    """
+
+    fused_devices = ("cuda", "cpu")
+
+    def __init__(self, chunk_size: int = 512):
+        self.chunk_size = chunk_size
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None, **kwargs):
+        B, T, _ = hidden_states.shape
+        context = hidden_states if encoder_hidden_states is None else encoder_hidden_states
+        query, key, value = attn.to_q(hidden_states), attn.to_k(context), attn.to_v(context)
+        head_dim = key.shape[-1] // attn.heads
+        query, key, value = (x.view(B, -1, attn.heads, head_dim).transpose(1, 2) for x in (query, key, value))
+        if attention_mask is not None:
+            attention_mask = attention_mask.unsqueeze(1)  # (B, 1, 1 or T, T)
+
+        if query.device.type in self.fused_devices or T <= self.chunk_size:
+            out = F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask)
+        else:
+            out = []
+            for start in range(0, T, self.chunk_size):
+                mask = attention_mask
+                if mask is not None and mask.size(2) > 1:
+                    mask = mask[:, :, start:start + self.chunk_size]
+                out.append(F.scaled_dot_product_attention(
+                    query[:, :, start:start + self.chunk_size], key, value, attn_mask=mask,
+                ))
+            out = torch.cat(out, dim=2)
+
+        out = out.transpose(1, 2).reshape(B, -1, attn.heads * head_dim).to(query.dtype)
+        out = attn.to_out[0](out)  # linear proj
+        return attn.to_out[1](out)  # dropout
+
+
+@dataclass
+class DecoderContext:
+    """
+    The inputs of `ConditionalDecoder.forward` that stay the same across the steps of an ODE solve, see
+    `ConditionalDecoder.prepare`.
+    """
+    mask: torch.Tensor  # (B, 1, T)
+    static: torch.Tensor  # (B, C, T): mu, spks and cond, packed after x
+    masks: List[torch.Tensor]  # (B, 1, T_i) padding mask of every resolution, highest first
+    attn_biases: List[Optional[torch.Tensor]]  # the matching attention biases; None without padding
+    time_embeds: Optional[torch.Tensor] = None  # (n_steps, time_embed_dim), one per solver step
+
+
 class Transpose(torch.nn.Module):
     def __init__(self, dim0: int, dim1: int):
         super().__init__()
@@ -221,6 +278,10 @@ class ConditionalDecoder(nn.Module):
         if self.meanflow:
             self.time_embed_mixer = get_intmeanflow_time_mixer(time_embed_dim)
 
+        for module in self.modules():
+            if isinstance(module, BasicTransformerBlock):
+                module.attn1.set_processor(KeyPaddingAttnProcessor())
+
 
     @property
     def dtype(self):
@@ -258,6 +319,11 @@ class ConditionalDecoder(nn.Module):
         Returns:
             _type_: _description_
         """
+        context = self.prepare(mask, mu, spks=spks, cond=cond)
+        return self.forward_prepared(x, context, self.embed_time(t, r))
+
+    def embed_time(self, t, r=None):
+        "Time embeddings, (N, time_embed_dim), of N timesteps `t` (and meanflow end times `r`)."
         t = self.time_embeddings(t).to(t.dtype)
         t = self.time_mlp(t)
 
@@ -266,24 +332,59 @@ class ConditionalDecoder(nn.Module):
             r = self.time_mlp(r)
             concat_embed = torch.cat([t, r], dim=1)
             t = self.time_embed_mixer(concat_embed)
+        return t
 
-        x = pack([x, mu], "b * t")[0]
-
+    def prepare(self, mask, mu, spks=None, cond=None, t_span=None) -> "DecoderContext":
+        """
+        Everything `forward` computes that doesn't depend on `x` or the timestep, for an ODE solver to compute once
+        and reuse on every step with `forward_prepared`: the conditioning channels (`mu`, `spks`, `cond`) packed as
+        they follow `x`, the masks and attention biases of every resolution and, given the solver's `t_span`, the
+        time embeddings of all its steps (step i goes from t_span[i] to t_span[i + 1]).
+        """
+        static = mu
         if spks is not None:
-            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
-            x = pack([x, spks], "b * t")[0]
+            spks = repeat(spks, "b c -> b c t", t=mu.shape[-1])
+            static = pack([static, spks], "b * t")[0]
         if cond is not None:
-            x = pack([x, cond], "b * t")[0]
+            static = pack([static, cond], "b * t")[0]
 
-        hiddens = []
+        # the down blocks halve the resolution, except the last one; the mid and up blocks reuse these masks
         masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
+        for _ in self.down_blocks[:-1]:
+            masks.append(masks[-1][:, :, ::2])
+        if self.static_chunk_size == 0 and bool(mask.all()):
+            # nothing to mask: without a bias, attention can use its fastest kernels
+            attn_biases = [None] * len(masks)
+        else:
+            attn_biases = []
+            for mask_i in masks:
+                attn_mask = add_optional_chunk_mask(
+                    mask_i.transpose(1, 2), mask_i.bool(), False, False, 0, self.static_chunk_size, -1,
+                )
+                attn_biases.append(mask_to_bias(attn_mask == 1, self.dtype))
+
+        time_embeds = None
+        if t_span is not None:
+            time_embeds = self.embed_time(t_span[:-1], t_span[1:] if self.meanflow else None)
+        return DecoderContext(mask=mask, static=static, masks=masks, attn_biases=attn_biases, time_embeds=time_embeds)
+
+    def forward_prepared(self, x, context: "DecoderContext", t):
+        """
+        `forward` with the step-invariant inputs from `prepare`; `t` is the index of the solver step in the
+        `t_span` given to `prepare`, or time embeddings from `embed_time`.
+        """
+        if isinstance(t, int):
+            t = context.time_embeds[t]
+        t = t.expand(x.size(0), -1)
+        mask = context.mask
+        x = pack([x, context.static], "b * t")[0]
+
+        hiddens = []
+        for (resnet, transformer_blocks, downsample), mask_down, attn_mask in zip(
+            self.down_blocks, context.masks, context.attn_biases,
+        ):
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_down.transpose(1, 2).contiguous(), mask_down)
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -293,16 +394,11 @@ class ConditionalDecoder(nn.Module):
             x = rearrange(x, "b t c -> b c t").contiguous()
             hiddens.append(x)  # Save hidden states for skip connections
             x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
-        mask_mid = masks[-1]
+        mask_mid, attn_mask = context.masks[-1], context.attn_biases[-1]
 
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_mid.transpose(1, 2).contiguous(), mask_mid)
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -311,15 +407,13 @@ class ConditionalDecoder(nn.Module):
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
 
-        for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
+        for (resnet, transformer_blocks, upsample), mask_up, attn_mask in zip(
+            self.up_blocks, context.masks[::-1], context.attn_biases[::-1],
+        ):
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_up.transpose(1, 2).contiguous(), mask_up)
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
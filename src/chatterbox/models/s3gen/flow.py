@@ -40,6 +40,21 @@ def _repeat_batch_dim(tnsr, B, ndim):
     return tnsr
 
 
+def _concat_padded(a, a_lens, b, b_lens):
+    """
+    Per row, the first `a_lens` items of `a` followed by the first `b_lens` of `b`, padded with zeros: (B, T, ...)
+    with T = max(a_lens + b_lens). Equals `torch.concat([a, b], dim=1)` when `a` has no padding.
+    """
+    lens = a_lens + b_lens
+    if bool((a_lens == a.size(1)).all()):
+        return torch.concat([a, b], dim=1)[:, :int(lens.max())], lens
+    out = a.new_zeros(a.size(0), int(lens.max()), *a.shape[2:])
+    for i, (a_len, b_len) in enumerate(zip(a_lens.long().tolist(), b_lens.long().tolist())):
+        out[i, :a_len] = a[i, :a_len]
+        out[i, a_len:a_len + b_len] = b[i, :b_len]
+    return out, lens
+
+
 class CausalMaskedDiffWithXvec(torch.nn.Module):
     def __init__(self,
                  input_size: int = 512,
@@ -128,6 +143,22 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         )
         return {'loss': loss}
 
+    def _encode_chunk(self, token, finalize, cache, num_left_chunks):
+        """
+        Encoder output of all the embedded `token`s (1, T, C), encoding only those added since the previous call
+        with this `cache`; without `finalize`, the last `pre_lookahead_len` tokens are only used as right context.
+        """
+        assert token.size(0) == 1, "the encoder cache is for single utterances"
+        start = cache.get("n_tokens", 0)
+        end = token.size(1) if finalize else token.size(1) - self.pre_lookahead_len
+        if end > start:
+            h, cache["encoder"] = self.encoder.forward_chunk(
+                token[:, start:end], token[:, end:], cache.get("encoder"), num_left_chunks,
+            )
+            cache["h"] = torch.cat([cache["h"], h], dim=1) if "h" in cache else h
+            cache["n_tokens"] = end
+        return cache["h"]
+
     @torch.inference_mode()
     def inference(self,
                   token,
@@ -140,9 +171,19 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   finalize,
                   n_timesteps=10,
                   noised_mels=None,
-                  meanflow=False):
-        # token: (B, n_toks)
+                  meanflow=False,
+                  cfg_steps=None,
+                  solver=None,
+                  t_schedule=None,
+                  encoder_cache=None,
+                  encoder_left_chunks=-1):
+        # token: (B, n_toks), padded
         # token_len: (B,)
+        # prompts are per item (B) or shared (1), padded, with `prompt_feat_len` None if the prompt mels aren't
+        # Returns the generated mels (B, 80, max mel_lens) without the prompt, left-aligned, and mel_lens (B,)
+        # encoder_cache: for streaming (B = 1, tokens only ever appended), a dict, empty on the first call, in which
+        # the encoder state is kept from one call to the next, so that only the new tokens are encoded, as chunks
+        # attending to `encoder_left_chunks` previous ones (see `UpsampleConformerEncoder.forward_chunk`)
         B = token.size(0)
 
         # xvec projection
@@ -158,7 +199,7 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         embedding = _repeat_batch_dim(embedding, B, ndim=2)  # (B, emb_dim)
 
         # concat text and prompt_text
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
+        token, token_len = _concat_padded(prompt_token, prompt_token_len, token, token_len)
         mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
 
         if (token >= self.vocab_size).any():
@@ -166,17 +207,26 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         token = self.input_embedding(token.long()) * mask
 
         # text encode
-        h, h_masks = self.encoder(token, token_len)
-        if finalize is False:
-            h = h[:, :-self.pre_lookahead_len * self.token_mel_ratio]
-
-        h_lengths = h_masks.sum(dim=-1).squeeze(dim=-1)
-        mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1] - prompt_feat.shape[1]
+        if encoder_cache is not None:
+            h = self._encode_chunk(token, finalize, encoder_cache, encoder_left_chunks)
+            h_lengths = torch.full((1,), h.size(1), device=h.device)
+        else:
+            h, h_masks = self.encoder(token, token_len)
+            h_lengths = h_masks.sum(dim=-1).squeeze(dim=-1)
+            if finalize is False:
+                # the mels of the lookahead tokens are dropped, per item
+                h_lengths = h_lengths - self.pre_lookahead_len * self.token_mel_ratio
+                h = h[:, :int(h_lengths.max())]
+
+        if prompt_feat_len is None:
+            prompt_feat_len = torch.full_like(h_lengths, prompt_feat.shape[1])
+        mel_lens = h_lengths - prompt_feat_len
         h = self.encoder_proj(h)
 
         # # get conditions
-        conds = torch.zeros([B, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
-        conds[:, :mel_len1] = prompt_feat
+        conds = torch.zeros([B, h.shape[1], self.output_size], device=token.device).to(h.dtype)
+        for i, mel_len1 in enumerate(prompt_feat_len.long().tolist()):
+            conds[i, :mel_len1] = prompt_feat[i, :mel_len1]
         conds = conds.transpose(1, 2)
 
         mask = (~make_pad_mask(h_lengths)).unsqueeze(1).to(h)
@@ -192,7 +242,12 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             n_timesteps=n_timesteps,
             noised_mels=noised_mels,
             meanflow=meanflow,
+            cfg_steps=cfg_steps,
+            solver=solver,
+            t_schedule=t_schedule,
         )
-        feat = feat[:, :, mel_len1:]
-        assert feat.shape[2] == mel_len2
-        return feat, None  # NOTE jrm: why are they returning None here?
+        # drop the prompt mels, per item
+        out = feat.new_zeros(B, feat.size(1), int(mel_lens.max()))
+        for i, (mel_len1, mel_len2) in enumerate(zip(prompt_feat_len.long().tolist(), mel_lens.long().tolist())):
+            out[i, :, :mel_len2] = feat[i, :, mel_len1:mel_len1 + mel_len2]
+        return out, mel_lens
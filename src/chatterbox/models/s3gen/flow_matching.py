@@ -16,6 +16,7 @@ import torch
 import torch.nn.functional as F
 from .matcha.flow_matching import BASECFM
 from .configs import CFM_PARAMS
+from .ode_solvers import get_solver, make_t_span
 from tqdm import tqdm
 
 
@@ -23,6 +24,19 @@ def cast_all(*args, dtype):
     return [a if (not a.dtype.is_floating_point) or a.dtype == dtype else a.to(dtype) for a in args]
 
 
+def guided_step_mask(cfg_steps, n_timesteps):
+    """
+    Which of the `n_timesteps` solver steps use classifier-free guidance: all of them (None), the first
+    `cfg_steps` (an int; the early steps are the high-noise ones), or the listed step indices.
+    """
+    if cfg_steps is None:
+        return [True] * n_timesteps
+    if isinstance(cfg_steps, int):
+        return [i < cfg_steps for i in range(n_timesteps)]
+    cfg_steps = set(cfg_steps)
+    return [i in cfg_steps for i in range(n_timesteps)]
+
+
 class ConditionalCFM(BASECFM):
     def __init__(self, in_channels, cfm_params, n_spks=1, spk_emb_dim=64, estimator: torch.nn.Module = None):
         super().__init__(
@@ -75,7 +89,7 @@ class ConditionalCFM(BASECFM):
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
         return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond, meanflow=False):
+    def solve_euler(self, x, t_span, mu, mask, spks, cond, meanflow=False, cfg_steps=None):
         """
         Fixed euler solver for ODEs.
         Args:
@@ -90,59 +104,55 @@ class ConditionalCFM(BASECFM):
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
             meanflow: meanflow mode
+            cfg_steps: the steps that use CFG, see `guided_step_mask` (default: all). The other steps run the
+                estimator on the conditional batch only, at half the cost.
+        """
+        return self.solve(x, t_span, mu, mask, spks, cond, cfg_steps=cfg_steps, solver="euler")
+
+    def solve(self, x, t_span, mu, mask, spks, cond, cfg_steps=None, solver=None):
         """
+        Solves the flow ODE over `t_span` with a solver from `ode_solvers.ODE_SOLVERS` (default: Euler), or any
+        function with the same signature. Arguments are as for `solve_euler`; the guidance of step i (`cfg_steps`)
+        also applies to the solver's intermediate evaluations within that step.
+        """
+        solver = get_solver(solver)
         in_dtype = x.dtype
         x, t_span, mu, mask, spks, cond = cast_all(x, t_span, mu, mask, spks, cond, dtype=self.estimator.dtype)
+        guided = guided_step_mask(cfg_steps, t_span.size(0) - 1)
 
-        # Duplicated batch dims are for CFG
-        # Do not use concat, it may cause memory format changed and trt infer with wrong results!
+        # Everything but x and t is the same on every step: the estimator prepares it once per batch layout
         B, T = mu.size(0), x.size(2)
-        x_in    = torch.zeros([2 * B, 80, T], device=x.device, dtype=x.dtype)
-        mask_in = torch.zeros([2 * B,  1, T], device=x.device, dtype=x.dtype)
-        mu_in   = torch.zeros([2 * B, 80, T], device=x.device, dtype=x.dtype)
-        t_in    = torch.zeros([2 * B       ], device=x.device, dtype=x.dtype)
-        spks_in = torch.zeros([2 * B, 80   ], device=x.device, dtype=x.dtype)
-        cond_in = torch.zeros([2 * B, 80, T], device=x.device, dtype=x.dtype)
-        r_in    = torch.zeros([2 * B       ], device=x.device, dtype=x.dtype) # (only used for meanflow)
-
-        for t, r in zip(t_span[:-1], t_span[1:]):
-            t = t.unsqueeze(dim=0)
-            r = r.unsqueeze(dim=0)
-            # Shapes:
-            #      x_in  ( 2B, 80, T )
-            #   mask_in  ( 2B,  1, T )
-            #     mu_in  ( 2B, 80, T )
-            #      t_in  ( 2B,       )
-            #   spks_in  ( 2B, 80,   )
-            #   cond_in  ( 2B, 80, T )
-            #      r_in  ( 2B,       )
-            #         x  (  B, 80, T )
-            #      mask  (  B,  1, T )
-            #        mu  (  B, 80, T )
-            #         t  (  B,       )
-            #      spks  (  B, 80,   )
-            #      cond  (  B, 80, T )
-            #         r  (  B,       )
-
-            x_in[:B] = x_in[B:] = x
+        context = context_cfg = None
+        if not all(guided):
+            context = self.estimator.prepare(mask, mu, spks=spks, cond=cond, t_span=t_span)
+        if any(guided):
+            # Duplicated batch dims are for CFG: the second half has no mu / spks / cond
+            # Do not use concat, it may cause memory format changed and trt infer with wrong results!
+            x_in    = torch.zeros([2 * B, 80, T], device=x.device, dtype=x.dtype)
+            mask_in = torch.zeros([2 * B,  1, T], device=x.device, dtype=x.dtype)
+            mu_in   = torch.zeros([2 * B, 80, T], device=x.device, dtype=x.dtype)
+            spks_in = torch.zeros([2 * B, 80   ], device=x.device, dtype=x.dtype)
+            cond_in = torch.zeros([2 * B, 80, T], device=x.device, dtype=x.dtype)
             mask_in[:B] = mask_in[B:] = mask
             mu_in[:B] = mu
-            t_in[:B] = t_in[B:] = t
             spks_in[:B] = spks
             cond_in[:B] = cond
-            r_in[:B] = r_in[B:] = r # (only used for meanflow)
-            dxdt = self.estimator.forward(
-                x=x_in, mask=mask_in, mu=mu_in, t=t_in, spks=spks_in, cond=cond_in,
-                r=r_in if meanflow else None,
-            )
-            dxdt, cfg_dxdt = torch.split(dxdt, [B, B], dim=0)
-            dxdt = ((1.0 + self.inference_cfg_rate) * dxdt - self.inference_cfg_rate * cfg_dxdt)
-            dt = r - t
-            x = x + dt * dxdt
-
-
-
-        return x.to(in_dtype)
+            context_cfg = self.estimator.prepare(mask_in, mu_in, spks=spks_in, cond=cond_in, t_span=t_span)
+
+        def velocity(x, step, t=None):
+            # on the solver grid, the step's precomputed time embedding; elsewhere, embed t
+            t = step if t is None else self.estimator.embed_time(t.view(1))
+            if guided[step]:
+                # Shapes:
+                #      x_in  ( 2B, 80, T )
+                #         x  (  B, 80, T )
+                x_in[:B] = x_in[B:] = x
+                dxdt = self.estimator.forward_prepared(x_in, context_cfg, t)
+                dxdt, cfg_dxdt = torch.split(dxdt, [B, B], dim=0)
+                return ((1.0 + self.inference_cfg_rate) * dxdt - self.inference_cfg_rate * cfg_dxdt)
+            return self.estimator.forward_prepared(x, context, t)
+
+        return solver(velocity, x, t_span).to(in_dtype)
 
     def compute_loss(self, x1, mask, mu, spks=None, cond=None):
         """Computes diffusion loss
@@ -193,7 +203,8 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = None
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, noised_mels=None, meanflow=False):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, noised_mels=None, meanflow=False,
+                cfg_steps=None, solver=None, t_schedule=None):
         """Forward diffusion
 
         Args:
@@ -207,6 +218,10 @@ class CausalConditionalCFM(ConditionalCFM):
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
             noised_mels: gt mels noised a time t
+            cfg_steps: the solver steps that use classifier-free guidance (default: all), see `guided_step_mask`
+            solver: ODE solver, a name in `ode_solvers.ODE_SOLVERS` (default: "euler") or a solver function
+            t_schedule: solver timesteps, a name in `ode_solvers.T_SCHEDULES`, a schedule function or explicit
+                times, see `make_t_span` (default: the model's `t_scheduler`)
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
@@ -220,9 +235,9 @@ class CausalConditionalCFM(ConditionalCFM):
             z[..., prompt_len:] = noised_mels
 
         # time steps for reverse diffusion
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
-        if (not meanflow) and (self.t_scheduler == 'cosine'):
-            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
+        if t_schedule is None:
+            t_schedule = self.t_scheduler if (not meanflow) and (self.t_scheduler == 'cosine') else "linear"
+        t_span = make_t_span(t_schedule, n_timesteps, device=mu.device, dtype=mu.dtype)
 
         # NOTE: right now, the only meanflow models are also distilled models, which don't need CFG
         #   because they were distilled with CFG outputs. We would need to add another hparam and
@@ -230,16 +245,18 @@ class CausalConditionalCFM(ConditionalCFM):
         if meanflow:
             return self.basic_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), None
 
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, meanflow=meanflow), None
+        return self.solve(
+            z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, cfg_steps=cfg_steps, solver=solver,
+        ), None
 
     def basic_euler(self, x, t_span, mu, mask, spks, cond):
         in_dtype = x.dtype
         x, t_span, mu, mask, spks, cond = cast_all(x, t_span, mu, mask, spks, cond, dtype=self.estimator.dtype)
 
+        context = self.estimator.prepare(mask, mu, spks=spks, cond=cond, t_span=t_span)
         print("S3 Token -> Mel Inference...")
-        for t, r in tqdm(zip(t_span[..., :-1], t_span[..., 1:]), total=t_span.shape[-1] - 1):
-            t, r = t[None], r[None]
-            dxdt = self.estimator.forward(x, mask=mask, mu=mu, t=t, spks=spks, cond=cond, r=r)
+        for step, (t, r) in tqdm(enumerate(zip(t_span[..., :-1], t_span[..., 1:])), total=t_span.shape[-1] - 1):
+            dxdt = self.estimator.forward_prepared(x, context, step)
             dt = r - t
             x = x + dt * dxdt
 
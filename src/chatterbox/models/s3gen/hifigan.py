@@ -24,7 +24,7 @@ import torch
 import torch.nn.functional as F
 from torch.nn import Conv1d
 from torch.nn import ConvTranspose1d
-from torch.nn.utils import remove_weight_norm
+from torch.nn.utils import parametrize
 from torch.nn.utils.parametrizations import weight_norm
 from torch.distributions.uniform import Uniform
 from torch import nn, sin, pow
@@ -103,6 +103,11 @@ This code is modified from https://github.com/jik876/hifi-gan
 """
 
 
+def remove_weight_norm(module: nn.Module):
+    "Folds the weight norm of `module` into a plain weight, computed once."
+    parametrize.remove_parametrizations(module, "weight", leave_parametrized=True)
+
+
 class ResBlock(torch.nn.Module):
     """Residual block module in HiFiGAN/BigVGAN."""
     def __init__(
@@ -204,9 +209,9 @@ class SineGen(torch.nn.Module):
         :return: [B, 1, sample_len]
         """
 
-        F_mat = torch.zeros((f0.size(0), self.harmonic_num + 1, f0.size(-1))).to(f0.device)
-        for i in range(self.harmonic_num + 1):
-            F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
+        # all harmonics at once: (B, 1, T) * (1, H + 1, 1)
+        harmonics = torch.arange(1, self.harmonic_num + 2, device=f0.device, dtype=torch.float32).view(1, -1, 1)
+        F_mat = f0 * harmonics / self.sampling_rate
 
         theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
         u_dist = Uniform(low=-np.pi, high=np.pi)
@@ -376,38 +381,46 @@ class HiFTGenerator(nn.Module):
         self.ups.apply(init_weights)
         self.conv_post.apply(init_weights)
         self.reflection_pad = nn.ReflectionPad1d((1, 0))
-        self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
+        # a buffer, so it follows the module to its device instead of being copied there on every call;
+        # the (i)STFT casts it back to fp32 after `.half()` & co.
+        stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
+        self.register_buffer("stft_window", stft_window, persistent=False)
         self.f0_predictor = f0_predictor
 
     def remove_weight_norm(self):
-        print('Removing weight norm...')
-        for l in self.ups:
-            remove_weight_norm(l)
-        for l in self.resblocks:
-            l.remove_weight_norm()
-        remove_weight_norm(self.conv_pre)
-        remove_weight_norm(self.conv_post)
-        self.m_source.remove_weight_norm()
-        for l in self.source_downs:
-            remove_weight_norm(l)
-        for l in self.source_resblocks:
-            l.remove_weight_norm()
+        "Folds every weight norm (`conv_pre`, `ups`, `resblocks`, `source_resblocks`, `conv_post`, the F0 predictor)."
+        for module in self.modules():
+            if parametrize.is_parametrized(module, "weight"):
+                remove_weight_norm(module)
+
+    def optimize_for_inference(self):
+        """
+        Inference-only mode: weight norms are folded into plain weights, instead of being recomputed from their
+        parametrization on every forward. The output is unchanged; do this after moving the model to its device, so
+        the weights are computed there. The model can't be trained any more.
+        """
+        self.eval()
+        self.remove_weight_norm()
+        return self
 
     def _stft(self, x):
+        # in fp32: reduced precision (i)STFTs are unsupported or inaccurate on several backends
         spec = torch.stft(
-            x,
-            self.istft_params["n_fft"], self.istft_params["hop_len"], self.istft_params["n_fft"], window=self.stft_window.to(x.device),
-            return_complex=True)
-        spec = torch.view_as_real(spec)  # [B, F, TT, 2]
+            x.float(),
+            self.istft_params["n_fft"], self.istft_params["hop_len"], self.istft_params["n_fft"],
+            window=self.stft_window.float(), return_complex=True)
+        spec = torch.view_as_real(spec).to(x.dtype)  # [B, F, TT, 2]
         return spec[..., 0], spec[..., 1]
 
     def _istft(self, magnitude, phase):
-        magnitude = torch.clip(magnitude, max=1e2)
+        dtype = magnitude.dtype
+        magnitude = torch.clip(magnitude.float(), max=1e2)
+        phase = phase.float()
         real = magnitude * torch.cos(phase)
         img = magnitude * torch.sin(phase)
         inverse_transform = torch.istft(torch.complex(real, img), self.istft_params["n_fft"], self.istft_params["hop_len"],
-                                        self.istft_params["n_fft"], window=self.stft_window.to(magnitude.device))
-        return inverse_transform
+                                        self.istft_params["n_fft"], window=self.stft_window.float())
+        return inverse_transform.to(dtype)
 
     def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
         s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
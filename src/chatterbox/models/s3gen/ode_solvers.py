@@ -0,0 +1,113 @@
+"""
+ODE solvers and timestep schedules for the flow matching decoder (`ConditionalCFM`).
+
+A solver integrates dx/dt = velocity(x, t) from noise (t = 0) to mels (t = 1) over a `t_span` of n + 1 times. It
+calls `velocity(x, step)` for the velocity at `t_span[step]`, the common case, whose time embedding is
+precomputed, and `velocity(x, step, t)` anywhere else within step `step` (which decides e.g. whether the
+evaluation is guided, see `guided_step_mask`).
+"""
+from typing import Callable, Sequence, Union
+
+import torch
+
+
+def linear_schedule(n_timesteps, device=None, dtype=None):
+    return torch.linspace(0, 1, n_timesteps + 1, device=device, dtype=dtype)
+
+
+def cosine_schedule(n_timesteps, device=None, dtype=None):
+    "Smaller steps at the start (high noise), larger ones near the end."
+    t_span = torch.linspace(0, 1, n_timesteps + 1, device=device, dtype=dtype)
+    return 1 - torch.cos(t_span * 0.5 * torch.pi)
+
+
+T_SCHEDULES = {
+    "linear": linear_schedule,
+    "cosine": cosine_schedule,
+}
+
+
+Schedule = Union[str, Callable, Sequence[float], torch.Tensor]
+
+
+def make_t_span(schedule: Schedule, n_timesteps: int, device=None, dtype=None) -> torch.Tensor:
+    """
+    The n_timesteps + 1 solver times, from a schedule name in `T_SCHEDULES`, a function like `cosine_schedule`, or
+    explicit increasing times from 0 to 1 (which then set the number of steps).
+    """
+    if isinstance(schedule, str):
+        if schedule not in T_SCHEDULES:
+            raise ValueError(f"unknown CFM timestep schedule {schedule!r}, expected one of {sorted(T_SCHEDULES)}")
+        schedule = T_SCHEDULES[schedule]
+    if callable(schedule):
+        return schedule(n_timesteps, device=device, dtype=dtype)
+    t_span = torch.as_tensor(schedule, device=device, dtype=dtype)
+    assert t_span.dim() == 1 and t_span.numel() >= 2, "explicit schedules need at least 2 times"
+    return t_span
+
+
+def euler(velocity, x, t_span):
+    "First order, 1 velocity evaluation per step."
+    for step in range(t_span.size(0) - 1):
+        dt = t_span[step + 1] - t_span[step]
+        x = x + dt * velocity(x, step)
+    return x
+
+
+def midpoint(velocity, x, t_span):
+    "Explicit midpoint (2nd order Runge-Kutta), 2 evaluations per step."
+    for step in range(t_span.size(0) - 1):
+        t = t_span[step]
+        dt = t_span[step + 1] - t
+        k1 = velocity(x, step)
+        k2 = velocity(x + 0.5 * dt * k1, step, t + 0.5 * dt)
+        x = x + dt * k2
+    return x
+
+
+def heun(velocity, x, t_span):
+    "Heun's method (trapezoidal predictor-corrector, 2nd order), 2 evaluations per step."
+    for step in range(t_span.size(0) - 1):
+        t, r = t_span[step], t_span[step + 1]
+        dt = r - t
+        k1 = velocity(x, step)
+        k2 = velocity(x + dt * k1, step, r)
+        x = x + 0.5 * dt * (k1 + k2)
+    return x
+
+
+def multistep(velocity, x, t_span):
+    """
+    2nd order Adams-Bashforth with variable steps, in the spirit of DPM-Solver++(2M): each step extrapolates from the
+    velocities of the current and previous points, so it stays at 1 evaluation per step (the first step is Euler).
+    """
+    prev = None  # (velocity, dt) of the previous step
+    for step in range(t_span.size(0) - 1):
+        dt = t_span[step + 1] - t_span[step]
+        v = velocity(x, step)
+        if prev is None:
+            x = x + dt * v
+        else:
+            v_prev, dt_prev = prev
+            ratio = 0.5 * dt / dt_prev
+            x = x + dt * ((1 + ratio) * v - ratio * v_prev)
+        prev = (v, dt)
+    return x
+
+
+ODE_SOLVERS = {
+    "euler": euler,
+    "midpoint": midpoint,
+    "heun": heun,
+    "multistep": multistep,
+}
+
+def get_solver(solver: Union[str, Callable, None]) -> Callable:
+    "A solver from `ODE_SOLVERS` by name (None: Euler), or a function with the same signature."
+    if solver is None:
+        return euler
+    if callable(solver):
+        return solver
+    if solver not in ODE_SOLVERS:
+        raise ValueError(f"unknown CFM solver {solver!r}, expected one of {sorted(ODE_SOLVERS)}")
+    return ODE_SOLVERS[solver]
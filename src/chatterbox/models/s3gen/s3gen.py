@@ -17,8 +17,9 @@ import logging
 import numpy as np
 import torch
 import torchaudio as ta
+from torch.nn.utils.rnn import pad_sequence
 from functools import lru_cache
-from typing import Optional
+from typing import List, Optional, Union
 
 from ..s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, S3Tokenizer
 from .const import S3GEN_SR
@@ -115,6 +116,33 @@ class S3Token2Mel(torch.nn.Module):
         params = self.flow.parameters()
         return next(params).dtype
 
+    def _cast_ref_dict(self, ref_dict: dict) -> dict:
+        # type/device casting (all values will be numpy if it's from a prod API call)
+        # NOTE: cast into a copy, the caller's dict may be shared across concurrent requests
+        ref_dict = dict(ref_dict)
+        for rk in list(ref_dict):
+            if isinstance(ref_dict[rk], np.ndarray):
+                ref_dict[rk] = torch.from_numpy(ref_dict[rk])
+            if torch.is_tensor(ref_dict[rk]):
+                ref_dict[rk] = ref_dict[rk].to(device=self.device, dtype=self.dtype)
+        return ref_dict
+
+    def batch_ref_dicts(self, ref_dicts: List[dict]) -> dict:
+        """
+        One reference per batch item (see `embed_ref`), possibly of different voices and lengths, as a single ref_dict
+        with zero-padded prompts and their lengths.
+        """
+        ref_dicts = [self._cast_ref_dict(ref_dict) for ref_dict in ref_dicts]
+        prompt_tokens = [torch.atleast_2d(ref["prompt_token"])[0] for ref in ref_dicts]
+        prompt_feats = [torch.atleast_3d(ref["prompt_feat"])[0] for ref in ref_dicts]
+        return dict(
+            prompt_token=pad_sequence(prompt_tokens, batch_first=True),
+            prompt_token_len=torch.tensor([len(tokens) for tokens in prompt_tokens], device=self.device),
+            prompt_feat=pad_sequence(prompt_feats, batch_first=True),
+            prompt_feat_len=torch.tensor([len(feat) for feat in prompt_feats], device=self.device),
+            embedding=torch.cat([torch.atleast_2d(ref["embedding"]) for ref in ref_dicts]),
+        )
+
     def embed_ref(
         self,
         ref_wav: torch.Tensor,
@@ -176,12 +204,17 @@ class S3Token2Mel(torch.nn.Module):
         # locally-computed ref embedding (mutex with ref_dict)
         ref_wav: Optional[torch.Tensor],
         ref_sr: Optional[int],
-        # pre-computed ref embedding (prod API)
-        ref_dict: Optional[dict] = None,
+        # pre-computed ref embedding (prod API), or one per batch item
+        ref_dict: Optional[Union[dict, List[dict]]] = None,
         n_cfm_timesteps = None,
         finalize: bool = False,
         speech_token_lens=None,
         noised_mels=None,
+        cfm_cfg_steps=None,
+        cfm_solver=None,
+        cfm_schedule=None,
+        encoder_cache=None,
+        encoder_left_chunks=-1,
     ):
         """
         Generate waveforms from S3 speech tokens and a reference waveform, which the speaker timbre is inferred from.
@@ -190,26 +223,35 @@ class S3Token2Mel(torch.nn.Module):
         - The speaker encoder accepts 16 kHz waveform.
         - S3TokenizerV2 accepts 16 kHz waveform.
         - The mel-spectrogram for the reference assumes 24 kHz input signal.
-        - This function is designed for batch_size=1 only.
+        - Batches are padded: `speech_token_lens` gives the length of each item, and `ref_dict` may be a list with
+          the reference of each item (different voices). The mels of each item are then left-aligned and zero-padded,
+          see `CausalMaskedDiffWithXvec.inference`.
 
         Args
         ----
-        - `speech_tokens`: S3 speech tokens [B=1, T]
+        - `speech_tokens`: S3 speech tokens [B, T]
         - `ref_wav`: reference waveform (`torch.Tensor` with shape=[B=1, T])
         - `ref_sr`: reference sample rate
+        - `speech_token_lens`: [B] lengths of `speech_tokens` (default: all of T)
         - `finalize`: whether streaming is finished or not. Note that if False, the last 3 tokens will be ignored.
+        - `cfm_cfg_steps`: the CFM solver steps that use classifier-free guidance: None (all), the first N (an int)
+          or a list of step indices; the others run the estimator at half the batch size. Ignored by meanflow models.
+        - `cfm_solver`: the CFM ODE solver, a name in `ode_solvers.ODE_SOLVERS` ("euler", "midpoint", "heun",
+          "multistep") or a solver function; default Euler. Ignored by meanflow models.
+        - `cfm_schedule`: the CFM timesteps, a name in `ode_solvers.T_SCHEDULES`, a schedule function or explicit
+          times; default the model's (cosine, linear for meanflow models).
+        - `encoder_cache`: for streaming, a dict kept across the calls for one utterance (empty on the first) so that
+          each call only encodes the tokens added since the previous one, as a chunk attending to
+          `encoder_left_chunks` previous chunks (all if < 0), see `CausalMaskedDiffWithXvec.inference`.
         """
         assert (ref_wav is None) ^ (ref_dict is None), f"Must provide exactly one of ref_wav or ref_dict (got {ref_wav} and {ref_dict})"
 
         if ref_dict is None:
             ref_dict = self.embed_ref(ref_wav, ref_sr)
+        elif isinstance(ref_dict, (list, tuple)):
+            ref_dict = self.batch_ref_dicts(ref_dict)
         else:
-            # type/device casting (all values will be numpy if it's from a prod API call)
-            for rk in list(ref_dict):
-                if isinstance(ref_dict[rk], np.ndarray):
-                    ref_dict[rk] = torch.from_numpy(ref_dict[rk])
-                if torch.is_tensor(ref_dict[rk]):
-                    ref_dict[rk] = ref_dict[rk].to(device=self.device, dtype=self.dtype)
+            ref_dict = self._cast_ref_dict(ref_dict)
 
         speech_tokens = torch.atleast_2d(speech_tokens)
 
@@ -224,6 +266,11 @@ class S3Token2Mel(torch.nn.Module):
             noised_mels=noised_mels,
             n_timesteps=n_cfm_timesteps,
             meanflow=self.meanflow,
+            cfg_steps=cfm_cfg_steps,
+            solver=cfm_solver,
+            t_schedule=cfm_schedule,
+            encoder_cache=encoder_cache,
+            encoder_left_chunks=encoder_left_chunks,
             **ref_dict,
         )
         return output_mels
@@ -271,16 +318,19 @@ class S3Token2Wav(S3Token2Mel):
         skip_vocoder=False,
         n_cfm_timesteps=None,
         noised_mels=None,
-
+        cfm_cfg_steps=None,
+        cfm_solver=None,
+        cfm_schedule=None,
     ):
         """
         Generate waveforms from S3 speech tokens and a reference waveform, which the speaker timbre is inferred from.
-        NOTE: used for sync synthesis only. Please use `S3GenStreamer` for streaming synthesis.
+        NOTE: used for sync synthesis only. Please use `S3GenStreamer` (below) for streaming synthesis.
         """
         output_mels = super().forward(
             speech_tokens, speech_token_lens=speech_token_lens, ref_wav=ref_wav,
             ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize,
-            n_cfm_timesteps=n_cfm_timesteps, noised_mels=noised_mels,
+            n_cfm_timesteps=n_cfm_timesteps, noised_mels=noised_mels, cfm_cfg_steps=cfm_cfg_steps,
+            cfm_solver=cfm_solver, cfm_schedule=cfm_schedule,
         )
 
         if skip_vocoder:
@@ -309,14 +359,24 @@ class S3Token2Wav(S3Token2Mel):
         n_cfm_timesteps = None,
         finalize: bool = False,
         speech_token_lens=None,
+        noised_mels=None,
+        cfm_cfg_steps=None,
+        cfm_solver=None,
+        cfm_schedule=None,
+        encoder_cache=None,
+        encoder_left_chunks=-1,
     ):
         n_cfm_timesteps = n_cfm_timesteps or (2 if self.meanflow else 10)
-        noise = None
-        if self.meanflow:
-            noise = torch.randn(1, 80, speech_tokens.size(-1) * 2, dtype=self.dtype, device=self.device)
+        noise = noised_mels
+        if noise is None and self.meanflow and torch.atleast_2d(speech_tokens).size(0) == 1:
+            # without `finalize`, the flow drops the mels of the lookahead tokens
+            n_tokens = speech_tokens.size(-1) - (0 if finalize else self.flow.pre_lookahead_len)
+            noise = torch.randn(1, 80, n_tokens * 2, dtype=self.dtype, device=self.device)
         output_mels = super().forward(
             speech_tokens, speech_token_lens=speech_token_lens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict,
-            n_cfm_timesteps=n_cfm_timesteps, finalize=finalize, noised_mels=noise,
+            n_cfm_timesteps=n_cfm_timesteps, finalize=finalize, noised_mels=noise, cfm_cfg_steps=cfm_cfg_steps,
+            cfm_solver=cfm_solver, cfm_schedule=cfm_schedule, encoder_cache=encoder_cache,
+            encoder_left_chunks=encoder_left_chunks,
         )
         return output_mels
 
@@ -333,16 +393,27 @@ class S3Token2Wav(S3Token2Mel):
         # locally-computed ref embedding (mutex with ref_dict)
         ref_wav: Optional[torch.Tensor] = None,
         ref_sr: Optional[int] = None,
-        # pre-computed ref embedding (prod API)
-        ref_dict: Optional[dict] = None,
+        # pre-computed ref embedding (prod API), or one per batch item
+        ref_dict: Optional[Union[dict, List[dict]]] = None,
         # left as a kwarg because this can change input/output size ratio
         drop_invalid_tokens=True,
         n_cfm_timesteps=None,
         speech_token_lens=None,
+        # CFM solver steps with classifier-free guidance, ODE solver and timesteps, see `S3Token2Mel.forward`
+        cfm_cfg_steps=None,
+        cfm_solver=None,
+        cfm_schedule=None,
     ):
+        """
+        Waveforms and HiFT sources of speech tokens. A batch, i.e. padded `speech_tokens` [B, T] with their
+        `speech_token_lens`, and a single `ref_dict` or one per item, runs the flow and HiFT once for all items; the
+        outputs are then lists with the waveform [1, N_i] and source [1, 1, N_i] of each item, trimmed to its length.
+        """
         # hallucination prevention, drop special tokens
         # if drop_invalid_tokens:
         #     speech_tokens, speech_token_lens = drop_invalid(speech_tokens, pad=S3_QUIET_PAD)
+        speech_tokens = torch.atleast_2d(speech_tokens)
+        batched = isinstance(ref_dict, (list, tuple)) or speech_tokens.size(0) > 1
 
         output_mels = self.flow_inference(
             speech_tokens,
@@ -351,6 +422,9 @@ class S3Token2Wav(S3Token2Mel):
             ref_sr=ref_sr,
             ref_dict=ref_dict,
             n_cfm_timesteps=n_cfm_timesteps,
+            cfm_cfg_steps=cfm_cfg_steps,
+            cfm_solver=cfm_solver,
+            cfm_schedule=cfm_schedule,
             finalize=True,
         )
         output_mels = output_mels.to(dtype=self.dtype) # FIXME (fp16 mode) is this still needed?
@@ -359,4 +433,189 @@ class S3Token2Wav(S3Token2Mel):
         # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
         output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
 
+        if batched:
+            if speech_token_lens is None:
+                speech_token_lens = torch.full((speech_tokens.size(0),), speech_tokens.size(1))
+            # each mel frame is vocoded into a fixed number of samples
+            samples_per_token = self.flow.token_mel_ratio * int(self.mel2wav.f0_upsamp.scale_factor)
+            wav_lens = [int(n) * samples_per_token for n in speech_token_lens.tolist()]
+            output_wavs = [wav[None, :n] for wav, n in zip(output_wavs, wav_lens)]
+            output_sources = [source[None, :, :n] for source, n in zip(output_sources, wav_lens)]
         return output_wavs, output_sources
+
+
+def fade_in_out(fade_in_wav, fade_out_wav, window):
+    "Crossfade the head of `fade_in_wav` with the tail of `fade_out_wav`, over half the length of `window` each."
+    overlap_len = window.size(0) // 2
+    fade_in_wav = fade_in_wav.clone()
+    fade_in_wav[..., :overlap_len] = (
+        fade_in_wav[..., :overlap_len] * window[:overlap_len] + fade_out_wav[..., -overlap_len:] * window[overlap_len:]
+    )
+    return fade_in_wav
+
+
+class S3GenStreamer:
+    """
+    Chunked token-to-waveform synthesis of a single utterance, for streaming TTS:
+        * every `token_hop_len` tokens the flow re-runs on all tokens received so far with `finalize=False`, so the
+          last `pre_lookahead_len` tokens are only used as right context; only the new mel frames are kept
+        * the flow's ODE noise is fixed per utterance, so frames don't change from one chunk to the next
+        * with `encoder_cache`, the flow encoder instead only encodes the new tokens, as a chunk attending to the
+          previous ones (`encoder_left_chunks` of them, all if < 0) through cached keys / values, so its cost per
+          chunk stops growing with the utterance; the prompt and first tokens form the first chunk
+        * opt-in, `context_tokens=N` (e.g. 50) bounds the flow's work per chunk: it runs on the new tokens only,
+          with the last N tokens already synthesized and their mels appended to the reference prompt. The output is
+          then no longer that of whole-utterance synthesis, as the new frames continue the streamer's own mels
+        * HiFT re-vocodes the last `mel_cache_len` mel frames of the previous chunk with its source excitation
+          (`cache_source`), and that overlap is crossfaded with the audio held back from the previous chunk
+
+    Usage:
+        streamer = S3GenStreamer(s3gen, ref_dict)
+        for tokens in token_chunks:
+            play(streamer.push(tokens))
+        play(streamer.flush())
+    """
+
+    def __init__(
+        self,
+        s3gen: S3Token2Wav,
+        ref_dict: dict,
+        n_cfm_timesteps=None,
+        cfm_cfg_steps=None,
+        cfm_solver=None,
+        cfm_schedule=None,
+        token_hop_len=25,
+        first_token_hop_len=None,
+        mel_cache_len=8,
+        context_tokens=None,
+        encoder_cache=False,
+        encoder_left_chunks=-1,
+    ):
+        if encoder_cache and context_tokens is not None:
+            raise ValueError("encoder_cache and context_tokens are alternatives, use one or the other")
+        self.s3gen = s3gen
+        self.ref_dict = ref_dict
+        self.n_cfm_timesteps = n_cfm_timesteps
+        self.cfm_cfg_steps = cfm_cfg_steps
+        self.cfm_solver = cfm_solver
+        self.cfm_schedule = cfm_schedule
+        self.token_hop_len = token_hop_len
+        self.first_token_hop_len = first_token_hop_len or token_hop_len
+        self.pre_lookahead_len = s3gen.flow.pre_lookahead_len
+        self.token_mel_ratio = s3gen.flow.token_mel_ratio
+        self.mel_cache_len = mel_cache_len
+        self.context_tokens = context_tokens
+        self.source_cache_len = mel_cache_len * int(s3gen.mel2wav.f0_upsamp.scale_factor)  # samples per mel frame
+
+        device, dtype = s3gen.device, s3gen.dtype
+        self.speech_window = torch.from_numpy(np.hamming(2 * self.source_cache_len)).to(device=device, dtype=dtype)
+        self.tokens = torch.zeros(1, 0, dtype=torch.long, device=device)
+        self.noise = torch.zeros(1, 80, 0, dtype=dtype, device=device)
+        self.mels = torch.zeros(1, 80, 0, dtype=dtype, device=device)  # of the last `context_tokens` tokens
+        self.token_offset = 0
+        self.hift_cache = None
+        self.encoder_cache = {} if encoder_cache else None
+        self.encoder_left_chunks = encoder_left_chunks
+        self.finished = False
+
+    @property
+    def first_chunk_tokens(self):
+        "Number of tokens needed before `push` returns any audio."
+        return self.first_token_hop_len + self.pre_lookahead_len
+
+    @torch.inference_mode()
+    def push(self, speech_tokens) -> torch.Tensor:
+        """
+        Add speech tokens (invalid/special tokens already removed) and return the audio that became ready,
+        shape (1, N), possibly empty.
+        """
+        assert not self.finished, "streamer already flushed"
+        speech_tokens = torch.atleast_2d(speech_tokens).to(device=self.tokens.device, dtype=torch.long)
+        self.tokens = torch.cat([self.tokens, speech_tokens], dim=1)
+
+        wavs = [self.noise.new_zeros(1, 0)]
+        while True:
+            hop_len = self.first_token_hop_len if self.token_offset == 0 else self.token_hop_len
+            if self.tokens.size(1) - self.token_offset < hop_len + self.pre_lookahead_len:
+                break
+            end = self.token_offset + hop_len + self.pre_lookahead_len
+            wavs.append(self._token2wav(self.tokens[:, :end], finalize=False))
+            self.token_offset += hop_len
+        return torch.cat(wavs, dim=1)
+
+    @torch.inference_mode()
+    def flush(self) -> torch.Tensor:
+        "Synthesize everything left, including the lookahead tokens; returns (1, N)."
+        assert not self.finished, "streamer already flushed"
+        self.finished = True
+        if self.tokens.size(1) == 0:
+            return self.noise.new_zeros(1, 0)
+        if self.tokens.size(1) == self.token_offset:
+            return self.hift_cache["speech"]
+        return self._token2wav(self.tokens, finalize=True)
+
+    def _token2wav(self, tokens, finalize):
+        n_mels = self.token_mel_ratio * (tokens.size(1) - (0 if finalize else self.pre_lookahead_len))
+        if self.noise.size(2) < n_mels:
+            extra = torch.randn(1, 80, n_mels - self.noise.size(2), dtype=self.noise.dtype, device=self.noise.device)
+            self.noise = torch.cat([self.noise, extra], dim=2)
+
+        # the mels before `start` are kept from the previous chunks
+        start = self.token_offset if self.context_tokens is not None else 0
+        mels = self.s3gen.flow_inference(
+            tokens[:, start:],
+            ref_dict=self._ref_dict_with_context() if start else self.ref_dict,
+            n_cfm_timesteps=self.n_cfm_timesteps,
+            cfm_cfg_steps=self.cfm_cfg_steps,
+            cfm_solver=self.cfm_solver,
+            cfm_schedule=self.cfm_schedule,
+            finalize=finalize,
+            noised_mels=self.noise[:, :, start * self.token_mel_ratio:n_mels],
+            encoder_cache=self.encoder_cache,
+            encoder_left_chunks=self.encoder_left_chunks,
+        )
+        mels = mels[:, :, (self.token_offset - start) * self.token_mel_ratio:].to(dtype=self.s3gen.dtype)
+        if self.context_tokens:
+            self.mels = torch.cat([self.mels, mels], dim=2)[:, :, -self.context_tokens * self.token_mel_ratio:]
+
+        cache_source = None
+        if self.hift_cache is not None:
+            mels = torch.cat([self.hift_cache["mel"], mels], dim=2)
+            cache_source = self.hift_cache["source"]
+        wavs, sources = self.s3gen.hift_inference(mels, cache_source)
+
+        if self.hift_cache is not None:
+            wavs = fade_in_out(wavs, self.hift_cache["speech"], self.speech_window)
+        else:
+            # NOTE: same ad-hoc "spillover" reduction as `S3Token2Wav.inference`, on the first chunk only
+            n_fade = min(wavs.size(1), len(self.s3gen.trim_fade))
+            wavs[:, :n_fade] *= self.s3gen.trim_fade[:n_fade]
+
+        if not finalize:
+            self.hift_cache = dict(
+                mel=mels[:, :, -self.mel_cache_len:],
+                source=sources[:, :, -self.source_cache_len:],
+                speech=wavs[:, -self.source_cache_len:],
+            )
+            wavs = wavs[:, :-self.source_cache_len]
+        return wavs
+
+    def _ref_dict_with_context(self):
+        "`ref_dict` with the last `context_tokens` synthesized tokens and their mels appended to the prompt."
+        n_context = min(self.context_tokens, self.token_offset)
+        if n_context == 0:
+            return self.ref_dict
+        ref = self.ref_dict
+        prompt_token = torch.atleast_2d(ref["prompt_token"])
+        n_prompt = prompt_token.size(1) if ref.get("prompt_token_len") is None else int(ref["prompt_token_len"][0])
+        # the context mels go right after the mels of the prompt tokens, which may be a frame shorter than `prompt_feat`
+        prompt_feat = ref["prompt_feat"][:, :n_prompt * self.token_mel_ratio]
+        context_token = self.tokens[:, self.token_offset - n_context:self.token_offset]
+        context_feat = self.mels[:, :, self.mels.size(2) - n_context * self.token_mel_ratio:].transpose(1, 2)
+        return dict(
+            ref,
+            prompt_token=torch.cat([prompt_token[:, :n_prompt], context_token.to(prompt_token)], dim=1),
+            prompt_token_len=torch.tensor([n_prompt + n_context], device=prompt_token.device),
+            prompt_feat=torch.cat([prompt_feat, context_feat.to(prompt_feat)], dim=1),
+            prompt_feat_len=None,
+        )
@@ -15,7 +15,7 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder definition."""
-from typing import Tuple
+from typing import List, Optional, Tuple
 
 import torch
 from torch import nn
@@ -62,6 +62,19 @@ class Upsample1D(nn.Module):
         outputs = self.conv(outputs)
         return outputs, input_lengths * self.stride
 
+    def forward_chunk(self, inputs: torch.Tensor, cache: Optional[torch.Tensor] = None
+                      ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        `forward` on the next frames (B, C, T) of a sequence, given `cache`, the last `2 * stride` upsampled frames
+        before them (None at the start of the sequence: zeros, like the padding in `forward`).
+        Returns (B, C, stride * T) and the cache for the next frames.
+        """
+        outputs = F.interpolate(inputs, scale_factor=float(self.stride), mode="nearest")
+        if cache is None:
+            cache = outputs.new_zeros(outputs.size(0), outputs.size(1), self.stride * 2)
+        outputs = torch.cat([cache, outputs], dim=2)
+        return self.conv(outputs), outputs[:, :, -self.stride * 2:]
+
 
 class PreLookaheadLayer(nn.Module):
     def __init__(self, channels: int, pre_lookahead_len: int = 1):
@@ -95,6 +108,25 @@ class PreLookaheadLayer(nn.Module):
         outputs = outputs + inputs
         return outputs
 
+    def forward_chunk(self, inputs: torch.Tensor, context: torch.Tensor, cache: Optional[torch.Tensor] = None
+                      ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        `forward` on the next frames (B, T, C) of a sequence, given the `context` frames (B, T', C) that follow them
+        (`pre_lookahead_len`, fewer at the end of the sequence: the rest is zero-padded like in `forward`) and
+        `cache`, the last 2 lookahead (`conv1`) outputs before them (None at the start of the sequence).
+        Returns (B, T, C) and the cache for the next frames.
+        """
+        outputs = torch.cat([inputs, context[:, :self.pre_lookahead_len]], dim=1).transpose(1, 2)
+        # look ahead
+        outputs = F.pad(outputs, (0, inputs.size(1) + self.pre_lookahead_len - outputs.size(2)), value=0.0)
+        outputs = F.leaky_relu(self.conv1(outputs))
+        if cache is None:
+            cache = outputs.new_zeros(outputs.size(0), outputs.size(1), 2)
+        outputs = torch.cat([cache, outputs], dim=2)
+        cache = outputs[:, :, -2:]
+        outputs = self.conv2(outputs).transpose(1, 2)
+        return outputs + inputs, cache
+
 
 class UpsampleConformerEncoder(torch.nn.Module):
 
@@ -277,7 +309,8 @@ class UpsampleConformerEncoder(torch.nn.Module):
                                               self.static_chunk_size,
                                               num_decoding_left_chunks)
         # lookahead + conformer encoder
-        xs = self.pre_lookahead_layer(xs)
+        # (padding zeroed, so the lookahead of a shorter item in a batch sees what it would alone: zeros)
+        xs = self.pre_lookahead_layer(xs * mask_pad.transpose(1, 2))
         xs = self.forward_layers(xs, chunk_masks, pos_emb, mask_pad)
 
         # upsample + conformer encoder
@@ -291,7 +324,8 @@ class UpsampleConformerEncoder(torch.nn.Module):
         chunk_masks = add_optional_chunk_mask(xs, masks,
                                               self.use_dynamic_chunk,
                                               self.use_dynamic_left_chunk,
-                                              decoding_chunk_size,
+                                              decoding_chunk_size * self.up_layer.stride
+                                              if decoding_chunk_size > 0 else decoding_chunk_size,
                                               self.static_chunk_size * self.up_layer.stride,
                                               num_decoding_left_chunks)
         xs = self.forward_up_layers(xs, chunk_masks, pos_emb, mask_pad)
@@ -316,3 +350,86 @@ class UpsampleConformerEncoder(torch.nn.Module):
         for layer in self.up_encoders:
             xs, chunk_masks, _, _ = layer(xs, chunk_masks, pos_emb, mask_pad)
         return xs
+
+    def forward_chunk(
+        self,
+        xs: torch.Tensor,
+        context: torch.Tensor,
+        cache: Optional[dict] = None,
+        num_decoding_left_chunks: int = -1,
+    ) -> Tuple[torch.Tensor, dict]:
+        """Encode the next chunk of a sequence, attending to the chunks before it through a cache.
+
+        Streaming counterpart of `forward`: encoding a sequence chunk by chunk gives the output of `forward` with
+        chunk masks over the same chunks (e.g. `decoding_chunk_size` for chunks of equal size). Only the new frames
+        are computed, so with a bounded `num_decoding_left_chunks` the cost per chunk doesn't grow with the length
+        of the sequence.
+
+        Args:
+            xs: next chunk (B, T, D), unpadded
+            context: input frames (B, T', D) that follow the chunk, the right context of the pre-lookahead layer
+                (T' = its `pre_lookahead_len`, or fewer at the end of the sequence)
+            cache: returned by the call for the previous chunk, None for the first chunk
+            num_decoding_left_chunks: number of previous chunks attended to
+                >=0: use num_decoding_left_chunks
+                <0: use all left chunks
+        Returns:
+            xs: encoded chunk (B, 2T, D)
+            cache: for the next chunk
+        """
+        cache = cache or {}
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+            context = self.global_cmvn(context)
+        # the chunks kept as left context of the next one
+        chunk_lens = cache.get("chunk_lens", []) + [xs.size(1)]
+        if num_decoding_left_chunks >= 0:
+            chunk_lens = chunk_lens[-num_decoding_left_chunks:] if num_decoding_left_chunks else []
+        n_keep = sum(chunk_lens)
+        offset = cache.get("offset", 0)
+
+        # lookahead + conformer encoder
+        masks = torch.ones(xs.size(0), 1, xs.size(1), dtype=torch.bool, device=xs.device)
+        xs, _, _ = self.embed(xs, masks, offset)
+        context, _, _ = self.embed(context, masks[:, :, :context.size(1)], offset + xs.size(1))
+        xs, lookahead_cache = self.pre_lookahead_layer.forward_chunk(xs, context, cache.get("lookahead"))
+        xs, att_caches = self._forward_chunk_layers(self.encoders, self.embed, xs, offset, cache.get("att"), n_keep)
+
+        # upsample + conformer encoder
+        xs, up_cache = self.up_layer.forward_chunk(xs.transpose(1, 2), cache.get("up"))
+        xs = xs.transpose(1, 2)
+        stride = self.up_layer.stride
+        xs, _, _ = self.up_embed(xs, masks.repeat(1, 1, stride), offset * stride)
+        xs, up_att_caches = self._forward_chunk_layers(
+            self.up_encoders, self.up_embed, xs, offset * stride, cache.get("up_att"), n_keep * stride,
+        )
+
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs, dict(
+            offset=offset + masks.size(2),
+            chunk_lens=chunk_lens,
+            lookahead=lookahead_cache,
+            att=att_caches,
+            up=up_cache,
+            up_att=up_att_caches,
+        )
+
+    @staticmethod
+    def _forward_chunk_layers(layers: torch.nn.ModuleList, embed: torch.nn.Module, xs: torch.Tensor, offset: int,
+                              att_caches: Optional[List[torch.Tensor]],
+                              n_keep: int) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        """
+        `layers` on a chunk at `offset`, attending to the keys / values `att_caches` (per layer) of the frames
+        before it; returns the output and the keys / values of the last `n_keep` frames, chunk included.
+        """
+        cache_t = att_caches[0].size(2) if att_caches else 0
+        # relative positions between the chunk (queries) and the cached frames + chunk (keys)
+        pos_emb = embed.position_encoding(offset=offset - cache_t, size=cache_t + xs.size(1))
+        no_mask = torch.ones((0, 0, 0), dtype=torch.bool, device=xs.device)
+        new_caches = []
+        for i, layer in enumerate(layers):
+            att_cache = att_caches[i] if att_caches else torch.zeros((0, 0, 0, 0), dtype=xs.dtype, device=xs.device)
+            xs, _, new_cache, _ = layer(xs, no_mask, pos_emb, att_cache=att_cache)
+            new_caches.append(new_cache[:, :, new_cache.size(2) - n_keep:])
+        return xs, new_caches
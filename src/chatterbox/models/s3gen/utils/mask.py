@@ -77,12 +77,22 @@ def subsequent_chunk_mask(
          [1, 1, 0, 0],
          [1, 1, 1, 1],
          [1, 1, 1, 1]]
+        >>> subsequent_chunk_mask(6, 2, num_left_chunks=1)
+        [[1, 1, 0, 0, 0, 0],
+         [1, 1, 0, 0, 0, 0],
+         [1, 1, 1, 1, 0, 0],
+         [1, 1, 1, 1, 0, 0],
+         [0, 0, 1, 1, 1, 1],
+         [0, 0, 1, 1, 1, 1]]
     """
-    # NOTE this modified implementation meets onnx export requirements, but it doesn't support num_left_chunks
-    # actually this is not needed after we have inference cache implemented, will remove it later
+    # NOTE this modified implementation meets onnx export requirements
     pos_idx = torch.arange(size, device=device)
-    block_value = (torch.div(pos_idx, chunk_size, rounding_mode='trunc') + 1) * chunk_size
+    chunk_idx = torch.div(pos_idx, chunk_size, rounding_mode='trunc')
+    block_value = (chunk_idx + 1) * chunk_size
     ret = pos_idx.unsqueeze(0) < block_value.unsqueeze(1)
+    if num_left_chunks >= 0:
+        start = (chunk_idx - num_left_chunks).clamp(min=0) * chunk_size
+        ret = ret & (pos_idx.unsqueeze(0) >= start.unsqueeze(1))
     return ret
 
 
@@ -108,7 +118,8 @@ def add_optional_chunk_mask(xs: torch.Tensor,
             >0: for decoding, use fixed chunk size as set.
         static_chunk_size (int): chunk size for static chunk training/decoding
             if it's greater than 0, if use_dynamic_chunk is true,
-            this parameter will be ignored
+            this parameter will be ignored; a decoding_chunk_size > 0
+            takes precedence over it
         num_decoding_left_chunks: number of left chunks, this is for decoding,
             the chunk size is decoding_chunk_size.
             >=0: use num_decoding_left_chunks
@@ -148,9 +159,10 @@ def add_optional_chunk_mask(xs: torch.Tensor,
                                             xs.device)  # (L, L)
         chunk_masks = chunk_masks.unsqueeze(0)  # (1, L, L)
         chunk_masks = masks & chunk_masks  # (B, L, L)
-    elif static_chunk_size > 0:
+    elif static_chunk_size > 0 or decoding_chunk_size > 0:
+        chunk_size = decoding_chunk_size if decoding_chunk_size > 0 else static_chunk_size
         num_left_chunks = num_decoding_left_chunks
-        chunk_masks = subsequent_chunk_mask(xs.size(1), static_chunk_size,
+        chunk_masks = subsequent_chunk_mask(xs.size(1), chunk_size,
                                             num_left_chunks,
                                             xs.device)  # (L, L)
         chunk_masks = chunk_masks.unsqueeze(0)  # (1, L, L)
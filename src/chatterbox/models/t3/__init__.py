@@ -1 +1,3 @@
-from .t3 import T3
+from .t3 import T3, SpeechTokenChunk
+from .inference.batch_scheduler import T3BatchScheduler, DecodeSequence
+from .inference.cfg_schedule import CFGSchedule
@@ -4,7 +4,6 @@
 import logging
 import torch
 from dataclasses import dataclass
-from types import MethodType
 
 
 logger = logging.getLogger(__name__)
@@ -30,149 +29,170 @@ class AlignmentAnalysisResult:
 
 
 class AlignmentStreamAnalyzer:
-    def __init__(self, tfmr, queue, text_tokens_slice, alignment_layer_idx=9, eos_idx=0):
+    def __init__(self, eos_idx=0, history=32):
         """
         Some transformer TTS models implicitly solve text-speech alignment in one or more of their self-attention
         activation maps. This module exploits this to perform online integrity checks which streaming.
-        A hook is injected into the specified attention layer, and heuristics are used to determine alignment
-        position, repetition, etc.
+        The attention maps of the heads listed in `attn_heads` are fed in with `observe` after every forward
+        pass, and heuristics are used to determine alignment position, repetition, etc.
 
-        NOTE: currently requires no queues.
+        The analyzer is long-lived: `reset` prepares it for a new utterance (buffers are reused, and only grow
+        when a longer text comes along). All state stays on the attention device and every statistic is updated
+        incrementally, so `step` costs the same at frame 1000 as at frame 1 and never waits on the device.
+        The alignment itself is kept in a ring buffer of the last `history` frames, see `alignment`.
         """
-        # self.queue = queue
-        self.text_tokens_slice = (i, j) = text_tokens_slice
         self.eos_idx = eos_idx
-        self.alignment = torch.zeros(0, j-i)
-        # self.alignment_bin = torch.zeros(0, j-i)
-        self.curr_frame_pos = 0
-        self.text_position = 0
+        self.history = history
 
-        self.started = False
-        self.started_at = None
+        # Using `output_attentions=True` is incompatible with optimized attention kernels, so
+        # the decoder only materialises the attention probabilities of the heads we ask for
+        self.attn_heads = tuple(LLAMA_ALIGNED_HEADS)
+        self.last_aligned_attns = [None] * len(LLAMA_ALIGNED_HEADS)
 
-        self.complete = False
-        self.completed_at = None
-        
-        # Track generated tokens for repetition detection
-        self.generated_tokens = []
+        self._ring = None  # (history, max text len) alignment rows, written at `n_frames % history`
+        self.text_tokens_slice = None
 
-        # Using `output_attentions=True` is incompatible with optimized attention kernels, so
-        # using it for all layers slows things down too much. We can apply it to just one layer
-        # by intercepting the kwargs and adding a forward hook (credit: jrm)
-        self.last_aligned_attns = []
-        for i, (layer_idx, head_idx) in enumerate(LLAMA_ALIGNED_HEADS):
-            self.last_aligned_attns += [None]
-            self._add_attention_spy(tfmr, i, layer_idx, head_idx)
-
-    def _add_attention_spy(self, tfmr, buffer_idx, layer_idx, head_idx):
+    def reset(self, text_tokens_slice, device):
+        "Start analyzing a new utterance whose text tokens sit at `text_tokens_slice` of the prefix."
+        self.text_tokens_slice = (i, j) = text_tokens_slice
+        S = j - i
+        if self._ring is None or self._ring.device != torch.device(device) or self._ring.size(1) < S:
+            self._ring = torch.zeros(self.history, S, device=device)
+        else:
+            self._ring.zero_()
+        self.last_aligned_attns = [None] * len(self.attn_heads)
+
+        self.curr_frame_pos = 0
+        self.n_frames = 0
+        self.n_tokens = 0
+
+        zero = lambda dtype=torch.float32: torch.zeros((), dtype=dtype, device=device)
+        self.text_position = zero(torch.long)
+        self.started = zero(torch.bool)
+        self.complete = zero(torch.bool)
+        # max activation over the first 4 text tokens, across all frames
+        self._first_tokens_max = zero()
+        # activations accumulated since completion: per last-3-token column sums, and summed row maxima of
+        # the other tokens
+        self._tail_sums = torch.zeros(min(S, 3), device=device)
+        self._repetition_sum = zero()
+        # the last two tokens seen by `step`, for token-level repetition
+        self._last_tokens = torch.full((2,), -1, dtype=torch.long, device=device)
+        # long_tail, alignment_repetition, token_repetition; sticky once set
+        self._forced = torch.zeros(3, dtype=torch.bool, device=device)
+        return self
+
+    @property
+    def forced_eos(self) -> bool:
+        "Whether `step` has overridden the logits to force an EOS (syncs with the device)."
+        return bool(self._forced.any())
+
+    @property
+    def forced_reasons(self) -> dict:
+        long_tail, alignment_repetition, token_repetition = self._forced.tolist()
+        return dict(long_tail=long_tail, alignment_repetition=alignment_repetition, token_repetition=token_repetition)
+
+    @property
+    def progress(self) -> float:
+        "Alignment position as a fraction of the text tokens, in [0, 1) (syncs with the device)."
+        i, j = self.text_tokens_slice
+        return int(self.text_position) / (j - i)
+
+    @property
+    def alignment(self):
+        "The last `min(n_frames, history)` alignment rows, oldest first, (T, S)."
+        i, j = self.text_tokens_slice
+        n = min(self.n_frames, self.history)
+        rows = torch.arange(self.n_frames - n, self.n_frames, device=self._ring.device) % self.history
+        return self._ring[rows, :j - i]
+
+    def observe(self, attentions, row=0):
         """
-        Adds a forward hook to a specific attention layer to collect outputs.
+        Records the aligned heads from {(layer_idx, head_idx): attention probs (B, T0, Ti)}, as returned by
+        `StaticKVDecoder.prefill` (T0 = number of prefilled positions) / `StaticKVDecoder.step` (T0 = 1); `row` is
+        the batch row of the (conditional) sequence being analyzed.
         """
-        def attention_forward_hook(module, input, output):
-            """
-            See `LlamaAttention.forward`; the output is a 3-tuple: `attn_output, attn_weights, past_key_value`.
-            NOTE:
-            - When `output_attentions=True`, `LlamaSdpaAttention.forward` calls `LlamaAttention.forward`.
-            - `attn_output` has shape [B, H, T0, T0] for the 0th entry, and [B, H, 1, T0+i] for the rest i-th.
-            """
-            if isinstance(output, tuple) and len(output) > 1 and output[1] is not None:
-                step_attention = output[1].cpu()  # (B, n_heads, T0, Ti)
-                self.last_aligned_attns[buffer_idx] = step_attention[0, head_idx]  # (T0, Ti)
-
-        target_layer = tfmr.layers[layer_idx].self_attn
-        # Register hook and store the handle
-        target_layer.register_forward_hook(attention_forward_hook)
-        if hasattr(tfmr, 'config') and hasattr(tfmr.config, 'output_attentions'):
-            self.original_output_attentions = tfmr.config.output_attentions
-            tfmr.config.output_attentions = True
+        for buffer_idx, key in enumerate(self.attn_heads):
+            self.last_aligned_attns[buffer_idx] = attentions[key][row]  # (T0, Ti)
 
     def step(self, logits, next_token=None):
         """
-        Emits an AlignmentAnalysisResult into the output queue, and potentially modifies the logits to force an EOS.
+        Updates the alignment state with the attention recorded by `observe`, and potentially modifies the logits
+        to force an EOS. `next_token` is the last generated token (a tensor, to avoid a device sync).
         """
         # extract approximate alignment matrix chunk (1 frame at a time after the first chunk)
-        aligned_attn = torch.stack(self.last_aligned_attns).mean(dim=0) # (N, N)
+        aligned_attn = torch.stack(self.last_aligned_attns).mean(dim=0).float() # (N, N)
         i, j = self.text_tokens_slice
+        S = j - i
         if self.curr_frame_pos == 0:
-            # first chunk has conditioning info, text tokens, and BOS token
-            A_chunk = aligned_attn[j:, i:j].clone().cpu() # (T, S)
+            # first chunk has conditioning info, text tokens, and BOS token; only the positions after the text
+            # matter, counted from the end since a cached prefix may not have been prefilled
+            A_chunk = aligned_attn[j - aligned_attn.size(-1):, i:j] # (T, S)
         else:
             # subsequent chunks have 1 frame due to KV-caching
-            A_chunk = aligned_attn[:, i:j].clone().cpu() # (1, S)
+            A_chunk = aligned_attn[:, i:j] # (1, S)
 
         # TODO: monotonic masking; could have issue b/c spaces are often skipped.
-        A_chunk[:, self.curr_frame_pos + 1:] = 0
-
-
-        self.alignment = torch.cat((self.alignment, A_chunk), dim=0)
+        A_chunk = A_chunk.masked_fill(torch.arange(S, device=A_chunk.device) > self.curr_frame_pos, 0)
 
-        A = self.alignment
-        T, S = A.shape
+        # only the last `history` frames of a long chunk fit in the ring
+        T = A_chunk.size(0)
+        n = min(T, self.history)
+        rows = torch.arange(self.n_frames + T - n, self.n_frames + T, device=A_chunk.device) % self.history
+        self._ring[:, :S].index_copy_(0, rows, A_chunk[-n:])
+        self.n_frames += T
 
         # update position
         cur_text_posn = A_chunk[-1].argmax()
-        discontinuity = not(-4 < cur_text_posn - self.text_position < 7) # NOTE: very lenient!
-        if not discontinuity:
-            self.text_position = cur_text_posn
+        delta = cur_text_posn - self.text_position
+        discontinuity = (delta <= -4) | (delta >= 7) # NOTE: very lenient!
+        self.text_position = torch.where(discontinuity, self.text_position, cur_text_posn)
 
         # Hallucinations at the start of speech show up as activations at the bottom of the attention maps!
         # To mitigate this, we just wait until there are no activations far off-diagonal in the last 2 tokens,
         # and there are some strong activations in the first few tokens.
-        false_start = (not self.started) and (A[-2:, -2:].max() > 0.1 or A[:, :4].max() < 0.5)
-        self.started = not false_start
-        if self.started and self.started_at is None:
-            self.started_at = T
+        self._first_tokens_max = torch.maximum(self._first_tokens_max, A_chunk[:, :4].max())
+        last_rows = self.alignment[-2:]
+        false_start = ~self.started & ((last_rows[:, -2:].max() > 0.1) | (self._first_tokens_max < 0.5))
+        self.started = ~false_start
 
-        # Is generation likely complete?
-        self.complete = self.complete or self.text_position >= S - 3
-        if self.complete and self.completed_at is None:
-            self.completed_at = T
+        # Frames after the one where generation was first deemed complete count towards the tail heuristics.
+        was_complete = self.complete
+        self._tail_sums += was_complete * A_chunk[:, -3:].sum(dim=0)
+        if S > 5:
+            self._repetition_sum += was_complete * A_chunk[:, :-5].max(dim=1).values.sum()
 
-        # NOTE: EOS rarely assigned activations, and second-last token is often punctuation, so use last 3 tokens.
-        # NOTE: due to the false-start behaviour, we need to make sure we skip activations for the first few tokens.
-        last_text_token_duration = A[15:, -3:].sum()
+        # Is generation likely complete?
+        self.complete = self.complete | (self.text_position >= S - 3)
 
         # Activations for the final token that last too long are likely hallucinations.
-        long_tail = self.complete and (A[self.completed_at:, -3:].sum(dim=0).max() >= 5) # 200ms
+        long_tail = self.complete & (self._tail_sums.max() >= 5) # 200ms
 
         # If there are activations in previous tokens after generation has completed, assume this is a repetition error.
-        alignment_repetition = self.complete and (A[self.completed_at:, :-5].max(dim=1).values.sum() > 5)
-        
+        alignment_repetition = self.complete & (self._repetition_sum > 5)
+
         # Track generated tokens for repetition detection
         if next_token is not None:
-            # Convert tensor to scalar if needed
-            if isinstance(next_token, torch.Tensor):
-                token_id = next_token.item() if next_token.numel() == 1 else next_token.view(-1)[0].item()
-            else:
-                token_id = next_token
-            self.generated_tokens.append(token_id)
-            
-            # Keep only last 8 tokens to prevent memory issues
-            if len(self.generated_tokens) > 8:
-                self.generated_tokens = self.generated_tokens[-8:]
-            
+            token = torch.as_tensor(next_token, device=self._last_tokens.device).view(-1)[:1]
+            self._last_tokens = torch.cat([self._last_tokens[1:], token])
+            self.n_tokens += 1
+
         # Check for excessive token repetition (3x same token in a row)
-        token_repetition = (
-            # self.complete and 
-            len(self.generated_tokens) >= 3 and
-            len(set(self.generated_tokens[-2:])) == 1
-        )
-        
-        if token_repetition:
-            repeated_token = self.generated_tokens[-1]
-            logger.warning(f"🚨 Detected 2x repetition of token {repeated_token}")
-            
+        token_repetition = (self._last_tokens[0] == self._last_tokens[1]) & (self.n_tokens >= 3)
+
         # Suppress EoS to prevent early termination
-        if cur_text_posn < S - 3 and S > 5:  # Only suppress if text is longer than 5 tokens
-            logits[..., self.eos_idx] = -2**15
+        if S > 5:  # Only suppress if text is longer than 5 tokens
+            suppress = cur_text_posn < S - 3
+            logits[..., self.eos_idx] = torch.where(suppress, -2**15, logits[..., self.eos_idx])
 
         # If a bad ending is detected, force emit EOS by modifying logits
         # NOTE: this means logits may be inconsistent with latents!
-        if long_tail or alignment_repetition or token_repetition:
-            logger.warning(f"forcing EOS token, {long_tail=}, {alignment_repetition=}, {token_repetition=}")
-            # (±2**15 is safe for all dtypes >= 16bit)
-            logits = -(2**15) * torch.ones_like(logits)
-            logits[..., self.eos_idx] = 2**15
+        force = torch.stack([long_tail, alignment_repetition, token_repetition])
+        self._forced |= force
+        # (±2**15 is safe for all dtypes >= 16bit)
+        forced_logits = torch.full_like(logits, -2**15)
+        forced_logits[..., self.eos_idx] = 2**15
+        logits = torch.where(force.any(), forced_logits, logits)
 
         self.curr_frame_pos += 1
         return logits
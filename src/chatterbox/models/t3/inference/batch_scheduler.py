@@ -0,0 +1,401 @@
+import logging
+import queue
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import torch
+from torch import Tensor
+
+from ..modules.cond_enc import T3Cond
+from .alignment_stream_analyzer import LLAMA_ALIGNED_HEADS
+from .cfg_schedule import CFGSchedule
+from .sampler import sample_tokens, seen_mask
+from .static_kv_decoder import StaticKVCache
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DecodeSequence:
+    """
+    One utterance decoded by `T3BatchScheduler`; created by `T3BatchScheduler.add`.
+    """
+    t3_cond: T3Cond
+    # (n_rows, len_text): 2 rows (cond / uncond) for CFG on the Llama models, else 1 row
+    text_tokens: Tensor
+    cfg_weight: float
+    temperature: float
+    top_p: float
+    min_p: float
+    top_k: int
+    repetition_penalty: float
+    max_new_tokens: int
+    chunk_size: int
+    first_chunk_size: Optional[int]
+    # per-sequence RNG, so sampled tokens don't depend on what else shares the batch
+    generator: Optional[torch.Generator] = None
+    cfg_schedule: CFGSchedule = field(default_factory=CFGSchedule)
+
+    # chunks are also put here, for consumers on other threads (see `T3BatchScheduler.stream`)
+    chunks: "queue.Queue" = field(default_factory=queue.Queue)
+    done: bool = False
+    stop_reason: Optional[str] = None
+    error: Optional[BaseException] = None  # set if the sequence couldn't be admitted (its only chunk queued)
+
+    # decoding state, owned by the scheduler
+    rows: List[int] = field(default_factory=list)
+    position: int = 0  # KV slot of the next input token
+    generated: List[Tensor] = field(default_factory=list)  # (1, 1) tokens, excluding EOS
+    seen: Optional[Tensor] = None  # (1, V) bool, tokens the repetition penalty applies to
+    pending: List[Tensor] = field(default_factory=list)  # sampled tokens not emitted yet
+    offset: int = 0
+    hidden: Optional[Tensor] = None  # (n_rows, C) hidden state to sample the next token from
+    analyzer: Optional[object] = None
+    guided_steps: int = 0
+
+    @property
+    def n_rows(self):
+        return self.text_tokens.size(0)
+
+
+class T3BatchScheduler:
+    """
+    Iteration-level ("continuous") batching for T3 decoding: sequences join a running decode batch as soon as KV
+    rows are free, and leave it individually at EOS, instead of waiting for the whole batch to finish.
+        * the KV cache is a single `StaticKVCache` of `max_rows` rows; a sequence owns 1 row (turbo) or 2 rows
+            (CFG cond / uncond). New sequences are prefilled on their own, then copied into their rows.
+        * every step decodes all rows at once with `StaticKVDecoder.step_rows`, each row at its own position;
+            decoding a single sequence is memory-bound, so the extra rows are nearly free.
+        * sampling parameters, the repetition penalty history, the RNG and (multilingual) the alignment analyzer
+            are per sequence; all sequences are sampled together by `sample_tokens`, with per-row parameters.
+        * a `CFGSchedule` limits which steps of a sequence are guided; its uncond row keeps decoding in between
+            (being batched, it costs next to nothing), and is given back to the pool once guidance is over.
+
+    Drive it synchronously with `add` + `run`, or call `start` once and use `stream` from any thread.
+    NOTE: the KV cache takes max_rows * capacity * n_layers * 2 * hidden_size values; a request whose prefix plus
+    `max_new_tokens` doesn't fit in `capacity` gets fewer new tokens.
+    """
+
+    def __init__(self, t3, max_rows: int = 8, capacity: int = 2048):
+        self.t3 = t3
+        self.max_rows = max_rows
+        self.capacity = capacity
+        self.cache: Optional[StaticKVCache] = None  # allocated on first use, on the model's device / dtype
+        self.free_rows = list(range(max_rows))
+        self.waiting = deque()
+        self.active: List[DecodeSequence] = []
+        self.lock = threading.Lock()
+        self._wakeup = threading.Condition(self.lock)
+        self._thread = None
+        self.steps = 0
+        # heads read by the alignment analyzers (multilingual only)
+        self.attn_heads = tuple(LLAMA_ALIGNED_HEADS) if t3.hp.is_multilingual else ()
+
+    # ---- submission ----
+
+    def add(
+        self,
+        t3_cond: T3Cond,
+        text_tokens: Tensor,
+        *,
+        cfg_weight=0.5,
+        temperature=0.8,
+        top_p=0.95,
+        min_p=0.05,
+        top_k=1000,
+        repetition_penalty=1.2,
+        max_new_tokens=1000,
+        chunk_size=25,
+        first_chunk_size=None,
+        generator=None,
+        cfg_schedule: Optional[CFGSchedule] = None,
+    ) -> DecodeSequence:
+        """
+        Queues an utterance; it is admitted into the batch by the next `step` with enough free rows. The inputs
+        are the ones of `T3.inference_stream` (Llama models, `text_tokens` doubled for CFG) or
+        `T3.inference_turbo_stream` (turbo; `cfg_weight` and `min_p` are ignored).
+        """
+        text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=self.t3.device)
+        cfg_schedule = cfg_schedule or CFGSchedule()
+        if cfg_schedule.window is not None and not self.t3.hp.is_multilingual:
+            raise ValueError("a CFG alignment window needs the alignment analyzer (multilingual models only)")
+        if self.t3.is_gpt or cfg_weight <= 0.0 or cfg_schedule.finished(0, 0.0):
+            text_tokens = text_tokens[:1]  # no CFG, a single row
+        assert text_tokens.size(0) <= self.max_rows, "sequence needs more KV rows than the scheduler has"
+        seq = DecodeSequence(
+            t3_cond=t3_cond, text_tokens=text_tokens, cfg_weight=cfg_weight, temperature=temperature, top_p=top_p,
+            min_p=min_p, top_k=top_k, repetition_penalty=repetition_penalty, max_new_tokens=max_new_tokens,
+            chunk_size=chunk_size, first_chunk_size=first_chunk_size, generator=generator, cfg_schedule=cfg_schedule,
+        )
+        with self.lock:
+            self.waiting.append(seq)
+            self._wakeup.notify()
+        return seq
+
+    def stream(self, t3_cond: T3Cond, text_tokens: Tensor, **kwargs):
+        """
+        Generator of `SpeechTokenChunk`s for one utterance, decoded by the background loop (see `start`).
+        Closing the generator early retires the sequence at the next step.
+        """
+        seq = self.add(t3_cond, text_tokens, **kwargs)
+        try:
+            while True:
+                chunk = seq.chunks.get()
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                yield chunk
+                if chunk.is_last:
+                    return
+        finally:
+            seq.done = True
+
+    # ---- driving ----
+
+    @property
+    def has_work(self):
+        return bool(self.waiting or self.active)
+
+    def run(self):
+        "Decodes until every queued sequence is done; yields `(sequence, SpeechTokenChunk)` as chunks complete."
+        while self.has_work:
+            yield from self.step()
+
+    def start(self):
+        "Runs the decode loop on a background thread (idempotent)."
+        with self.lock:
+            if self._thread is not None and self._thread.is_alive():
+                return self
+            self._thread = threading.Thread(target=self._loop, name="t3-batch-scheduler", daemon=True)
+            self._thread.start()
+        return self
+
+    def _loop(self):
+        while True:
+            with self.lock:
+                while not (self.waiting or self.active):
+                    self._wakeup.wait()
+            try:
+                for _ in self.step():
+                    pass
+            except Exception as e:
+                logger.exception("T3 batch step failed, dropping the running batch")
+                for seq in self.active + list(self.waiting):
+                    seq.chunks.put(e)
+                with self.lock:
+                    self.waiting.clear()
+                self._retire_all()
+
+    @torch.inference_mode()
+    def step(self):
+        """
+        One decoding iteration: admit waiting sequences, sample one token for every active sequence, retire
+        finished ones and run the batched forward pass. Returns the `(sequence, chunk)` pairs emitted.
+        """
+        from ..t3 import SpeechTokenChunk
+
+        t3 = self.t3
+        emitted = []
+
+        def emit(seq, tokens, is_last=False):
+            chunk = SpeechTokenChunk(
+                tokens, seq.offset, is_last=is_last, stop_reason=seq.stop_reason,
+                guided_steps=seq.guided_steps if is_last else None,
+            )
+            seq.offset += tokens.size(1)
+            seq.chunks.put(chunk)
+            emitted.append((seq, chunk))
+
+        self._admit()
+        if not self.active:
+            return emitted
+
+        # ---- sample one token per sequence ----
+        hidden = torch.cat([seq.hidden for seq in self.active])
+        all_logits = t3.speech_logits(hidden).split([seq.n_rows for seq in self.active])
+        logits, seen = zip(*[self._guide(seq, seq_logits) for seq, seq_logits in zip(self.active, all_logits)])
+        tokens, invalid = sample_tokens(
+            torch.cat(logits),
+            seen=torch.cat(seen),
+            temperature=[seq.temperature for seq in self.active],
+            top_k=[seq.top_k if t3.is_gpt else 0 for seq in self.active],
+            top_p=[seq.top_p for seq in self.active],
+            min_p=[0.0 if t3.is_gpt else seq.min_p for seq in self.active],
+            repetition_penalty=[seq.repetition_penalty for seq in self.active],
+            penalty_last=t3.is_gpt,
+            generator=[seq.generator for seq in self.active],
+        )
+        token_ids = tokens.view(-1).tolist()  # single sync for the whole batch
+        # (the standard chain never checked for this)
+        invalid = invalid.tolist() if t3.is_gpt else [False] * len(token_ids)
+        tokens = tokens.split(1)
+
+        still_active = []
+        for seq, token, token_id, bad in zip(self.active, tokens, token_ids, invalid):
+            if seq.done:  # consumer went away
+                seq.stop_reason = "cancelled"
+            elif bad:
+                logger.warning("Warning: All logits are -inf")
+                seq.stop_reason = "invalid_logits"
+            elif token_id == t3.hp.stop_speech_token:
+                forced = seq.analyzer is not None and seq.analyzer.forced_eos
+                if forced:
+                    logger.warning(f"EOS was forced by the alignment analyzer: {seq.analyzer.forced_reasons}")
+                seq.stop_reason = "alignment" if forced else "eos"
+            else:
+                if t3.is_gpt and not seq.generated:
+                    seq.seen.zero_()  # the start token only counts for the first token
+                seq.generated.append(token)
+                seq.seen.scatter_(1, token, True)
+                seq.pending.append(token)
+                if len(seq.generated) >= seq.max_new_tokens:
+                    seq.stop_reason = "max_tokens"
+                elif seq.n_rows > 1 and seq.cfg_schedule.finished(len(seq.generated), self._progress(seq)):
+                    self._drop_uncond(seq)
+
+            if seq.stop_reason is not None:
+                last = torch.cat(seq.pending, dim=1) if seq.pending else token.new_zeros(1, 0)
+                seq.pending = []
+                emit(seq, last, is_last=True)
+                self._retire(seq)
+                continue
+
+            chunk_size = (seq.first_chunk_size or seq.chunk_size) if seq.offset == 0 else seq.chunk_size
+            if len(seq.pending) >= chunk_size:
+                emit(seq, torch.cat(seq.pending, dim=1))
+                seq.pending = []
+            still_active.append(seq)
+        self.active = still_active
+        if not self.active:
+            return emitted
+
+        # ---- batched forward pass over all rows, each at its own position ----
+        device = hidden.device
+        inputs_embeds = hidden.new_zeros(self.max_rows, 1, hidden.size(-1))
+        positions = torch.zeros(self.max_rows, dtype=torch.long)
+        for seq in self.active:
+            embed = self._embed_token(seq.generated[-1], len(seq.generated))
+            for row in seq.rows:
+                inputs_embeds[row] = embed[0]
+                positions[row] = seq.position
+            seq.position += 1
+        hidden, attns = t3.decoder.step_rows(self.cache, inputs_embeds, positions.to(device), self.attn_heads)
+        for seq in self.active:
+            seq.hidden = hidden[seq.rows, -1]
+            if seq.analyzer is not None:
+                seq.analyzer.observe(attns, row=seq.rows[0])
+        self.steps += 1
+        return emitted
+
+    # ---- internals ----
+
+    def _admit(self):
+        while True:
+            with self.lock:
+                if not self.waiting or len(self.free_rows) < self.waiting[0].n_rows:
+                    return
+                seq = self.waiting.popleft()
+                seq.rows, self.free_rows = self.free_rows[:seq.n_rows], self.free_rows[seq.n_rows:]
+            if seq.done:
+                self._retire(seq)
+                continue
+            try:
+                self._prefill(seq)
+            except Exception as e:
+                # the sequence is in neither `waiting` nor `active`: fail it alone and give its rows back
+                logger.exception("T3 batch admission failed")
+                self._retire(seq)
+                seq.stop_reason, seq.error = "error", e
+                seq.chunks.put(e)
+                continue
+            self.active.append(seq)
+
+    def _prefill(self, seq):
+        "Prefills the prefix of `seq` and copies it into the rows of the sequence."
+        t3 = self.t3
+        # same prefix as `T3.inference_stream` / `T3.inference_turbo_stream`
+        speech_start = t3.hp.start_speech_token * torch.ones_like(seq.text_tokens[:, :1])
+        speech_embeds = t3.prepare_speech_embeds(speech_start)
+        if not t3.is_gpt:
+            bos_embed = self._embed_token(speech_start[:1], 0)
+            speech_embeds = torch.cat([speech_embeds, bos_embed.expand(seq.n_rows, -1, -1)], dim=1)
+
+        # prefilled on its own, then copied into the rows of the sequence
+        max_len_cond = 2 + t3.hp.speech_cond_prompt_len  # speaker + prompt (at most) + emotion
+        seq_cache = t3.decoder.new_cache(seq.n_rows, max_len_cond + seq.text_tokens.size(1) + speech_embeds.size(1))
+        hidden, attns, len_cond = t3.prefill_prefix(
+            seq_cache,
+            t3_cond=seq.t3_cond,
+            text_tokens=seq.text_tokens,
+            speech_embeds=speech_embeds,
+            cfg_weight=seq.cfg_weight if seq.n_rows > 1 else 0.0,
+            attn_heads=self.attn_heads,
+        )
+        if self.cache is None:
+            self.cache = t3.decoder.new_cache(self.max_rows, self.capacity)
+        self.cache.copy_rows_from(seq_cache, torch.tensor(seq.rows, device=hidden.device))
+        seq.position = seq_cache.length
+        seq.hidden = hidden[:, -1]
+        seq.seen = seen_mask(speech_start[:1], t3.n_speech_logits)
+
+        if seq.position + seq.max_new_tokens > self.cache.capacity:
+            seq.max_new_tokens = self.cache.capacity - seq.position
+            logger.warning(f"T3 batch capacity reached, limiting to {seq.max_new_tokens} new tokens")
+
+        if t3.hp.is_multilingual:
+            seq.analyzer = t3._acquire_analyzer((len_cond, len_cond + seq.text_tokens.size(-1)))
+            seq.analyzer.observe(attns)
+
+    def _retire(self, seq):
+        if seq.analyzer is not None:
+            self.t3._release_analyzer(seq.analyzer)
+            seq.analyzer = None
+        seq.done = True
+        seq.hidden = None
+        with self.lock:
+            self.free_rows += seq.rows
+        seq.rows = []
+
+    def _drop_uncond(self, seq):
+        "Guidance is over for `seq`: its uncond row goes back to the pool."
+        with self.lock:
+            self.free_rows += seq.rows[1:]
+        seq.rows = seq.rows[:1]
+        seq.text_tokens = seq.text_tokens[:1]
+
+    def _retire_all(self):
+        for seq in self.active:
+            self._retire(seq)
+        self.active = []
+
+    def _embed_token(self, token, idx):
+        t3 = self.t3
+        embed = t3.speech_emb(token)
+        if not t3.is_gpt:
+            embed = embed + t3.speech_pos_emb.get_fixed_embedding(idx)
+        return embed  # (1, 1, C)
+
+    def _guide(self, seq, logits):
+        "Per-sequence logits, (1, V), and the tokens its repetition penalty applies to, (1, V)."
+        t3 = self.t3
+        if not t3.is_gpt:
+            # CFG combine → (1, V)
+            cond, uncond = logits[0:1], logits[1:2]
+            if seq.n_rows > 1 and seq.cfg_schedule.guided(len(seq.generated), self._progress(seq)):
+                logits = cond + seq.cfg_weight * (cond - uncond)
+                seq.guided_steps += 1
+            else:
+                logits = cond
+            if seq.analyzer is not None:
+                last = seq.generated[-1] if seq.generated else seq.text_tokens.new_full((1, 1), t3.hp.start_speech_token)
+                logits = seq.analyzer.step(logits, next_token=last[0, -1])
+        return logits, seq.seen
+
+    @staticmethod
+    def _progress(seq):
+        "Alignment position of `seq`, for CFG windows only (syncs with the device)."
+        if seq.cfg_schedule.window is None or seq.analyzer is None:
+            return None
+        return seq.analyzer.progress
@@ -0,0 +1,77 @@
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+
+@dataclass(frozen=True)
+class CFGSchedule:
+    """
+    Which T3 decoding steps apply classifier-free guidance; the other steps sample from the conditional logits
+    alone. The default guides every step (plain CFG). A step is guided when all of the set conditions hold:
+        * `max_steps`: only the first `max_steps` tokens
+        * `every`: only every `every`-th token (steps 0, every, 2 * every, ...)
+        * `window`: only while the alignment position, as a fraction of the text tokens, is within
+            [start, end); needs the alignment analyzer, i.e. a multilingual model
+    Once no later step can be guided (past `max_steps`, or the alignment past the end of `window`), the
+    unconditional row is dropped and its KV freed.
+    """
+    max_steps: Optional[int] = None
+    every: int = 1
+    window: Optional[Tuple[float, float]] = None
+
+    def __post_init__(self):
+        assert self.every >= 1, "`every` must be >= 1"
+        assert self.max_steps is None or self.max_steps >= 0, "`max_steps` must be >= 0"
+        if self.window is not None:
+            start, end = self.window
+            assert 0.0 <= start < end, "`window` must be (start, end) with 0 <= start < end"
+
+    @classmethod
+    def parse(cls, spec: Optional[str]) -> "CFGSchedule":
+        """
+        From a comma-separated spec, e.g. "first=200", "every=2", "window=0:0.5" or "first=300,every=2";
+        empty / None / "full" is the default (every step).
+        """
+        kwargs = {}
+        for item in (spec or "").replace(" ", "").split(","):
+            if item in ("", "full"):
+                continue
+            key, _, value = item.partition("=")
+            if key == "first":
+                kwargs["max_steps"] = int(value)
+            elif key == "every":
+                kwargs["every"] = int(value)
+            elif key == "window":
+                start, _, end = value.partition(":")
+                kwargs["window"] = (float(start), float(end))
+            else:
+                raise ValueError(f"unknown CFG schedule item: {item!r}")
+        return cls(**kwargs)
+
+    @property
+    def is_full(self):
+        "Guides every step."
+        return self.max_steps is None and self.every == 1 and self.window is None
+
+    @property
+    def lockstep(self):
+        """
+        Whether guidance, while it lasts, applies to every consecutive step: the unconditional row is then decoded
+        together with the conditional one; otherwise it only catches up on the guided steps.
+        """
+        return self.every == 1 and self.window is None
+
+    def guided(self, step: int, progress: Optional[float] = None) -> bool:
+        "Whether step `step` (0-based token index) is guided; `progress` is the alignment position in [0, 1]."
+        if self.max_steps is not None and step >= self.max_steps:
+            return False
+        if step % self.every:
+            return False
+        if self.window is not None and not (self.window[0] <= progress < self.window[1]):
+            return False
+        return True
+
+    def finished(self, step: int, progress: Optional[float] = None) -> bool:
+        "Whether no step from `step` on will be guided (the alignment position is assumed not to go back)."
+        if self.max_steps is not None and step >= self.max_steps:
+            return True
+        return self.window is not None and progress >= self.window[1]
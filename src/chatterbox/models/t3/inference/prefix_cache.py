@@ -0,0 +1,197 @@
+import hashlib
+import threading
+import time
+from typing import List, Optional, Sequence
+
+import torch
+from torch import Tensor
+
+from ..modules.cond_enc import T3Cond
+from .static_kv_decoder import StaticKVCache
+
+
+def voice_key(t3_cond: T3Cond) -> str:
+    "Content hash of everything in `t3_cond` that ends up in the conditioning prefix."
+    h = hashlib.sha256()
+    for name in ("speaker_emb", "clap_emb", "cond_prompt_speech_tokens", "emotion_adv"):
+        value = getattr(t3_cond, name)
+        if torch.is_tensor(value):
+            value = value.detach().cpu().contiguous()
+            h.update(f"|{name}:{value.dtype}:{tuple(value.shape)}".encode())
+            h.update(value.numpy().tobytes() if value.dtype != torch.bfloat16 else value.float().numpy().tobytes())
+        else:
+            h.update(f"|{name}={value!r}".encode())
+    return h.hexdigest()
+
+
+class _Node:
+    """
+    Radix tree node: the KV of a run of prefix positions, `k` / `v` being one (rows, n_kv_heads, len, head_dim)
+    tensor per layer.
+        * voice roots hold the conditioning prefix, with a single row: it is the same for the CFG cond / uncond rows
+        * below them, the edges are runs of text tokens, separately for each number of rows (1, or 2 with CFG)
+    """
+
+    __slots__ = ("tokens", "k", "v", "parent", "children", "last_used")
+
+    def __init__(self, tokens: Sequence[int], k: List[Tensor], v: List[Tensor], parent: Optional["_Node"]):
+        self.tokens = tuple(tokens)
+        self.k = k
+        self.v = v
+        self.parent = parent
+        self.children = {}  # first token -> _Node; (n_rows, first token) -> _Node below voice roots
+        self.last_used = time.monotonic()
+
+    @property
+    def length(self):
+        return self.k[0].size(2)
+
+    @property
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for t in self.k + self.v)
+
+    def split(self, n: int) -> "_Node":
+        "Keeps the first `n` positions here, moves the rest to a new child, which is returned."
+        child = _Node(
+            self.tokens[n:], [t[:, :, n:].clone() for t in self.k], [t[:, :, n:].clone() for t in self.v], self,
+        )
+        child.children, self.children = self.children, {}
+        for grandchild in child.children.values():
+            grandchild.parent = child
+        child.last_used = self.last_used
+        self.tokens = self.tokens[:n]
+        self.k = [t[:, :, :n].clone() for t in self.k]
+        self.v = [t[:, :, :n].clone() for t in self.v]
+        self.children[child.tokens[0]] = child
+        return child
+
+
+class PrefixKVCache:
+    """
+    KV states of T3 prefill prefixes, [conditioning | text tokens], stored as a radix tree keyed by
+    (voice, text token prefix), so a request only prefills what follows its longest cached prefix:
+        * a known voice skips the conditioning encoder (speaker projection, Perceiver) and its prefill
+        * texts sharing an opening ("Thank you for calling ...") share the KV of the common tokens
+    The speech tokens that follow the text are never cached, so a lookup always leaves something to prefill.
+    Bounded by `max_bytes`; the least recently used leaves are evicted first. Thread-safe.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 2**20):
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self._voices = {}  # voice key -> root _Node
+        self._nbytes = 0
+        self.counters = dict(voice_hits=0, voice_misses=0, hit_tokens=0, miss_tokens=0, evictions=0)
+
+    def load(self, cache: StaticKVCache, voice: str, text_tokens: Sequence[int]):
+        """
+        Writes the longest cached prefix for `voice` + `text_tokens` into all rows of the empty `cache` and sets
+        `cache.length`. Returns (len_cond, n_text_tokens) of what was loaded; len_cond is None on a voice miss.
+        """
+        assert cache.length == 0
+        with self.lock:
+            root = self._voices.get(voice)
+            if root is None:
+                self.counters["voice_misses"] += 1
+                self.counters["miss_tokens"] += len(text_tokens)
+                return None, 0
+            self.counters["voice_hits"] += 1
+            path, n_tokens = self._match(root, cache.batch_size, text_tokens)
+
+            now = time.monotonic()
+            start = 0
+            for node, n in path:
+                self._write(cache, node, start, n)
+                node.last_used = now
+                start += n
+            cache.length = start
+            self.counters["hit_tokens"] += n_tokens
+            self.counters["miss_tokens"] += len(text_tokens) - n_tokens
+            return root.length, n_tokens
+
+    def store(self, cache: StaticKVCache, voice: str, text_tokens: Sequence[int], len_cond: int):
+        "Records the prefix KV held in `cache` (positions [0, len_cond + len(text_tokens)))."
+        text_tokens = tuple(text_tokens)
+        assert cache.length >= len_cond + len(text_tokens)
+        n_rows = cache.batch_size
+        with self.lock:
+            root = self._voices.get(voice)
+            if root is None:
+                root = self._voices[voice] = self._read(cache, (), 0, len_cond, parent=None, rows=slice(0, 1))
+            path, n_tokens = self._match(root, n_rows, text_tokens)
+            node, matched = path[-1]
+            if node is not root and matched < len(node.tokens):
+                node.split(matched)
+            if n_tokens < len(text_tokens):
+                leaf = self._read(cache, text_tokens[n_tokens:], len_cond + n_tokens, len_cond + len(text_tokens), node)
+                node.children[(n_rows, leaf.tokens[0]) if node is root else leaf.tokens[0]] = leaf
+            now = time.monotonic()
+            for node, _ in path:
+                node.last_used = now
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self._voices.clear()
+            self._nbytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counters, voices=len(self._voices), bytes=self._nbytes, budget=self.max_bytes)
+
+    # ---- internals ----
+
+    def _match(self, root: _Node, n_rows: int, text_tokens: Sequence[int]):
+        """
+        Nodes from `root` along `text_tokens` as (node, number of positions used; the last node may only partially
+        match), and the number of text tokens matched.
+        """
+        path, node, n = [(root, root.length)], root, 0
+        while n < len(text_tokens):
+            key = (n_rows, text_tokens[n]) if node is root else text_tokens[n]
+            child = node.children.get(key)
+            if child is None:
+                break
+            m = 0
+            while m < len(child.tokens) and n + m < len(text_tokens) and child.tokens[m] == text_tokens[n + m]:
+                m += 1
+            path.append((child, m))
+            n += m
+            if m < len(child.tokens):
+                break
+            node = child
+        return path, n
+
+    def _read(self, cache, tokens, start, end, parent, rows=slice(None)):
+        node = _Node(
+            tokens, [t[rows, :, start:end].clone() for t in cache.k], [t[rows, :, start:end].clone() for t in cache.v],
+            parent,
+        )
+        self._nbytes += node.nbytes
+        return node
+
+    @staticmethod
+    def _write(cache, node, start, n):
+        # voice roots have a single row, broadcast to every (CFG) row
+        for dst, src in zip(cache.k + cache.v, node.k + node.v):
+            dst[:, :, start:start + n].copy_(src[:, :, :n])
+
+    def _leaves(self):
+        stack = list(self._voices.values())
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(node.children.values())
+            else:
+                yield node
+
+    def _evict(self):
+        while self._nbytes > self.max_bytes and self._voices:
+            victim = min(self._leaves(), key=lambda node: node.last_used)
+            self._nbytes -= victim.nbytes
+            self.counters["evictions"] += 1
+            if victim.parent is None:
+                del self._voices[next(k for k, root in self._voices.items() if root is victim)]
+            else:
+                parent = victim.parent
+                del parent.children[next(k for k, child in parent.children.items() if child is victim)]
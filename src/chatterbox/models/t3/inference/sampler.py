@@ -0,0 +1,110 @@
+from typing import Optional, Sequence, Union
+
+import torch
+from torch import Tensor
+
+
+Param = Union[float, int, Sequence[float], Sequence[int]]
+
+
+def _per_row(value: Param, batch_size: int):
+    "A scalar or one value per row → list of `batch_size` python values."
+    if isinstance(value, (int, float)):
+        return [value] * batch_size
+    value = list(value)
+    assert len(value) == batch_size, f"expected {batch_size} values, got {len(value)}"
+    return value
+
+
+def seen_mask(input_ids: Tensor, vocab_size: int) -> Tensor:
+    "(B, n) token history → (B, V) bool mask of the tokens that occur in it."
+    seen = torch.zeros(input_ids.size(0), vocab_size, dtype=torch.bool, device=input_ids.device)
+    return seen.scatter_(1, input_ids, True)
+
+
+def _penalize(logits: Tensor, seen: Tensor, penalty: Tensor):
+    # same as `RepetitionPenaltyLogitsProcessor`: push the logits of seen tokens towards -inf
+    penalized = torch.where(logits < 0, logits * penalty, logits / penalty)
+    return torch.where(seen, penalized, logits)
+
+
+def sample_tokens(
+    logits: Tensor,
+    *,
+    seen: Tensor,
+    temperature: Param = 1.0,
+    top_k: Param = 0,
+    top_p: Param = 1.0,
+    min_p: Param = 0.0,
+    repetition_penalty: Param = 1.0,
+    penalty_last: bool = False,
+    generator: Union[None, torch.Generator, Sequence[Optional[torch.Generator]]] = None,
+):
+    """
+    Samples the next token of every row of `logits`, (B, V), in one pass over the batch; every sampling parameter
+    is either a scalar or one value per row. Equivalent to these chains of `transformers` logits processors:
+        * `T3.inference`: repetition penalty → temperature → min-p → top-p (`penalty_last=False`)
+        * `T3.inference_turbo`: temperature → top-k → top-p → repetition penalty (`penalty_last=True`)
+    Instead of sorting the whole vocabulary (twice for min-p + top-p), only the top-k candidates are sorted, or,
+    without top-k, the tokens that pass min-p; top-p and the late repetition penalty then work on those.
+    The filtered logits are scattered back into a full-vocabulary distribution before sampling, so with the same
+    RNG state the tokens match the processor chains.
+
+    Args:
+        seen: (B, V) bool, tokens the repetition penalty applies to (see `seen_mask`)
+        temperature: not applied when <= 0
+        top_k: <= 0 keeps the whole vocabulary
+        generator: one for all rows, or one per row (None: the default RNG)
+    Returns the tokens, (B, 1), and (B,) bool: whether every logit of the row was filtered out (its token is
+    then meaningless).
+    """
+    B, V = logits.shape
+    device = logits.device
+
+    def as_tensor(values):
+        return torch.tensor(values, dtype=logits.dtype, device=device)[:, None]
+
+    temperature = [t if t > 0 else 1.0 for t in _per_row(temperature, B)]
+    top_k = [min(k, V) if k > 0 else V for k in _per_row(top_k, B)]
+    top_p = as_tensor(_per_row(top_p, B))
+    min_p = _per_row(min_p, B)
+    penalty = as_tensor(_per_row(repetition_penalty, B))
+
+    if not penalty_last:
+        logits = _penalize(logits, seen, penalty)
+    if any(t != 1.0 for t in temperature):
+        logits = logits / as_tensor(temperature)
+
+    # candidates: the top-k tokens, or the ones with at least `min_p` times the probability of the best one
+    n_candidates = torch.tensor(top_k, device=device)
+    if any(p > 0 for p in min_p):
+        probs = torch.softmax(logits, dim=-1)
+        keep = probs >= as_tensor(min_p) * probs.max(dim=-1, keepdim=True).values
+        logits = logits.masked_fill(~keep, -float("inf"))
+        n_candidates = torch.minimum(n_candidates, keep.sum(dim=-1))
+        K = int(n_candidates.max())  # NOTE: syncs, but sorting the survivors only is worth it
+    else:
+        K = max(top_k)
+    cand_logits, cand_idx = logits.topk(K, dim=-1)  # sorted, descending
+    cand_logits = cand_logits.masked_fill(torch.arange(K, device=device) >= n_candidates[:, None], -float("inf"))
+
+    # top-p: drop the tail (lowest candidates) whose total probability is <= 1 - top_p, keep at least one token
+    tail_mass = cand_logits.flip(-1).softmax(dim=-1).cumsum(dim=-1).flip(-1)
+    drop = tail_mass <= 1 - top_p
+    drop[:, 0] = False
+    cand_logits = cand_logits.masked_fill(drop, -float("inf"))
+
+    if penalty_last:
+        cand_logits = _penalize(cand_logits, seen.gather(1, cand_idx), penalty)
+
+    invalid = torch.isneginf(cand_logits).all(dim=-1)
+    cand_logits = cand_logits.masked_fill(invalid[:, None], 0.0)  # keeps multinomial happy, result unused
+    full = torch.full_like(logits, -float("inf")).scatter_(1, cand_idx, cand_logits)
+    probs = torch.softmax(full, dim=-1)
+    if generator is None or isinstance(generator, torch.Generator):
+        tokens = torch.multinomial(probs, num_samples=1, generator=generator)
+    else:
+        tokens = torch.cat([
+            torch.multinomial(row, num_samples=1, generator=g) for row, g in zip(probs[:, None], generator)
+        ])
+    return tokens, invalid
@@ -0,0 +1,216 @@
+import math
+from typing import Dict, List, Sequence, Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+from transformers import GPT2Model
+from transformers.models.llama.modeling_llama import apply_rotary_pos_emb
+
+
+class StaticKVCache:
+    """
+    Fixed-capacity KV buffers for one decoding run, allocated once up front:
+        * `k`, `v`: one (B, n_kv_heads, capacity, head_dim) tensor per layer
+        * `length`: number of positions filled so far (by `prefill` / `step`; rows decoded with `step_rows`
+            track their own positions)
+    NOTE: separate tensors per layer, not one stacked buffer: under `torch.compile`, an in-place write into a
+    view of a graph input makes the whole base tensor get copied back on every step.
+    """
+
+    def __init__(self, n_layers, batch_size, n_kv_heads, capacity, head_dim, device, dtype):
+        shape = (batch_size, n_kv_heads, capacity, head_dim)
+        # zero-filled, not empty: masked slots still take part in `probs @ v`, and 0 * NaN would poison it
+        self.k = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(n_layers)]
+        self.v = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(n_layers)]
+        self.length = 0
+
+    @property
+    def batch_size(self):
+        return self.k[0].size(0)
+
+    @property
+    def capacity(self):
+        return self.k[0].size(2)
+
+    @property
+    def device(self):
+        return self.k[0].device
+
+    def narrow_rows(self, start: int, length: int) -> "StaticKVCache":
+        "A cache over rows [start, start + length) of this one, sharing its buffers (but not `length`)."
+        view = object.__new__(StaticKVCache)
+        view.k = [t[start:start + length] for t in self.k]
+        view.v = [t[start:start + length] for t in self.v]
+        view.length = self.length
+        return view
+
+    def clone_rows(self, start: int, length: int) -> "StaticKVCache":
+        "A copy of rows [start, start + length), with new buffers: this cache's can then be freed."
+        view = self.narrow_rows(start, length)
+        view.k = [t.clone() for t in view.k]
+        view.v = [t.clone() for t in view.v]
+        return view
+
+    def broadcast_row(self, row: int, length: int):
+        "Copies positions [0, length) of `row` to all other rows."
+        for t in self.k + self.v:
+            t[:, :, :length] = t[row:row + 1, :, :length].clone()
+
+    def copy_rows_from(self, src: "StaticKVCache", rows: Tensor):
+        "Copies all rows of `src` (at most the same capacity) into `rows` of this cache."
+        n = src.capacity
+        for dst_k, dst_v, src_k, src_v in zip(self.k, self.v, src.k, src.v):
+            dst_k[:, :, :n].index_copy_(0, rows, src_k)
+            dst_v[:, :, :n].index_copy_(0, rows, src_v)
+
+
+class StaticKVDecoder:
+    """
+    Runs the T3 backbone (`LlamaModel` or `GPT2Model`) layer by layer against a `StaticKVCache`, instead of
+    going through the HF forward with a `past_key_values` that is re-allocated on every token.
+        * `prefill` consumes a whole prefix (dynamic length, eager)
+        * `step` consumes a single token; all shapes are fixed by the cache capacity, so it can be wrapped
+            with `torch.compile` (see `compile`) without recompiling as the sequence grows
+        * `step_rows` is `step` with a position per batch row, for batches whose sequences have different
+            lengths (see `T3BatchScheduler`)
+    All return the final (normalised) hidden states, plus the attention probabilities of the (layer, head)
+    pairs listed in `attn_heads`. Those are computed separately; the layer outputs themselves always come from
+    SDPA, so no layer falls back to eager attention.
+
+    NOTE: this is not an `nn.Module` on purpose, it only borrows the weights of `tfmr`, which stays registered
+    (and saved / loaded) under `T3.tfmr`.
+    """
+
+    # cache capacities are rounded up to a multiple of this, so compiled steps are reused across requests
+    CAPACITY_BUCKET = 256
+
+    def __init__(self, tfmr):
+        self.tfmr = tfmr
+        self.is_gpt = isinstance(tfmr, GPT2Model)
+        cfg = tfmr.config
+        self.n_heads = cfg.num_attention_heads
+        self.n_kv_heads = getattr(cfg, "num_key_value_heads", None) or self.n_heads
+        self.head_dim = getattr(cfg, "head_dim", None) or cfg.hidden_size // self.n_heads
+        self.layers = tfmr.h if self.is_gpt else tfmr.layers
+        self._step = self._forward
+
+    def new_cache(self, batch_size: int, min_capacity: int) -> StaticKVCache:
+        bucket = self.CAPACITY_BUCKET
+        capacity = bucket * math.ceil(min_capacity / bucket)
+        param = next(self.tfmr.parameters())
+        return StaticKVCache(
+            len(self.layers), batch_size, self.n_kv_heads, capacity, self.head_dim, param.device, param.dtype,
+        )
+
+    def compile(self, **compile_kwargs):
+        "Compile the single-token step; `compile_kwargs` are passed to `torch.compile`."
+        self._step = torch.compile(self._forward, dynamic=False, **compile_kwargs)
+        return self
+
+    def prefill(
+        self,
+        cache: StaticKVCache,
+        inputs_embeds: Tensor,
+        attn_heads: Sequence[Tuple[int, int]] = (),
+        last_only: bool = False,
+    ):
+        """
+        Appends a prefix, (B, T, C), to the cache.
+        Returns the hidden states, (B, T, C) or (B, 1, C) with `last_only` (the last layer then skips the
+        attention output and MLP of all other positions), and {(layer_idx, head_idx): probs (B, T, cache.length)}.
+        """
+        B, T, _ = inputs_embeds.shape
+        assert cache.length + T <= cache.capacity, "KV cache capacity exceeded"
+        positions = torch.arange(cache.length, cache.length + T, device=inputs_embeds.device).expand(B, T)
+        hidden, attns = self._forward(
+            inputs_embeds, cache.k, cache.v, positions, cache.length + T, tuple(attn_heads), last_only,
+        )
+        cache.length += T
+        return hidden, attns
+
+    def step(self, cache: StaticKVCache, inputs_embeds: Tensor, attn_heads: Sequence[Tuple[int, int]] = ()):
+        """
+        Appends a single token, (B, 1, C), to the cache; attends over the full (masked) capacity so the
+        shapes never change. Returns the hidden state, (B, 1, C), and {(layer_idx, head_idx): (B, 1, capacity)}.
+        """
+        assert cache.length < cache.capacity, "KV cache capacity exceeded"
+        positions = torch.full((inputs_embeds.size(0),), cache.length, dtype=torch.long, device=inputs_embeds.device)
+        hidden, attns = self.step_rows(cache, inputs_embeds, positions, attn_heads)
+        cache.length += 1
+        return hidden, attns
+
+    def step_rows(
+        self, cache: StaticKVCache, inputs_embeds: Tensor, positions: Tensor, attn_heads: Sequence[Tuple[int, int]] = (),
+    ):
+        """
+        Like `step`, but row `b` of `inputs_embeds` is written at `positions[b]`, (B,), and only attends to the
+        positions before it; `cache.length` is left alone. The caller must keep `positions < cache.capacity`.
+        """
+        return self._step(inputs_embeds, cache.k, cache.v, positions[:, None], cache.capacity, tuple(attn_heads))
+
+    def _forward(
+        self, x: Tensor, k_cache: List[Tensor], v_cache: List[Tensor], positions: Tensor, n_keys: int,
+        attn_heads: Tuple[Tuple[int, int]], last_only: bool = False,
+    ) -> Tuple[Tensor, Dict[Tuple[int, int], Tensor]]:
+        # positions: (B, T), the cache slot of every input token
+        B, T, C = x.shape
+        H, H_kv, D = self.n_heads, self.n_kv_heads, self.head_dim
+        key_positions = torch.arange(n_keys, device=x.device)
+        mask = (key_positions <= positions[..., None])[:, None]  # (B, 1, T, n_keys), causal + hides unfilled slots
+
+        tfmr = self.tfmr
+        if self.is_gpt:
+            x = tfmr.drop(x + tfmr.wpe(positions))
+        else:
+            cos, sin = tfmr.rotary_emb(x, positions)
+        kv_index = positions[:, None, :, None].expand(B, H_kv, T, D)
+
+        attns = {}
+        for layer_idx, layer in enumerate(self.layers):
+            if self.is_gpt:
+                h = layer.ln_1(x)
+                q, k, v = layer.attn.c_attn(h).split(C, dim=2)
+                k = k.view(B, T, H_kv, D).transpose(1, 2)
+            else:
+                h = layer.input_layernorm(x)
+                attn = layer.self_attn
+                q = attn.q_proj(h)
+                k = attn.k_proj(h).view(B, T, H_kv, D).transpose(1, 2)
+                v = attn.v_proj(h)
+            q = q.view(B, T, H, D).transpose(1, 2)
+            v = v.view(B, T, H_kv, D).transpose(1, 2)
+            if not self.is_gpt:
+                q, k = apply_rotary_pos_emb(q, k, cos, sin)
+
+            k_cache[layer_idx].scatter_(2, kv_index, k)
+            v_cache[layer_idx].scatter_(2, kv_index, v)
+            keys = k_cache[layer_idx][:, :, :n_keys]
+            values = v_cache[layer_idx][:, :, :n_keys]
+            if H_kv != H:
+                keys = keys.repeat_interleave(H // H_kv, dim=1)
+                values = values.repeat_interleave(H // H_kv, dim=1)
+
+            heads = [head_idx for l, head_idx in attn_heads if l == layer_idx]
+            if heads:
+                # only the requested heads, (B, n_heads, T, n_keys)
+                scores = (q[:, heads] @ keys[:, heads].transpose(-1, -2)) / math.sqrt(D)
+                probs = torch.softmax(scores.masked_fill(~mask, float("-inf")), dim=-1, dtype=torch.float32)
+                for i, head_idx in enumerate(heads):
+                    attns[(layer_idx, head_idx)] = probs[:, i]
+
+            if last_only and layer_idx == len(self.layers) - 1:
+                # K/V of every position are cached above, but only the last one flows further
+                q, mask, x, T = q[:, :, -1:], mask[:, :, -1:], x[:, -1:], 1
+            out = F.scaled_dot_product_attention(q, keys, values, attn_mask=mask)
+            out = out.transpose(1, 2).reshape(B, T, H * D)
+
+            if self.is_gpt:
+                x = x + layer.attn.resid_dropout(layer.attn.c_proj(out))
+                x = x + layer.mlp(layer.ln_2(x))
+            else:
+                x = x + attn.o_proj(out)
+                x = x + layer.mlp(layer.post_attention_layernorm(x))
+
+        x = tfmr.ln_f(x) if self.is_gpt else tfmr.norm(x)
+        return x, attns
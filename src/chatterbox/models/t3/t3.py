@@ -1,6 +1,7 @@
 # Copyright (c) 2025 Resemble AI
 # MIT License
 import logging
+from dataclasses import dataclass
 from typing import Union, Optional, List
 
 logger = logging.getLogger(__name__)
@@ -10,21 +11,16 @@ import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
 from transformers import LlamaModel, LlamaConfig, GPT2Config, GPT2Model
-from transformers.generation.logits_process import (
-    LogitsProcessorList,
-    RepetitionPenaltyLogitsProcessor,
-    TemperatureLogitsWarper,
-    TopKLogitsWarper,
-    TopPLogitsWarper,
-    MinPLogitsWarper,
-)
 from .modules.learned_pos_emb import LearnedPositionEmbeddings
 
 from .modules.cond_enc import T3CondEnc, T3Cond
 from .modules.t3_config import T3Config
 from .llama_configs import LLAMA_CONFIGS
-from .inference.t3_hf_backend import T3HuggingfaceBackend
-from .inference.alignment_stream_analyzer import AlignmentStreamAnalyzer
+from .inference.static_kv_decoder import StaticKVDecoder, StaticKVCache
+from .inference.alignment_stream_analyzer import AlignmentStreamAnalyzer, LLAMA_ALIGNED_HEADS
+from .inference.prefix_cache import PrefixKVCache, voice_key
+from .inference.sampler import sample_tokens, seen_mask
+from .inference.cfg_schedule import CFGSchedule
 from ..utils import AttrDict
 
 
@@ -37,6 +33,24 @@ def _ensure_BOT_EOT(text_tokens: Tensor, hp):
     assert (text_tokens == hp.stop_text_token).int().sum() >= B, "missing stop_text_token"
 
 
+@dataclass
+class SpeechTokenChunk:
+    """
+    A piece of the speech token stream produced by `T3.inference_stream` / `T3.inference_turbo_stream`.
+    """
+    # (B, n) newly sampled speech tokens, never includes the EOS token
+    tokens: Tensor
+    # index of `tokens[:, 0]` in the full generated sequence
+    offset: int
+    # True for the final chunk (which may be empty)
+    is_last: bool = False
+    # set on the final chunk: "eos", "alignment" (EOS forced by the alignment analyzer), "max_tokens",
+    # "invalid_logits" or "cancelled" (consumer went away, `T3BatchScheduler` only)
+    stop_reason: Optional[str] = None
+    # set on the final chunk: number of sampled tokens that used classifier-free guidance (see `CFGSchedule`)
+    guided_steps: Optional[int] = None
+
+
 class T3(nn.Module):
     """
     Token-To-Token (T3) TTS model using huggingface transformer models as backbones,
@@ -84,20 +98,92 @@ class T3(nn.Module):
         # logit projection
         self.text_head = nn.Linear(self.cfg.hidden_size, hp.text_tokens_dict_size, bias=False)
         self.speech_head = nn.Linear(self.cfg.hidden_size, hp.speech_tokens_dict_size, bias=self.is_gpt)
-        self.compiled = False
+        # additive logits mask of the trimmed speech head used for inference, see `trim_speech_head`
+        self.register_buffer("speech_logits_mask", None, persistent=False)
+
+        # autoregressive inference runs the backbone against preallocated KV buffers
+        self.decoder = StaticKVDecoder(self.tfmr)
+        # idle alignment analyzers (multilingual only), reused across requests
+        self._analyzer_pool = []
+        # KV of known (voice, text prefix) prefill prefixes, see `enable_prefix_cache`
+        self.prefix_cache: Optional[PrefixKVCache] = None
 
     @property
     def device(self):
         return self.speech_head.weight.device
 
+    def _acquire_analyzer(self, text_tokens_slice):
+        "Borrows a long-lived `AlignmentStreamAnalyzer`, reset for a new utterance; see `_release_analyzer`."
+        try:
+            analyzer = self._analyzer_pool.pop()  # list.pop / append are atomic, no lock needed
+        except IndexError:
+            analyzer = AlignmentStreamAnalyzer(eos_idx=self.hp.stop_speech_token)
+        return analyzer.reset(text_tokens_slice, self.device)
+
+    def _release_analyzer(self, analyzer):
+        self._analyzer_pool.append(analyzer)
+
+    def compile_decode_step(self, **compile_kwargs):
+        """
+        Wraps the single-token decode step with `torch.compile` (static shapes, so it is compiled once per
+        batch size / KV capacity bucket). Works on CPU too, where per-step Python overhead dominates.
+        """
+        self.decoder.compile(**compile_kwargs)
+        return self
+
+    def trim_speech_head(self):
+        """
+        Inference only: speech logits are computed for the ids up to the start / stop tokens only (the tokens S3Gen
+        can use, plus stop), and the start token is masked out, so no invalid token can ever be sampled and the
+        logits / sampling work shrink with the vocabulary (8194 → 6563 for the standard models). `speech_head` itself
+        is left intact (the trimmed head is a view of its first rows), for training and checkpoints.
+        """
+        n_tokens = max(self.hp.start_speech_token, self.hp.stop_speech_token) + 1
+        mask = torch.zeros(n_tokens, device=self.device, dtype=self.speech_head.weight.dtype)
+        # finite (and fp16-safe): CFG computes cond - uncond, which must stay 0 rather than become NaN
+        mask[self.hp.start_speech_token] = -1e4
+        self.speech_logits_mask = mask
+        return self
+
+    @property
+    def n_speech_logits(self):
+        "Size of the last dim of `speech_logits`."
+        return self.speech_head.out_features if self.speech_logits_mask is None else self.speech_logits_mask.size(0)
+
+    def speech_logits(self, hidden: Tensor):
+        "`speech_head` for inference; see `trim_speech_head`."
+        if self.speech_logits_mask is None:
+            return self.speech_head(hidden)
+        n_tokens = self.n_speech_logits
+        bias = self.speech_logits_mask
+        if self.speech_head.bias is not None:
+            bias = bias + self.speech_head.bias[:n_tokens]
+        return F.linear(hidden, self.speech_head.weight[:n_tokens], bias)
+
+    def enable_prefix_cache(self, max_bytes: int = 512 * 2**20):
+        """
+        Reuse the prefill KV of the conditioning (per voice) and of shared text openings across requests, see
+        `PrefixKVCache`; `max_bytes` bounds its memory on the model device. 0 disables it.
+        """
+        self.prefix_cache = PrefixKVCache(max_bytes) if max_bytes > 0 else None
+        return self
+
+    def _apply(self, fn, *args, **kwargs):
+        # cached KV doesn't follow `.to()` / dtype casts, drop it
+        if getattr(self, "prefix_cache", None) is not None:
+            self.prefix_cache.clear()
+        return super()._apply(fn, *args, **kwargs)
+
     def prepare_conditioning(self, t3_cond: T3Cond):
         """
         Token cond data needs to be embedded, so that needs to be here instead of in `T3CondEnc`.
         """
         if t3_cond.cond_prompt_speech_tokens is not None and t3_cond.cond_prompt_speech_emb is None:
-            t3_cond.cond_prompt_speech_emb = self.speech_emb(t3_cond.cond_prompt_speech_tokens)
+            # NOTE: assign the finished embedding in one go, `t3_cond` may be shared by concurrent requests
+            cond_prompt_speech_emb = self.speech_emb(t3_cond.cond_prompt_speech_tokens)
             if not self.is_gpt:
-                t3_cond.cond_prompt_speech_emb += self.speech_pos_emb(t3_cond.cond_prompt_speech_tokens)
+                cond_prompt_speech_emb = cond_prompt_speech_emb + self.speech_pos_emb(t3_cond.cond_prompt_speech_tokens)
+            t3_cond.cond_prompt_speech_emb = cond_prompt_speech_emb
         return self.cond_enc(t3_cond)  # (B, len_cond, dim)
 
     def prepare_input_embeds(
@@ -110,14 +196,8 @@ class T3(nn.Module):
     ):
         # prepare input embeddings (skip backbone tranformer embeddings)
         cond_emb = self.prepare_conditioning(t3_cond)  # (B, len_cond, dim)
-        text_emb = self.text_emb(text_tokens)  # (B, len_text, dim)
-        if cfg_weight > 0.0 and not self.is_gpt:
-            text_emb[1].zero_()  # CFG uncond
-
-        speech_emb = self.speech_emb(speech_tokens)  # (B, len_speech, dim)
-        if self.hp.input_pos_emb == "learned":
-            text_emb = text_emb + self.text_pos_emb(text_tokens)
-            speech_emb = speech_emb + self.speech_pos_emb(speech_tokens)
+        text_emb = self.prepare_text_embeds(text_tokens, cfg_weight)  # (B, len_text, dim)
+        speech_emb = self.prepare_speech_embeds(speech_tokens)  # (B, len_speech, dim)
         len_cond = cond_emb.size(1)
 
         if cond_emb.size(0) != text_emb.size(0):
@@ -130,6 +210,63 @@ class T3(nn.Module):
         ])  # (B, length, dim)
         return embeds, len_cond
 
+    def prepare_text_embeds(self, text_tokens: torch.LongTensor, cfg_weight: float = 0.0):
+        text_emb = self.text_emb(text_tokens)  # (B, len_text, dim)
+        if cfg_weight > 0.0 and not self.is_gpt:
+            text_emb[1].zero_()  # CFG uncond
+        if self.hp.input_pos_emb == "learned":
+            text_emb = text_emb + self.text_pos_emb(text_tokens)
+        return text_emb
+
+    def prepare_speech_embeds(self, speech_tokens: torch.LongTensor):
+        speech_emb = self.speech_emb(speech_tokens)  # (B, len_speech, dim)
+        if self.hp.input_pos_emb == "learned":
+            speech_emb = speech_emb + self.speech_pos_emb(speech_tokens)
+        return speech_emb
+
+    def prefill_prefix(
+        self,
+        kv_cache: StaticKVCache,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: torch.LongTensor,
+        speech_embeds: Tensor,
+        cfg_weight: float = 0.0,
+        attn_heads=(),
+    ):
+        """
+        Fills the empty `kv_cache` with the inference prefix [conditioning | text | speech_embeds], like
+        `prepare_input_embeds` + `StaticKVDecoder.prefill(last_only=True)`, but:
+            * the conditioning is the same for the CFG cond / uncond rows, so it is prefilled once for both
+            * with `self.prefix_cache`, the conditioning and the longest known text prefix are loaded from it,
+                and only the rest is prefilled (`speech_embeds` always is)
+        Returns the prefill outputs (hidden, attns) of the last position, and len_cond.
+        """
+        text_emb = self.prepare_text_embeds(text_tokens, cfg_weight)
+        len_cond, n_cached = None, 0
+        if self.prefix_cache is not None:
+            # the text KV of CFG uncond rows (zeroed text embeddings) differs from plain batched rows
+            voice = voice_key(t3_cond) + ("/cfg" if cfg_weight > 0.0 and not self.is_gpt else "")
+            tokens = text_tokens[0].tolist()
+            len_cond, n_cached = self.prefix_cache.load(kv_cache, voice, tokens)
+
+        embeds = torch.cat([text_emb[:, n_cached:], speech_embeds], dim=1)
+        if len_cond is None:
+            cond_emb = self.prepare_conditioning(t3_cond)  # (1, len_cond, dim)
+            len_cond = cond_emb.size(1)
+            if cond_emb.size(0) == embeds.size(0):
+                embeds = torch.cat([cond_emb, embeds], dim=1)
+            else:
+                # prefill row 0 only, then copy it to the other (CFG) rows
+                self.decoder.prefill(kv_cache.narrow_rows(0, 1), cond_emb, last_only=True)
+                kv_cache.broadcast_row(0, len_cond)
+                kv_cache.length = len_cond
+
+        hidden, attns = self.decoder.prefill(kv_cache, embeds, attn_heads, last_only=True)
+        if self.prefix_cache is not None:
+            self.prefix_cache.store(kv_cache, voice, tokens, len_cond)
+        return hidden, attns, len_cond
+
     def forward(
         self,
         *,
@@ -224,7 +361,7 @@ class T3(nn.Module):
         return loss_text, loss_speech
 
     @torch.inference_mode()
-    def inference(
+    def inference_stream(
         self,
         *,
         t3_cond: T3Cond,
@@ -245,246 +382,270 @@ class T3(nn.Module):
         length_penalty=1.0,
         repetition_penalty=1.2,
         cfg_weight=0.5,
+        cfg_schedule: Optional[CFGSchedule]=None,
+
+        # streaming
+        chunk_size=25,
+        first_chunk_size=None,
     ):
         """
+        Generator version of `inference`: yields a `SpeechTokenChunk` every `chunk_size` sampled tokens
+        (`first_chunk_size` for the first one, a smaller value gets audio out sooner). The KV cache and the
+        alignment analyzer stay alive between yields; the last chunk tells why generation stopped, and how many
+        tokens were guided.
+
         Args:
             text_tokens: a 1D (unbatched) or 2D (batched) tensor.
+            cfg_schedule: which steps apply CFG (default: all of them). While guidance applies to consecutive
+                steps, the uncond row is decoded along with the cond row; with gaps, it only catches up (in one
+                forward pass) on the guided steps. Once guidance is over, it is dropped and its KV freed.
         """
         # Validate / sanitize inputs
         assert prepend_prompt_speech_tokens is None, "not implemented"
         _ensure_BOT_EOT(text_tokens, self.hp)
         text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=self.device)
 
+        # CFG decodes a (cond, uncond) pair of rows; without it, a single sequence end to end (half the compute and
+        # KV memory), even if the caller still doubled the text tokens
+        schedule = cfg_schedule or CFGSchedule()
+        if schedule.window is not None and not self.hp.is_multilingual:
+            raise ValueError("a CFG alignment window needs the alignment analyzer (multilingual models only)")
+        use_cfg = cfg_weight > 0.0 and not schedule.finished(0, 0.0)
+        if not use_cfg:
+            text_tokens = text_tokens[:1]
+        B = text_tokens.size(0)
+
         # Default initial speech to a single start-of-speech token
         if initial_speech_tokens is None:
             initial_speech_tokens = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
 
-        # Prepare custom input embeds
-        embeds, len_cond = self.prepare_input_embeds(
-            t3_cond=t3_cond,
-            text_tokens=text_tokens,
-            speech_tokens=initial_speech_tokens,
-            cfg_weight=cfg_weight,
-        )
-
-        # In order to use the standard HF generate method, we need to extend some methods to inject our custom logic
-        # Note the llama-specific logic. Other tfmr types can be added later.
+        # Default to no alignment analysis for English models, only used for multilingual
+        attn_heads = tuple(LLAMA_ALIGNED_HEADS) if self.hp.is_multilingual else ()
 
-        self.compiled = False
-
-        # TODO? synchronize the expensive compile function
-        # with self.compile_lock:
-        if not self.compiled:
-            # Default to None for English models, only create for multilingual
-            alignment_stream_analyzer = None
-            if self.hp.is_multilingual:
-                alignment_stream_analyzer = AlignmentStreamAnalyzer(
-                    self.tfmr,
-                    None,
-                    text_tokens_slice=(len_cond, len_cond + text_tokens.size(-1)),
-                    alignment_layer_idx=9, # TODO: hparam or something?
-                    eos_idx=self.hp.stop_speech_token,
-                )
-                assert alignment_stream_analyzer.eos_idx == self.hp.stop_speech_token
-
-            patched_model = T3HuggingfaceBackend(
-                config=self.cfg,
-                llama=self.tfmr,
-                speech_enc=self.speech_emb,
-                speech_head=self.speech_head,
-                alignment_stream_analyzer=alignment_stream_analyzer,
-            )
-            self.patched_model = patched_model
-            self.compiled = True
-
-        # # Run normal generate method, which calls our custom extended methods
-        # return self.patched_model.generate(
-        #     inputs=initial_speech_tokens,
-        #     decoder_cond=embeds,
-        #     bos_token_id=self.hp.start_speech_token,
-        #     eos_token_id=(self.hp.stop_speech_token if stop_on_eos else -1),
-        #     pad_token_id=self.hp.stop_speech_token,
-        #     max_new_tokens=max_new_tokens or self.hp.max_speech_tokens,
-        #     num_return_sequences=num_return_sequences,
-        #     temperature=temperature,
-        #     min_p=min_p,
-        #     length_penalty=length_penalty,
-        #     repetition_penalty=repetition_penalty,
-        #     do_sample=do_sample,
-        #     # cache_implementation=None if not self.compiled else "static",
-        # )
-
-        device = embeds.device
+        device = text_tokens.device
+        max_new_tokens = max_new_tokens or self.hp.max_speech_tokens
 
         bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=device)
         bos_embed = self.speech_emb(bos_token)  # shape: (B, 1, embed_dim)
         bos_embed = bos_embed + self.speech_pos_emb.get_fixed_embedding(0)
 
         # batch_size=2 for CFG
-        bos_embed = torch.cat([bos_embed, bos_embed])
-
-        # Combine condition and BOS token for the initial input
-        inputs_embeds = torch.cat([embeds, bos_embed], dim=1)
-
-        # Track generated token ids; start with the BOS token.
-        generated_ids = bos_token.clone()
-        predicted = []  # To store the predicted tokens
-
-        # Instantiate the logits processors.
-        top_p_warper = TopPLogitsWarper(top_p=top_p)
-        min_p_warper = MinPLogitsWarper(min_p=min_p)
-        top_p_warper = TopPLogitsWarper(top_p=top_p)
-        repetition_penalty_processor = RepetitionPenaltyLogitsProcessor(penalty=float(repetition_penalty))
-
-        # ---- Initial Forward Pass (no kv_cache yet) ----
-        output = self.patched_model(
-            inputs_embeds=inputs_embeds,
-            past_key_values=None,
-            use_cache=True,
-            output_attentions=True,
-            output_hidden_states=True,
-            return_dict=True,
-        )
-        # Initialize kv_cache with the full context.
-        past = output.past_key_values
-
-        # ---- Generation Loop using kv_cache ----
-        for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
-            logits_step = output.logits[:, -1, :]
-            # CFG combine  → (1, V)
-            cond   = logits_step[0:1, :]
-            uncond = logits_step[1:2, :]
-            cfg = torch.as_tensor(cfg_weight, device=cond.device, dtype=cond.dtype)
-            logits = cond + cfg * (cond - uncond)
-            
-            # Apply alignment stream analyzer integrity checks
-            if self.patched_model.alignment_stream_analyzer is not None:
-                if logits.dim() == 1:            # guard in case something upstream squeezed
-                    logits = logits.unsqueeze(0) # (1, V)
-                # Pass the last generated token for repetition tracking
-                last_token = generated_ids[0, -1].item() if len(generated_ids[0]) > 0 else None
-                logits = self.patched_model.alignment_stream_analyzer.step(logits, next_token=last_token)  # (1, V)
-
-            # Apply repetition penalty
-            ids_for_proc = generated_ids[:1, ...]   # batch = 1
-            logits = repetition_penalty_processor(ids_for_proc, logits)  # expects (B,V)
-            
-            # Apply temperature scaling.
-            if temperature != 1.0:
-                logits = logits / temperature
-                
-            # Apply min_p and top_p filtering
-            logits = min_p_warper(ids_for_proc, logits)
-            logits = top_p_warper(ids_for_proc, logits)
-
-            # Convert logits to probabilities and sample the next token.
-            probs = torch.softmax(logits, dim=-1)
-            next_token = torch.multinomial(probs, num_samples=1)  # shape: (B, 1)
-
-            predicted.append(next_token)
-            generated_ids = torch.cat([generated_ids, next_token], dim=1)
-
-            # Check for EOS token.
-            if next_token.view(-1) == self.hp.stop_speech_token:
-                logger.info(f"✅ EOS token detected! Stopping generation at step {i+1}")
-                break
-
-            # Get embedding for the new token.
-            next_token_embed = self.speech_emb(next_token)
-            next_token_embed = next_token_embed + self.speech_pos_emb.get_fixed_embedding(i + 1)
-
-            #  For CFG
-            next_token_embed = torch.cat([next_token_embed, next_token_embed])
-
-            # Forward pass with only the new token and the cached past.
-            output = self.patched_model(
-                inputs_embeds=next_token_embed,
-                past_key_values=past,
-                output_attentions=True,
-                output_hidden_states=True,
-                return_dict=True,
+        bos_embed = bos_embed.expand(B, -1, -1)
+
+        # Speech start and BOS token end the initial input (the conditioning and text come first)
+        speech_embeds = torch.cat([self.prepare_speech_embeds(initial_speech_tokens), bos_embed], dim=1)
+
+        # KV buffers for the whole run, allocated once
+        max_len_cond = 2 + self.hp.speech_cond_prompt_len  # speaker + prompt (at most) + emotion
+        prefix_len = max_len_cond + text_tokens.size(1) + speech_embeds.size(1)
+        kv_cache = self.decoder.new_cache(B, prefix_len + max_new_tokens)
+
+        # Tokens seen so far (for the repetition penalty), updated in place; start with the BOS token.
+        seen = seen_mask(bos_token, self.n_speech_logits)
+        last_token = bos_token
+        pending = []  # sampled tokens not yielded yet
+        offset = 0
+        next_chunk_size = first_chunk_size or chunk_size
+        stop_reason = "max_tokens"
+
+        guided_steps = 0
+        progress = 0.0  # alignment position (fraction of the text), only tracked for a CFG window
+        uncond_cache = None  # the uncond row, when it only catches up on guided steps
+        uncond_inputs = []  # token embeds the uncond row hasn't consumed yet
+
+        # NOTE: borrowed from a pool, so concurrent calls never share an analyzer
+        alignment_stream_analyzer = None
+        try:
+            # ---- Initial Forward Pass (fills the kv_cache with the full context) ----
+            hidden, attns, len_cond = self.prefill_prefix(
+                kv_cache,
+                t3_cond=t3_cond,
+                text_tokens=text_tokens,
+                speech_embeds=speech_embeds,
+                cfg_weight=cfg_weight if use_cfg else 0.0,
+                attn_heads=attn_heads,
             )
-            # Update the kv_cache.
-            past = output.past_key_values
+            if self.hp.is_multilingual:
+                alignment_stream_analyzer = self._acquire_analyzer((len_cond, len_cond + text_tokens.size(-1)))
+            if use_cfg and not schedule.lockstep:
+                kv_cache, uncond_cache = kv_cache.narrow_rows(0, 1), kv_cache.narrow_rows(1, 1)
+
+            # ---- Generation Loop using kv_cache ----
+            for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
+                logits_step = self.speech_logits(hidden[:, -1, :])
+                # CFG combine  → (1, V)
+                cond   = logits_step[0:1, :]
+                if use_cfg and schedule.guided(i, progress):
+                    if hidden.size(0) > 1:
+                        uncond = logits_step[1:2, :]
+                    else:
+                        # the uncond row catches up on the tokens since its last guided step
+                        uncond_hidden, _ = self.decoder.prefill(uncond_cache, torch.cat(uncond_inputs, dim=1), last_only=True)
+                        uncond_inputs = []
+                        uncond = self.speech_logits(uncond_hidden[:, -1, :])
+                    cfg = torch.as_tensor(cfg_weight, device=cond.device, dtype=cond.dtype)
+                    logits = cond + cfg * (cond - uncond)
+                    guided_steps += 1
+                else:
+                    logits = cond
+
+                # Apply alignment stream analyzer integrity checks
+                if alignment_stream_analyzer is not None:
+                    if logits.dim() == 1:            # guard in case something upstream squeezed
+                        logits = logits.unsqueeze(0) # (1, V)
+                    alignment_stream_analyzer.observe(attns)
+                    # Pass the last generated token for repetition tracking
+                    logits = alignment_stream_analyzer.step(logits, next_token=last_token[0, -1])  # (1, V)
+                    if use_cfg and schedule.window is not None:
+                        progress = alignment_stream_analyzer.progress
+
+                # Repetition penalty, temperature, min_p and top_p filtering, then sample the next token.
+                next_token, _ = sample_tokens(
+                    logits,
+                    seen=seen,
+                    temperature=temperature,
+                    top_p=top_p,
+                    min_p=min_p,
+                    repetition_penalty=float(repetition_penalty),
+                )  # shape: (B, 1)
+
+                seen.scatter_(1, next_token, True)
+                last_token = next_token
+
+                # Check for EOS token.
+                if next_token.view(-1) == self.hp.stop_speech_token:
+                    logger.info(f"✅ EOS token detected! Stopping generation at step {i+1}")
+                    forced = alignment_stream_analyzer is not None and alignment_stream_analyzer.forced_eos
+                    if forced:
+                        logger.warning(f"EOS was forced by the alignment analyzer: {alignment_stream_analyzer.forced_reasons}")
+                    stop_reason = "alignment" if forced else "eos"
+                    break
+
+                pending.append(next_token)
+                if len(pending) >= next_chunk_size:
+                    yield SpeechTokenChunk(torch.cat(pending, dim=1), offset)
+                    offset += len(pending)
+                    pending = []
+                    next_chunk_size = chunk_size
+
+                if use_cfg and schedule.finished(i + 1, progress):
+                    # guidance is over: decode the cond row alone, and let go of the uncond KV
+                    kv_cache, uncond_cache, uncond_inputs = kv_cache.clone_rows(0, 1), None, []
+                    use_cfg = False
+
+                # Get embedding for the new token.
+                next_token_embed = self.speech_emb(next_token)
+                next_token_embed = next_token_embed + self.speech_pos_emb.get_fixed_embedding(i + 1)
+                if uncond_cache is not None:
+                    uncond_inputs.append(next_token_embed)
+
+                #  For CFG
+                next_token_embed = next_token_embed.expand(kv_cache.batch_size, -1, -1)
+
+                # Forward pass with only the new token and the cached past.
+                hidden, attns = self.decoder.step(kv_cache, next_token_embed, attn_heads)
+
+            if cfg_weight > 0.0:
+                n_sampled = offset + len(pending) + (stop_reason in ("eos", "alignment"))
+                logger.info(f"CFG guided {guided_steps} of {n_sampled} sampled tokens")
+            last = torch.cat(pending, dim=1) if pending else bos_token.new_zeros(1, 0)
+            yield SpeechTokenChunk(last, offset, is_last=True, stop_reason=stop_reason, guided_steps=guided_steps)
+        finally:
+            if alignment_stream_analyzer is not None:
+                self._release_analyzer(alignment_stream_analyzer)
 
-        # Concatenate all predicted tokens along the sequence dimension.
-        predicted_tokens = torch.cat(predicted, dim=1)  # shape: (B, num_tokens)
+    @torch.inference_mode()
+    def inference(self, *, max_new_tokens=None, **kwargs):
+        """
+        Runs `inference_stream` to the end and returns all predicted tokens, (B, num_tokens), including the
+        final EOS token when one was sampled.
+        """
+        max_new_tokens = max_new_tokens or self.hp.max_speech_tokens
+        chunks = list(self.inference_stream(max_new_tokens=max_new_tokens, chunk_size=max_new_tokens, **kwargs))
+        predicted_tokens = torch.cat([chunk.tokens for chunk in chunks], dim=1)
+        if chunks[-1].stop_reason in ("eos", "alignment"):
+            predicted_tokens = F.pad(predicted_tokens, (0, 1), value=self.hp.stop_speech_token)
         return predicted_tokens
 
     @torch.inference_mode()
-    def inference_turbo(self, t3_cond, text_tokens, temperature=0.8, top_k=1000, top_p=0.95, repetition_penalty=1.2,
-                        max_gen_len=1000):
+    def inference_turbo_stream(self, t3_cond, text_tokens, temperature=0.8, top_k=1000, top_p=0.95,
+                               repetition_penalty=1.2, max_gen_len=1000, chunk_size=25, first_chunk_size=None):
+        """
+        Generator version of `inference_turbo`, yields `SpeechTokenChunk`s like `inference_stream`.
+        """
+        # temperature → top_k → top_p → repetition penalty
+        sampling = dict(
+            temperature=temperature, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty,
+            penalty_last=True,
+        )
 
-        logits_processors = LogitsProcessorList()
-        if temperature > 0 and temperature != 1.0:
-            logits_processors.append(TemperatureLogitsWarper(temperature))
-        if top_k > 0:
-            logits_processors.append(TopKLogitsWarper(top_k))
-        if top_p < 1.0:
-            logits_processors.append(TopPLogitsWarper(top_p))
-        if repetition_penalty != 1.0:
-            logits_processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+        speech_start_token = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
 
+        pending = []  # sampled tokens not yielded yet
+        offset = 0
+        next_chunk_size = first_chunk_size or chunk_size
+        stop_reason = "max_tokens"
 
-        speech_start_token = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
-        embeds, _ = self.prepare_input_embeds(
+        # KV buffers for the whole run, allocated once
+        max_len_cond = 2 + self.hp.speech_cond_prompt_len  # speaker + prompt (at most) + emotion
+        kv_cache = self.decoder.new_cache(text_tokens.size(0), max_len_cond + text_tokens.size(1) + 1 + max_gen_len)
+        hidden_states, _, _ = self.prefill_prefix(
+            kv_cache,
             t3_cond=t3_cond,
             text_tokens=text_tokens,
-            speech_tokens=speech_start_token,
-            cfg_weight=0.0,
+            speech_embeds=self.prepare_speech_embeds(speech_start_token),
         )
 
-        generated_speech_tokens = []
-
-        llm_outputs = self.tfmr(
-            inputs_embeds=embeds,
-            use_cache=True
-        )
-
-        hidden_states = llm_outputs[0]
-        past_key_values = llm_outputs.past_key_values
-
         speech_hidden = hidden_states[:, -1:]
-        speech_logits = self.speech_head(speech_hidden)
+        speech_logits = self.speech_logits(speech_hidden)
 
-        processed_logits = logits_processors(speech_start_token, speech_logits[:, -1, :])
-        probs = F.softmax(processed_logits, dim=-1)
-        next_speech_token = torch.multinomial(probs, num_samples=1)
+        logits = speech_logits[:, -1, :]
+        next_speech_token, _ = sample_tokens(logits, seen=seen_mask(speech_start_token, logits.size(-1)), **sampling)
 
-        generated_speech_tokens.append(next_speech_token)
+        # generated tokens (the start token no longer counts) for the repetition penalty, updated in place
+        seen = seen_mask(next_speech_token, logits.size(-1))
         current_speech_token = next_speech_token
 
         for _ in tqdm(range(max_gen_len)):
-            current_speech_embed = self.speech_emb(current_speech_token)
+            if torch.all(current_speech_token == self.hp.stop_speech_token):
+                stop_reason = "eos"
+                break
+            pending.append(current_speech_token)
+            if len(pending) >= next_chunk_size:
+                yield SpeechTokenChunk(torch.cat(pending, dim=1), offset)
+                offset += len(pending)
+                pending = []
+                next_chunk_size = chunk_size
 
-            llm_outputs = self.tfmr(
-                inputs_embeds=current_speech_embed,
-                past_key_values=past_key_values,
-                use_cache=True
-            )
+            current_speech_embed = self.speech_emb(current_speech_token)
 
-            hidden_states = llm_outputs[0]
-            past_key_values = llm_outputs.past_key_values
-            speech_logits = self.speech_head(hidden_states)
+            hidden_states, _ = self.decoder.step(kv_cache, current_speech_embed)
+            speech_logits = self.speech_logits(hidden_states)
 
-            input_ids = torch.cat(generated_speech_tokens, dim=1)
-            processed_logits = logits_processors(input_ids, speech_logits[:, -1, :])
-            if torch.all(processed_logits == -float("inf")):
-                print("Warning: All logits are -inf")
+            logits = speech_logits[:, -1, :]
+            next_speech_token, invalid = sample_tokens(logits, seen=seen, **sampling)
+            if torch.all(invalid):
+                logger.warning("All logits are -inf")
+                stop_reason = "invalid_logits"
                 break
 
-            probs = F.softmax(processed_logits, dim=-1)
-            next_speech_token = torch.multinomial(probs, num_samples=1)
-
-            generated_speech_tokens.append(next_speech_token)
+            seen.scatter_(1, next_speech_token, True)
             current_speech_token = next_speech_token
-            if torch.all(next_speech_token == self.hp.stop_speech_token):
-                break
-
-        all_tokens = torch.cat(generated_speech_tokens, dim=1)
+        else:
+            # the token sampled by the last step is kept, unless it is EOS
+            if torch.all(current_speech_token == self.hp.stop_speech_token):
+                stop_reason = "eos"
+            else:
+                pending.append(current_speech_token)
 
-        # Remove EOS token if present
-        if all_tokens.size(1) > 0 and all_tokens[0, -1] == self.hp.stop_speech_token:
-            all_tokens = all_tokens[:, :-1]
+        last = torch.cat(pending, dim=1) if pending else speech_start_token.new_zeros(speech_start_token.size(0), 0)
+        yield SpeechTokenChunk(last, offset, is_last=True, stop_reason=stop_reason)
 
-        return all_tokens
+    @torch.inference_mode()
+    def inference_turbo(self, t3_cond, text_tokens, max_gen_len=1000, **kwargs):
+        """
+        Runs `inference_turbo_stream` to the end and returns all speech tokens, without the EOS token.
+        """
+        chunks = self.inference_turbo_stream(t3_cond, text_tokens, max_gen_len=max_gen_len, chunk_size=max_gen_len + 1,
+                                             **kwargs)
+        return torch.cat([chunk.tokens for chunk in chunks], dim=1)
@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 from pathlib import Path
+from typing import List
 import os
 
 import librosa
@@ -9,13 +10,16 @@ import torch.nn.functional as F
 from safetensors.torch import load_file as load_safetensors
 from huggingface_hub import snapshot_download
 
-from .models.t3 import T3
+from .models.t3 import T3, CFGSchedule, T3BatchScheduler
 from .models.t3.modules.t3_config import T3Config
-from .models.s3tokenizer import S3_SR, drop_invalid_tokens
-from .models.s3gen import S3GEN_SR, S3Gen
+from .models.s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, drop_invalid_tokens
+from .models.s3gen import S3GEN_SR, S3Gen, S3GenStreamer
 from .models.tokenizers import MTLTokenizer
 from .models.voice_encoder import VoiceEncoder
 from .models.t3.modules.cond_enc import T3Cond
+from .conds_cache import ConditionalsCache, conds_cache_key
+from .text_utils import split_sentences
+from .batch_synthesis import decode_batch, vocode_batch
 
 
 REPO_ID = "ResembleAI/chatterbox"
@@ -150,6 +154,7 @@ class ChatterboxMultilingualTTS:
         self.tokenizer = tokenizer
         self.device = device
         self.conds = conds
+        self.conds_cache = ConditionalsCache()
         self.watermarker = perth.PerthImplicitWatermarker()
 
     @classmethod
@@ -173,12 +178,14 @@ class ChatterboxMultilingualTTS:
             t3_state = t3_state["model"][0]
         t3.load_state_dict(t3_state)
         t3.to(device).eval()
+        t3.trim_speech_head()  # inference only, never samples tokens S3Gen can't use
 
         s3gen = S3Gen()
         s3gen.load_state_dict(
             torch.load(ckpt_dir / "s3gen.pt", weights_only=True)
         )
         s3gen.to(device).eval()
+        s3gen.mel2wav.optimize_for_inference()  # fold HiFT weight norms, on the target device
 
         tokenizer = MTLTokenizer(
             str(ckpt_dir / "grapheme_mtl_merged_expanded_v1.json")
@@ -203,7 +210,21 @@ class ChatterboxMultilingualTTS:
         )
         return cls.from_local(ckpt_dir, device)
     
-    def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
+    def get_conditionals(self, wav_fpath, exaggeration=0.5) -> Conditionals:
+        """
+        Build the `Conditionals` for a reference clip without touching `self.conds`, so the result can be
+        passed to `generate(conds=...)` from any thread.
+        Results are memoized in `self.conds_cache` by audio content; set it to None to always recompute.
+        """
+        if self.conds_cache is None:
+            return self._build_conditionals(wav_fpath, exaggeration)
+        key = conds_cache_key(wav_fpath, type(self).__name__, exaggeration=exaggeration)
+        return self.conds_cache.get_or_create(
+            key, self.device, Conditionals,
+            lambda: self._build_conditionals(wav_fpath, exaggeration),
+        )
+
+    def _build_conditionals(self, wav_fpath, exaggeration) -> Conditionals:
         ## Load reference wav
         s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
 
@@ -228,7 +249,10 @@ class ChatterboxMultilingualTTS:
             cond_prompt_speech_tokens=t3_cond_prompt_tokens,
             emotion_adv=exaggeration * torch.ones(1, 1, 1),
         ).to(device=self.device)
-        self.conds = Conditionals(t3_cond, s3gen_ref_dict)
+        return Conditionals(t3_cond, s3gen_ref_dict)
+
+    def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
+        self.conds = self.get_conditionals(wav_fpath, exaggeration=exaggeration)
 
     def generate(
         self,
@@ -241,61 +265,195 @@ class ChatterboxMultilingualTTS:
         repetition_penalty=2.0,
         min_p=0.05,
         top_p=1.0,
+        conds: Conditionals = None,
+        cfg_schedule: CFGSchedule = None,
     ):
-        # Validate language_id
+        """
+        NOTE: passing `conds` (see `get_conditionals`) makes this call reentrant: the model's shared state is
+        never modified, so several threads can synthesize different voices with one loaded model.
+        `cfg_schedule` (see `CFGSchedule`) limits which T3 steps pay for classifier-free guidance.
+        """
+        self._check_language_id(language_id)
+
+        if conds is None:
+            if audio_prompt_path:
+                self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
+            else:
+                assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+            conds = self.conds
+
+        conds = self._with_exaggeration(conds, exaggeration)
+        text_tokens = self._text_to_tokens(text, language_id, cfg_weight)
+
+        with torch.inference_mode():
+            speech_tokens = self.t3.inference(
+                t3_cond=conds.t3,
+                text_tokens=text_tokens,
+                max_new_tokens=1000,  # TODO: use the value in config
+                temperature=temperature,
+                cfg_weight=cfg_weight,
+                cfg_schedule=cfg_schedule,
+                repetition_penalty=repetition_penalty,
+                min_p=min_p,
+                top_p=top_p,
+            )
+            # Extract only the conditional batch.
+            speech_tokens = speech_tokens[0]
+
+            # TODO: output becomes 1D
+            speech_tokens = drop_invalid_tokens(speech_tokens)
+            speech_tokens = speech_tokens.to(self.device)
+
+            wav, _ = self.s3gen.inference(
+                speech_tokens=speech_tokens,
+                ref_dict=conds.gen,
+            )
+        return self._watermark(wav)
+
+    def generate_batch(self, requests: List[dict], scheduler: T3BatchScheduler = None):
+        """
+        Synthesizes several utterances together: T3 decodes them in one `T3BatchScheduler` batch (a new one unless
+        `scheduler` is given) and S3Gen vocodes them in one padded batch. Each request holds the `generate` keyword
+        arguments of one utterance, `text` included; the waveforms are returned in the same order.
+        """
+        sequences, ref_dicts = zip(*[self._batch_sequence(**request) for request in requests])
+        with torch.inference_mode():
+            speech_tokens = decode_batch(self.t3, sequences, scheduler)
+            speech_tokens = [drop_invalid_tokens(tokens) for tokens in speech_tokens]
+            wavs = vocode_batch(self.s3gen, speech_tokens, ref_dicts)
+        return [self._watermark(wav) for wav in wavs]
+
+    def _batch_sequence(
+        self,
+        text,
+        language_id,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        repetition_penalty=2.0,
+        min_p=0.05,
+        top_p=1.0,
+        conds: Conditionals = None,
+        cfg_schedule: CFGSchedule = None,
+    ):
+        "`T3BatchScheduler.add` arguments and S3Gen reference of one `generate_batch` request."
+        self._check_language_id(language_id)
+        if conds is None:
+            if audio_prompt_path:
+                conds = self.get_conditionals(audio_prompt_path, exaggeration=exaggeration)
+            else:
+                assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+                conds = self.conds
+        conds = self._with_exaggeration(conds, exaggeration)
+        sequence = dict(
+            t3_cond=conds.t3,
+            text_tokens=self._text_to_tokens(text, language_id, cfg_weight),
+            max_new_tokens=1000,  # TODO: use the value in config
+            temperature=temperature,
+            cfg_weight=cfg_weight,
+            cfg_schedule=cfg_schedule,
+            repetition_penalty=repetition_penalty,
+            min_p=min_p,
+            top_p=top_p,
+            chunk_size=1000,
+        )
+        return sequence, conds.gen
+
+    @staticmethod
+    def _check_language_id(language_id):
         if language_id and language_id.lower() not in SUPPORTED_LANGUAGES:
             supported_langs = ", ".join(SUPPORTED_LANGUAGES.keys())
             raise ValueError(
                 f"Unsupported language_id '{language_id}'. "
                 f"Supported languages: {supported_langs}"
             )
-        
-        if audio_prompt_path:
-            self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
-        else:
-            assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
-
-        # Update exaggeration if needed
-        if float(exaggeration) != float(self.conds.t3.emotion_adv[0, 0, 0].item()):
-            _cond: T3Cond = self.conds.t3
-            self.conds.t3 = T3Cond(
+
+    def _with_exaggeration(self, conds: Conditionals, exaggeration) -> Conditionals:
+        # Update exaggeration if needed (per call, the shared conditionals are left untouched)
+        if float(exaggeration) != float(conds.t3.emotion_adv[0, 0, 0].item()):
+            _cond: T3Cond = conds.t3
+            conds = Conditionals(T3Cond(
                 speaker_emb=_cond.speaker_emb,
                 cond_prompt_speech_tokens=_cond.cond_prompt_speech_tokens,
                 emotion_adv=exaggeration * torch.ones(1, 1, 1),
-            ).to(device=self.device)
+            ).to(device=self.device), conds.gen)
+        return conds
 
+    def _text_to_tokens(self, text, language_id, cfg_weight):
         # Norm and tokenize text
         text = punc_norm(text)
         text_tokens = self.tokenizer.text_to_tokens(text, language_id=language_id.lower() if language_id else None).to(self.device)
-        text_tokens = torch.cat([text_tokens, text_tokens], dim=0)  # Need two seqs for CFG
+        if cfg_weight > 0.0:
+            text_tokens = torch.cat([text_tokens, text_tokens], dim=0)  # Need two seqs for CFG
 
         sot = self.t3.hp.start_text_token
         eot = self.t3.hp.stop_text_token
         text_tokens = F.pad(text_tokens, (1, 0), value=sot)
         text_tokens = F.pad(text_tokens, (0, 1), value=eot)
+        return text_tokens
 
-        with torch.inference_mode():
-            speech_tokens = self.t3.inference(
-                t3_cond=self.conds.t3,
-                text_tokens=text_tokens,
+    def _watermark(self, wav):
+        wav = wav.squeeze(0).detach().cpu().numpy()
+        watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
+        return torch.from_numpy(watermarked_wav).unsqueeze(0)
+
+    @torch.inference_mode()
+    def generate_stream(
+        self,
+        text,
+        language_id,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        repetition_penalty=2.0,
+        min_p=0.05,
+        top_p=1.0,
+        conds: Conditionals = None,
+        cfg_schedule: CFGSchedule = None,
+        chunk_size=25,
+        first_chunk_size=10,
+    ):
+        """
+        Streaming version of `generate`: yields (1, N) waveform chunks while speech tokens are still being sampled.
+        The text is split into sentences (see `split_sentences`); within a sentence, every `chunk_size` speech tokens
+        (40ms of audio each, `first_chunk_size` for the first chunk) are vocoded by an `S3GenStreamer`.
+        NOTE: each chunk is watermarked on its own, so the concatenated stream doesn't carry the watermark `generate`
+        would put on the same audio, and detection on short chunks is unreliable; use `generate` when the watermark
+        has to be verified.
+        """
+        self._check_language_id(language_id)
+
+        if conds is None:
+            if audio_prompt_path:
+                conds = self.get_conditionals(audio_prompt_path, exaggeration=exaggeration)
+            else:
+                assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+                conds = self.conds
+        conds = self._with_exaggeration(conds, exaggeration)
+
+        for sentence in split_sentences(text):
+            streamer = S3GenStreamer(
+                self.s3gen, conds.gen, token_hop_len=chunk_size, first_token_hop_len=first_chunk_size,
+            )
+            token_chunks = self.t3.inference_stream(
+                t3_cond=conds.t3,
+                text_tokens=self._text_to_tokens(sentence, language_id, cfg_weight),
                 max_new_tokens=1000,  # TODO: use the value in config
                 temperature=temperature,
                 cfg_weight=cfg_weight,
+                cfg_schedule=cfg_schedule,
                 repetition_penalty=repetition_penalty,
                 min_p=min_p,
                 top_p=top_p,
+                chunk_size=chunk_size,
+                first_chunk_size=streamer.first_chunk_tokens,
             )
-            # Extract only the conditional batch.
-            speech_tokens = speech_tokens[0]
-
-            # TODO: output becomes 1D
-            speech_tokens = drop_invalid_tokens(speech_tokens)
-            speech_tokens = speech_tokens.to(self.device)
-
-            wav, _ = self.s3gen.inference(
-                speech_tokens=speech_tokens,
-                ref_dict=self.conds.gen,
-            )
-            wav = wav.squeeze(0).detach().cpu().numpy()
-            watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
-        return torch.from_numpy(watermarked_wav).unsqueeze(0)
+            for chunk in token_chunks:
+                speech_tokens = chunk.tokens[0]
+                wav = streamer.push(speech_tokens[speech_tokens < SPEECH_VOCAB_SIZE])
+                if chunk.is_last:
+                    wav = torch.cat([wav, streamer.flush()], dim=1)
+                if wav.numel() > 0:
+                    yield self._watermark(wav)
@@ -0,0 +1,52 @@
+import re
+from typing import List
+
+
+# sentence-final punctuation, followed by whitespace for latin scripts; CJK full-width marks need none
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+|(?<=[。！？])|\n+")
+_CLAUSE_SPLIT = re.compile(r"(?<=[,;:，；：、])\s*")
+
+
+def _join(a: str, b: str) -> str:
+    # no separator after CJK text, a space otherwise
+    if not a:
+        return b
+    return a + b if ord(a[-1]) >= 0x2E80 else f"{a} {b}"
+
+
+def split_sentences(text: str, min_chars: int = 20, max_chars: int = 300) -> List[str]:
+    """
+    Split text into sentence-sized pieces for incremental synthesis.
+        * pieces shorter than `min_chars` are merged with the following one, very short inputs sound choppy
+        * pieces longer than `max_chars` are further split at clause punctuation, then at spaces
+    """
+    pieces = []
+    for sentence in _SENTENCE_SPLIT.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if len(sentence) <= max_chars:
+            pieces.append(sentence)
+            continue
+        chunk = ""
+        for clause in _CLAUSE_SPLIT.split(sentence):
+            while len(clause) > max_chars:
+                cut = clause.rfind(" ", 0, max_chars)
+                cut = cut if cut > 0 else max_chars
+                pieces.extend([chunk] if chunk else [])
+                pieces.append(clause[:cut].strip())
+                chunk, clause = "", clause[cut:].strip()
+            if chunk and len(chunk) + len(clause) + 1 > max_chars:
+                pieces.append(chunk)
+                chunk = ""
+            chunk = _join(chunk, clause)
+        if chunk:
+            pieces.append(chunk)
+
+    merged = []
+    for piece in pieces:
+        if merged and len(merged[-1]) < min_chars:
+            merged[-1] = _join(merged[-1], piece)
+        else:
+            merged.append(piece)
+    return merged
@@ -2,6 +2,7 @@ import os
 import math
 from dataclasses import dataclass
 from pathlib import Path
+from typing import List
 
 import librosa
 import torch
@@ -12,12 +13,15 @@ from safetensors.torch import load_file
 from huggingface_hub import snapshot_download
 from transformers import AutoTokenizer
 
-from .models.t3 import T3
+from .models.t3 import T3, T3BatchScheduler
 from .models.s3tokenizer import S3_SR
-from .models.s3gen import S3GEN_SR, S3Gen
+from .models.s3gen import S3GEN_SR, S3Gen, S3GenStreamer
 from .models.tokenizers import EnTokenizer
 from .models.voice_encoder import VoiceEncoder
 from .models.t3.modules.cond_enc import T3Cond
+from .conds_cache import ConditionalsCache, conds_cache_key
+from .text_utils import split_sentences
+from .batch_synthesis import decode_batch, vocode_batch
 from .models.t3.modules.t3_config import T3Config
 from .models.s3gen.const import S3GEN_SIL
 import logging
@@ -127,6 +131,7 @@ class ChatterboxTurboTTS:
         self.tokenizer = tokenizer
         self.device = device
         self.conds = conds
+        self.conds_cache = ConditionalsCache()
         self.watermarker = perth.PerthImplicitWatermarker()
 
     @classmethod
@@ -161,6 +166,7 @@ class ChatterboxTurboTTS:
         t3.load_state_dict(t3_state)
         del t3.tfmr.wte
         t3.to(device).eval()
+        t3.trim_speech_head()  # inference only, never samples tokens S3Gen can't use
 
         s3gen = S3Gen(meanflow=True)
         weights = load_file(ckpt_dir / "s3gen_meanflow.safetensors")
@@ -168,6 +174,7 @@ class ChatterboxTurboTTS:
             weights, strict=True
         )
         s3gen.to(device).eval()
+        s3gen.mel2wav.optimize_for_inference()  # fold HiFT weight norms, on the target device
 
         tokenizer = AutoTokenizer.from_pretrained(ckpt_dir)
         if tokenizer.pad_token is None:
@@ -214,7 +221,21 @@ class ChatterboxTurboTTS:
 
         return wav
 
-    def prepare_conditionals(self, wav_fpath, exaggeration=0.5, norm_loudness=True):
+    def get_conditionals(self, wav_fpath, exaggeration=0.5, norm_loudness=True) -> Conditionals:
+        """
+        Build the `Conditionals` for a reference clip without touching `self.conds`, so the result can be
+        passed to `generate(conds=...)` from any thread.
+        Results are memoized in `self.conds_cache` by audio content; set it to None to always recompute.
+        """
+        if self.conds_cache is None:
+            return self._build_conditionals(wav_fpath, exaggeration, norm_loudness)
+        key = conds_cache_key(wav_fpath, type(self).__name__, exaggeration=exaggeration, norm_loudness=norm_loudness)
+        return self.conds_cache.get_or_create(
+            key, self.device, Conditionals,
+            lambda: self._build_conditionals(wav_fpath, exaggeration, norm_loudness),
+        )
+
+    def _build_conditionals(self, wav_fpath, exaggeration, norm_loudness) -> Conditionals:
         ## Load and norm reference wav
         s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
 
@@ -243,7 +264,10 @@ class ChatterboxTurboTTS:
             cond_prompt_speech_tokens=t3_cond_prompt_tokens,
             emotion_adv=exaggeration * torch.ones(1, 1, 1),
         ).to(device=self.device)
-        self.conds = Conditionals(t3_cond, s3gen_ref_dict)
+        return Conditionals(t3_cond, s3gen_ref_dict)
+
+    def prepare_conditionals(self, wav_fpath, exaggeration=0.5, norm_loudness=True):
+        self.conds = self.get_conditionals(wav_fpath, exaggeration=exaggeration, norm_loudness=norm_loudness)
 
     def generate(
         self,
@@ -257,22 +281,26 @@ class ChatterboxTurboTTS:
         temperature=0.8,
         top_k=1000,
         norm_loudness=True,
+        conds: Conditionals = None,
     ):
-        if audio_prompt_path:
-            self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration, norm_loudness=norm_loudness)
-        else:
-            assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+        """
+        NOTE: passing `conds` (see `get_conditionals`) makes this call reentrant: the model's shared state is
+        never modified, so several threads can synthesize different voices with one loaded model.
+        """
+        if conds is None:
+            if audio_prompt_path:
+                self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration, norm_loudness=norm_loudness)
+            else:
+                assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+            conds = self.conds
 
         if cfg_weight > 0.0 or exaggeration > 0.0 or min_p > 0.0:
             logger.warning("CFG, min_p and exaggeration are not supported by Turbo version and will be ignored.")
 
-        # Norm and tokenize text
-        text = punc_norm(text)
-        text_tokens = self.tokenizer(text, return_tensors="pt", padding=True, truncation=True)
-        text_tokens = text_tokens.input_ids.to(self.device)
+        text_tokens = self._text_to_tokens(text)
 
         speech_tokens = self.t3.inference_turbo(
-            t3_cond=self.conds.t3,
+            t3_cond=conds.t3,
             text_tokens=text_tokens,
             temperature=temperature,
             top_k=top_k,
@@ -288,9 +316,132 @@ class ChatterboxTurboTTS:
 
         wav, _ = self.s3gen.inference(
             speech_tokens=speech_tokens,
-            ref_dict=self.conds.gen,
+            ref_dict=conds.gen,
             n_cfm_timesteps=2,
         )
+        return self._watermark(wav)
+
+    def generate_batch(self, requests: List[dict], scheduler: T3BatchScheduler = None):
+        """
+        Synthesizes several utterances together: T3 decodes them in one `T3BatchScheduler` batch (a new one unless
+        `scheduler` is given) and S3Gen vocodes them in one padded batch. Each request holds the `generate` keyword
+        arguments of one utterance, `text` included; the waveforms are returned in the same order.
+        """
+        sequences, ref_dicts = zip(*[self._batch_sequence(**request) for request in requests])
+        with torch.inference_mode():
+            speech_tokens = decode_batch(self.t3, sequences, scheduler)
+            # Remove OOV tokens and add silence to end
+            silence = torch.tensor([S3GEN_SIL, S3GEN_SIL, S3GEN_SIL]).long().to(self.device)
+            speech_tokens = [torch.cat([tokens[tokens < 6561].to(self.device), silence]) for tokens in speech_tokens]
+            wavs = vocode_batch(self.s3gen, speech_tokens, ref_dicts, n_cfm_timesteps=2)
+        return [self._watermark(wav) for wav in wavs]
+
+    def _batch_sequence(
+        self,
+        text,
+        repetition_penalty=1.2,
+        min_p=0.00,
+        top_p=0.95,
+        audio_prompt_path=None,
+        exaggeration=0.0,
+        cfg_weight=0.0,
+        temperature=0.8,
+        top_k=1000,
+        norm_loudness=True,
+        conds: Conditionals = None,
+    ):
+        "`T3BatchScheduler.add` arguments and S3Gen reference of one `generate_batch` request."
+        if conds is None:
+            if audio_prompt_path:
+                conds = self.get_conditionals(audio_prompt_path, exaggeration=exaggeration, norm_loudness=norm_loudness)
+            else:
+                assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+                conds = self.conds
+
+        if cfg_weight > 0.0 or exaggeration > 0.0 or min_p > 0.0:
+            logger.warning("CFG, min_p and exaggeration are not supported by Turbo version and will be ignored.")
+
+        sequence = dict(
+            t3_cond=conds.t3,
+            text_tokens=self._text_to_tokens(text),
+            max_new_tokens=1000,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            chunk_size=1000,
+        )
+        return sequence, conds.gen
+
+    def _text_to_tokens(self, text):
+        # Norm and tokenize text
+        text = punc_norm(text)
+        text_tokens = self.tokenizer(text, return_tensors="pt", padding=True, truncation=True)
+        return text_tokens.input_ids.to(self.device)
+
+    def _watermark(self, wav):
         wav = wav.squeeze(0).detach().cpu().numpy()
         watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
         return torch.from_numpy(watermarked_wav).unsqueeze(0)
+
+    @torch.inference_mode()
+    def generate_stream(
+        self,
+        text,
+        repetition_penalty=1.2,
+        min_p=0.00,
+        top_p=0.95,
+        audio_prompt_path=None,
+        exaggeration=0.0,
+        cfg_weight=0.0,
+        temperature=0.8,
+        top_k=1000,
+        norm_loudness=True,
+        conds: Conditionals = None,
+        chunk_size=25,
+        first_chunk_size=10,
+    ):
+        """
+        Streaming version of `generate`: yields (1, N) waveform chunks while speech tokens are still being sampled.
+        The text is split into sentences (see `split_sentences`); within a sentence, every `chunk_size` speech tokens
+        (40ms of audio each, `first_chunk_size` for the first chunk) are vocoded by an `S3GenStreamer`.
+        NOTE: each chunk is watermarked on its own, so the concatenated stream doesn't carry the watermark `generate`
+        would put on the same audio, and detection on short chunks is unreliable; use `generate` when the watermark
+        has to be verified.
+        """
+        if conds is None:
+            if audio_prompt_path:
+                conds = self.get_conditionals(audio_prompt_path, exaggeration=exaggeration, norm_loudness=norm_loudness)
+            else:
+                assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+                conds = self.conds
+
+        if cfg_weight > 0.0 or exaggeration > 0.0 or min_p > 0.0:
+            logger.warning("CFG, min_p and exaggeration are not supported by Turbo version and will be ignored.")
+
+        silence = torch.tensor([S3GEN_SIL, S3GEN_SIL, S3GEN_SIL]).long().to(self.device)
+        for sentence in split_sentences(text):
+            streamer = S3GenStreamer(
+                self.s3gen, conds.gen, n_cfm_timesteps=2, token_hop_len=chunk_size, first_token_hop_len=first_chunk_size,
+            )
+            token_chunks = self.t3.inference_turbo_stream(
+                t3_cond=conds.t3,
+                text_tokens=self._text_to_tokens(sentence),
+                temperature=temperature,
+                top_k=top_k,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+                chunk_size=chunk_size,
+                first_chunk_size=streamer.first_chunk_tokens,
+            )
+            for chunk in token_chunks:
+                # Remove OOV tokens and add silence to end
+                speech_tokens = chunk.tokens[0]
+                speech_tokens = speech_tokens[speech_tokens < 6561]
+                if chunk.is_last:
+                    speech_tokens = torch.cat([speech_tokens, silence])
+                wav = streamer.push(speech_tokens)
+                if chunk.is_last:
+                    wav = torch.cat([wav, streamer.flush()], dim=1)
+                if wav.numel() > 0:
+                    yield self._watermark(wav)
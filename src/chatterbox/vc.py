@@ -55,6 +55,7 @@ class ChatterboxVC:
             load_file(ckpt_dir / "s3gen.safetensors"), strict=False
         )
         s3gen.to(device).eval()
+        s3gen.mel2wav.optimize_for_inference()  # fold HiFT weight norms, on the target device
 
         return cls(s3gen, device, ref_dict=ref_dict)
 
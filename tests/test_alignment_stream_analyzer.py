@@ -0,0 +1,16 @@
+import torch
+
+from chatterbox.models.t3.inference.alignment_stream_analyzer import AlignmentStreamAnalyzer
+
+
+def test_prefill_longer_than_the_history_keeps_its_last_frames():
+    torch.manual_seed(0)
+    analyzer = AlignmentStreamAnalyzer(history=4)
+    analyzer.reset((2, 12), "cpu")
+    attn = torch.rand(1, 9, 21)  # 9 prefilled positions after the 10 text tokens
+    analyzer.observe({key: attn for key in analyzer.attn_heads})
+    analyzer.step(torch.zeros(1, 10))
+
+    A_chunk = attn[0, 12 - 21:, 2:12].masked_fill(torch.arange(10) > 0, 0)
+    assert analyzer.n_frames == 9
+    assert torch.allclose(analyzer.alignment, A_chunk[-4:])  # the heads are averaged
@@ -0,0 +1,56 @@
+import threading
+from types import SimpleNamespace
+
+import torch
+
+from chatterbox.models.t3.inference.batch_scheduler import T3BatchScheduler
+
+
+class FailingPrefillT3:
+    "Just enough of `T3` for `T3BatchScheduler` to admit a sequence, whose prefill then fails."
+
+    is_gpt = True
+    device = torch.device("cpu")
+
+    def __init__(self):
+        self.hp = SimpleNamespace(is_multilingual=False, start_speech_token=0, speech_cond_prompt_len=4)
+        self.decoder = SimpleNamespace(new_cache=lambda n_rows, length: None)
+        self.prefill_calls = 0
+
+    def prepare_speech_embeds(self, speech_tokens):
+        return torch.zeros(speech_tokens.size(0), 1, 8)
+
+    def prefill_prefix(self, cache, **kwargs):
+        self.prefill_calls += 1
+        raise RuntimeError("prefill failed")
+
+
+def test_failed_prefill_reaches_the_consumer_and_frees_rows():
+    scheduler = T3BatchScheduler(FailingPrefillT3(), max_rows=2).start()
+    errors = []
+
+    def consume():
+        try:
+            next(scheduler.stream(None, torch.zeros(1, 5, dtype=torch.long)))
+        except RuntimeError as e:
+            errors.append(e)
+
+    consumer = threading.Thread(target=consume, daemon=True)
+    consumer.start()
+    consumer.join(timeout=10)
+    assert not consumer.is_alive(), "the consumer never got the prefill error"
+    assert [str(e) for e in errors] == ["prefill failed"]
+    assert sorted(scheduler.free_rows) == [0, 1]
+    assert not scheduler.has_work
+
+
+def test_failed_prefill_does_not_stop_the_next_admissions():
+    t3 = FailingPrefillT3()
+    scheduler = T3BatchScheduler(t3, max_rows=1)
+    sequences = [scheduler.add(None, torch.zeros(1, 5, dtype=torch.long)) for _ in range(2)]
+    assert list(scheduler.run()) == []
+    assert t3.prefill_calls == 2
+    for seq in sequences:
+        assert seq.done and seq.stop_reason == "error"
+        assert isinstance(seq.chunks.get_nowait(), RuntimeError)
+    assert scheduler.free_rows == [0]
@@ -0,0 +1,53 @@
+import threading
+import time
+
+import torch
+
+from chatterbox.conds_cache import ConditionalsCache
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+from chatterbox.tts import Conditionals
+
+
+def make_conds():
+    t3 = T3Cond(speaker_emb=torch.zeros(1, 256), cond_prompt_speech_tokens=torch.zeros(1, 4, dtype=torch.long))
+    return Conditionals(t3, dict(embedding=torch.zeros(1, 192)))
+
+
+def test_concurrent_misses_build_once():
+    cache = ConditionalsCache()
+    builds = []
+
+    def create():
+        builds.append(threading.get_ident())
+        time.sleep(0.2)
+        return make_conds()
+
+    results = [None] * 4
+
+    def request(i):
+        results[i] = cache.get_or_create("voice", "cpu", Conditionals, create)
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(len(results))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(builds) == 1
+    assert all(conds is results[0] for conds in results)
+    assert cache.counters["misses"] == 1 and cache.counters["device_hits"] == 3
+    assert not cache._builds
+
+
+def test_failed_build_lets_the_next_caller_retry():
+    cache = ConditionalsCache()
+
+    def fail():
+        raise RuntimeError("bad clip")
+
+    try:
+        cache.get_or_create("voice", "cpu", Conditionals, fail)
+    except RuntimeError:
+        pass
+    conds = cache.get_or_create("voice", "cpu", Conditionals, make_conds)
+    assert conds is cache.get("voice", "cpu", Conditionals)
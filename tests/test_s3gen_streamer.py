@@ -0,0 +1,46 @@
+import torch
+
+from chatterbox.models.s3gen import S3Gen, S3GenStreamer
+
+
+def make_s3gen():
+    torch.manual_seed(0)
+    s3gen = S3Gen().eval()
+    ref_dict = dict(
+        prompt_token=torch.randint(0, 6561, (1, 30)), prompt_token_len=torch.tensor([30]),
+        prompt_feat=torch.randn(1, 60, 80), prompt_feat_len=None, embedding=torch.randn(1, 192),
+    )
+    return s3gen, ref_dict
+
+
+def stream(s3gen, ref_dict, tokens, **kwargs):
+    "The streamed waveform and the number of tokens (prompt included) the flow ran on, per chunk."
+    flow_sizes = []
+    flow_inference = s3gen.flow_inference
+
+    def counting_flow_inference(speech_tokens, ref_dict, **kwargs):
+        flow_sizes.append(speech_tokens.size(1) + ref_dict["prompt_token"].size(1))
+        return flow_inference(speech_tokens, ref_dict=ref_dict, **kwargs)
+
+    s3gen.flow_inference = counting_flow_inference
+    try:
+        streamer = S3GenStreamer(s3gen, ref_dict, n_cfm_timesteps=2, token_hop_len=10, **kwargs)
+        wavs = [streamer.push(tokens[:, i:i + 7]) for i in range(0, tokens.size(1), 7)]
+        wavs.append(streamer.flush())
+    finally:
+        del s3gen.flow_inference
+    return torch.cat(wavs, dim=1), flow_sizes
+
+
+def test_flow_work_per_chunk_is_bounded():
+    s3gen, ref_dict = make_s3gen()
+    tokens = torch.randint(0, 6561, (1, 80))
+    wav, flow_sizes = stream(s3gen, ref_dict, tokens, context_tokens=20)
+    # prompt + context + hop + lookahead, whatever the position in the utterance
+    assert max(flow_sizes) <= 30 + 20 + 10 + s3gen.flow.pre_lookahead_len
+    assert len(set(flow_sizes[2:-1])) == 1
+    samples_per_token = s3gen.flow.token_mel_ratio * int(s3gen.mel2wav.f0_upsamp.scale_factor)
+    assert wav.size(1) == tokens.size(1) * samples_per_token
+
+    _, full_flow_sizes = stream(s3gen, ref_dict, tokens, context_tokens=None)
+    assert full_flow_sizes[-1] == 30 + tokens.size(1)
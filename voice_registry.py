@@ -0,0 +1,112 @@
+"""Voice Registry - 注册一次参考音频，之后按 voice_id 合成"""
+import json
+import threading
+import time
+import uuid
+import logging
+from pathlib import Path
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class VoiceRegistry:
+    """
+    音色注册表 - 保存 `prepare_conditionals` 的结果（Conditionals），避免每次请求重复提取音色特征。
+    内存常驻，同时通过 `Conditionals.save` 落盘，API 与 MCP 进程可共享同一目录。
+    """
+
+    def __init__(self, voice_dir: Path, model_type: str = "turbo"):
+        # 不同模型的 conditionals 不通用（如 turbo 的 prompt token 长度不同），按模型类型分目录
+        self.voice_dir = Path(voice_dir) / model_type
+        self.voice_dir.mkdir(parents=True, exist_ok=True)
+        self.model_type = model_type
+        self.lock = threading.Lock()
+        self._voices = {}  # voice_id -> Conditionals
+        self._meta = {}    # voice_id -> dict
+
+    def _paths(self, voice_id: str):
+        return self.voice_dir / f"{voice_id}.pt", self.voice_dir / f"{voice_id}.json"
+
+    @staticmethod
+    def _valid_id(voice_id: str) -> bool:
+        return bool(voice_id) and voice_id.isalnum()
+
+    def enroll(self, model, wav_fpath: str, name: str = None) -> dict:
+        """提取参考音频的 conditionals 并注册（需在推理线程中调用）"""
+        start = time.time()
+        conds = model.get_conditionals(wav_fpath)
+        voice_id = uuid.uuid4().hex
+        meta = {
+            "voice_id": voice_id,
+            "name": name or voice_id[:8],
+            "model_type": self.model_type,
+            "created_at": int(time.time()),
+            "enroll_time": round(time.time() - start, 3),
+        }
+        conds_path, meta_path = self._paths(voice_id)
+        conds.save(conds_path)
+        meta_path.write_text(json.dumps(meta))
+        with self.lock:
+            self._voices[voice_id] = conds
+            self._meta[voice_id] = meta
+        logger.info(f"Voice {voice_id} enrolled in {meta['enroll_time']}s")
+        return meta
+
+    def exists(self, voice_id: str) -> bool:
+        if not self._valid_id(voice_id):
+            return False
+        with self.lock:
+            if voice_id in self._voices:
+                return True
+        return self._paths(voice_id)[0].exists()
+
+    def get(self, voice_id: str, device=None):
+        """按 voice_id 取 Conditionals；内存未命中时从磁盘加载。不存在则抛出 KeyError"""
+        from chatterbox.tts import Conditionals
+        from chatterbox.models.t3.modules.cond_enc import T3Cond
+
+        if not self._valid_id(voice_id):
+            raise KeyError(voice_id)
+        with self.lock:
+            conds = self._voices.get(voice_id)
+            if conds is None:
+                conds_path, meta_path = self._paths(voice_id)
+                if not conds_path.exists():
+                    raise KeyError(voice_id)
+                conds = Conditionals.load(conds_path, map_location=device or "cpu")
+                if device is not None:
+                    conds = conds.to(device)
+                self._voices[voice_id] = conds
+                if meta_path.exists():
+                    self._meta[voice_id] = json.loads(meta_path.read_text())
+            elif device is not None and conds.t3.speaker_emb.device.type != torch.device(device).type:
+                # 模型换了设备：替换为新设备上的副本，已取出的旧对象保持不变
+                conds = Conditionals(T3Cond(**conds.t3.__dict__), dict(conds.gen)).to(device)
+                self._voices[voice_id] = conds
+            return conds
+
+    def delete(self, voice_id: str) -> bool:
+        if not self._valid_id(voice_id):
+            return False
+        with self.lock:
+            self._voices.pop(voice_id, None)
+            self._meta.pop(voice_id, None)
+            removed = False
+            for path in self._paths(voice_id):
+                if path.exists():
+                    path.unlink()
+                    removed = True
+            return removed
+
+    def list(self) -> list:
+        with self.lock:
+            metas = dict(self._meta)
+        for meta_path in self.voice_dir.glob("*.json"):
+            if meta_path.stem not in metas:
+                try:
+                    metas[meta_path.stem] = json.loads(meta_path.read_text())
+                except (OSError, ValueError):
+                    pass
+        return sorted(metas.values(), key=lambda m: m.get("created_at", 0))